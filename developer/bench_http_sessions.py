@@ -0,0 +1,129 @@
+#
+# Compares bare requests.post calls with the shared keep-alive sessions in octoapp.httpsessions.
+#
+# This starts a local HTTPS server as a stand-in for the cloud function, with a self signed cert made by the
+# openssl cli, and then posts a notification sized json body to it many times with both approaches.
+#
+# Usage:
+#   python3 developer/bench_http_sessions.py [--count N] [--delay-ms N]
+#
+# --delay-ms adds a fake network round trip to every new connection, to get closer to a real uplink.
+# Note this needs the requests package and the openssl cli.
+#
+import os
+import sys
+import ssl
+import json
+import time
+import shutil
+import tempfile
+import threading
+import subprocess
+import http.server
+
+# Allow the benchmark to be run from anywhere in the repo.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+#pylint: disable=wrong-import-position
+import requests
+from octoapp.httpsessions import HttpSessions
+
+ConnectDelaySec = 0.0
+
+
+class _StandInHandler(http.server.BaseHTTPRequestHandler):
+
+    # HTTP/1.1 so the connection is kept alive.
+    protocol_version = "HTTP/1.1"
+    # The headers and body are written separately, without this delayed acks add 40ms to every kept alive request.
+    disable_nagle_algorithm = True
+
+    def setup(self):
+        # Simulate the round trips of a new connection.
+        if ConnectDelaySec > 0:
+            time.sleep(ConnectDelaySec)
+        super().setup()
+
+    def do_POST(self):
+        length = int(self.headers.get("Content-Length", "0"))
+        self.rfile.read(length)
+        body = json.dumps({"invalidTokens": []}).encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args): #pylint: disable=redefined-builtin
+        pass
+
+
+def StartServer(certDir:str):
+    certPath = os.path.join(certDir, "cert.pem")
+    keyPath = os.path.join(certDir, "key.pem")
+    subprocess.run(["openssl", "req", "-x509", "-newkey", "rsa:2048", "-nodes", "-keyout", keyPath, "-out", certPath,
+                    "-days", "1", "-subj", "/CN=localhost", "-addext", "subjectAltName=DNS:localhost,IP:127.0.0.1"],
+                   check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", 0), _StandInHandler)
+    context = ssl.SSLContext(ssl.PROTOCOL_TLS_SERVER)
+    context.load_cert_chain(certPath, keyPath)
+    server.socket = context.wrap_socket(server.socket, server_side=True)
+    t = threading.Thread(target=server.serve_forever)
+    t.daemon = True
+    t.start()
+    return server, certPath
+
+
+def Run(name:str, postFunc, url:str, certPath:str, count:int):
+    body = {
+        "targets": [{"fcmToken": "x" * 160, "fcmTokenFallback": None, "instanceId": "instance"}],
+        "highPriority": True,
+        "androidData": "y" * 1500,
+        "apnsData": None,
+    }
+    latencies = []
+    start = time.perf_counter()
+    cpuStart = time.process_time()
+    for _ in range(count):
+        s = time.perf_counter()
+        r = postFunc(url, json=body, timeout=(5.0, 10.0), verify=certPath)
+        r.json()
+        latencies.append((time.perf_counter() - s) * 1000.0)
+    elapsed = time.perf_counter() - start
+    cpu = time.process_time() - cpuStart
+    latencies.sort()
+    print(f"{name:<22} avg: {sum(latencies) / count:7.2f} ms  p50: {latencies[count // 2]:7.2f} ms  p95: {latencies[int(count * 0.95)]:7.2f} ms  total: {elapsed:6.2f}s  cpu: {cpu:6.2f}s")
+    return sum(latencies) / count
+
+
+def Main():
+    global ConnectDelaySec
+    args = sys.argv[1:]
+    count = 200
+    if "--count" in args:
+        count = int(args[args.index("--count") + 1])
+    if "--delay-ms" in args:
+        ConnectDelaySec = float(args[args.index("--delay-ms") + 1]) / 1000.0
+
+    certDir = tempfile.mkdtemp()
+    try:
+        server, certPath = StartServer(certDir)
+        url = f"https://localhost:{server.server_address[1]}/sendNotificationV2"
+        print(f"Posting {count} notifications to {url}")
+        print("")
+        bare = Run("bare requests.post", requests.post, url, certPath, count)
+        shared = Run("shared session", HttpSessions.Get().Post, url, certPath, count)
+        print("")
+        print(f"Latency improvement: {bare / shared:.1f}x")
+        print(f"Session stats: {json.dumps(HttpSessions.Get().GetStats())}")
+        server.shutdown()
+    finally:
+        shutil.rmtree(certDir, ignore_errors=True)
+
+
+if __name__ == '__main__':
+    # Sentry needs a logger, even though we don't log much.
+    import logging
+    from octoapp.sentry import Sentry
+    Sentry.Init(logging.getLogger("bench"), "bench", True)
+    Main()
@@ -0,0 +1,170 @@
+#
+# Benchmark for parsing mjpeg streams.
+#
+# This measures how many frames per second can be parsed out of a recorded stream, comparing the old
+# "read 300 bytes, decode and split the headers, grow the buffer" approach with the MjpegParser, with and
+# without Content-Length headers in the parts.
+#
+# Usage:
+#   python3 developer/bench_mjpeg_parser.py [recording] [--seconds N]
+#
+# The recording is optional. It's the raw body of a mjpeg stream, which can be recorded with something like:
+#   curl -s --max-time 10 "http://printer.local/webcam/?action=stream" > stream.mjpeg
+# If no recording is given, a synthetic one is generated with 720p sized frames.
+#
+import io
+import os
+import sys
+import time
+import random
+
+# Allow the benchmark to be run from anywhere in the repo.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+#pylint: disable=wrong-import-position
+from octoapp.mjpegparser import MjpegParser
+
+
+# Builds a jpeg shaped buffer, with the segments the parser walks and random scan data of about the given size.
+def BuildJpeg(rnd:random.Random, scanSize:int) -> bytes:
+    scan = rnd.randbytes(scanSize).replace(b"\xff", b"\xff\x00")
+    header = b"\xff\xd8" + b"\xff\xe0\x00\x10JFIF\x00\x01\x01\x00\x00\x01\x00\x01\x00\x00"
+    quant = b"\xff\xdb\x00\x43\x00" + rnd.randbytes(64)
+    sos = b"\xff\xda\x00\x0c\x03\x01\x00\x02\x11\x03\x11\x00\x3f\x00"
+    return header + quant + sos + scan + b"\xff\xd9"
+
+
+def BuildStream(frames:list, withContentLength:bool) -> bytes:
+    parts = []
+    for frame in frames:
+        headers = b"\r\n--boundarydonotcross\r\nContent-Type: image/jpeg\r\n"
+        if withContentLength:
+            headers += b"Content-Length: " + str(len(frame)).encode() + b"\r\n"
+        headers += b"X-Timestamp: 2122192.753042\r\n\r\n"
+        parts.append(headers + frame)
+    return b"".join(parts)
+
+
+def BuildSyntheticFrames() -> list:
+    rnd = random.Random(42)
+    # A 720p frame from a typical printer camera is about 60-120KB.
+    return [BuildJpeg(rnd, rnd.randint(60000, 120000)) for _ in range(30)]
+
+
+# Splits a recording into frames, so streams with and without the Content-Length can be built from it.
+def LoadRecording(path:str) -> list:
+    with open(path, "rb") as f:
+        data = f.read()
+    parser = MjpegParser()
+    parser.Feed(data)
+    frames = []
+    while True:
+        frame = parser.NextFrame()
+        if frame is None:
+            break
+        frames.append(bytes(frame[1]))
+    return frames
+
+
+# The old way _GetSnapshotFromStream read a frame, looped so it reads every frame of the stream.
+# This needs the Content-Length header.
+def OldParse(raw) -> int:
+    count = 0
+    while True:
+        dataBuffer = raw.read(300)
+        if dataBuffer is None or len(dataBuffer) == 0:
+            return count
+        headerStr = dataBuffer.decode(errors="ignore")
+        headerStrSize = headerStr.find("\r\n\r\n")
+        if headerStrSize == -1:
+            raise Exception("No end of headers found.")
+        headerStrSize += 4
+        frameSizeInt = 0
+        contentType = None
+        for header in headerStr.split("\r\n"):
+            headerLower = header.lower()
+            if headerLower.startswith("content-type"):
+                p = header.split(':')
+                if len(p) == 2:
+                    contentType = p[1].strip()
+            if headerLower.startswith("content-length"):
+                p = header.split(':')
+                if len(p) == 2:
+                    frameSizeInt = int(p[1].strip())
+        if frameSizeInt == 0 or contentType is None:
+            raise Exception("No frame size found.")
+        totalDesiredBufferSize = frameSizeInt + headerStrSize
+        toRead = totalDesiredBufferSize - len(dataBuffer)
+        if toRead > 0:
+            dataBuffer += raw.read(toRead)
+        _ = dataBuffer[headerStrSize:]
+        count += 1
+
+
+# The parser, leaving the frames as views into its buffer.
+def NewParse(raw) -> int:
+    parser = MjpegParser()
+    count = 0
+    while parser.ReadFrame(raw) is not None:
+        count += 1
+    return count
+
+
+# The parser, plus the one copy the stream reader makes of every frame it keeps.
+def NewParseAndKeep(raw) -> int:
+    parser = MjpegParser()
+    count = 0
+    while True:
+        frame = parser.ReadFrame(raw)
+        if frame is None:
+            return count
+        _ = bytes(frame[1])
+        count += 1
+
+
+def Run(name:str, func, stream:bytes, seconds:float):
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        count += func(io.BytesIO(stream))
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    mbPerSec = rate * (len(stream) / max(func(io.BytesIO(stream)), 1)) / (1024 * 1024)
+    print(f"{name:<40} {rate:>10,.0f} frames/s  {mbPerSec:>8,.0f} MB/s  ({1000.0 / rate:.3f} ms/frame)")
+    return rate
+
+
+def Main():
+    args = sys.argv[1:]
+    seconds = 2.0
+    if "--seconds" in args:
+        seconds = float(args[args.index("--seconds") + 1])
+    files = [a for a in args if a.startswith("--") is False and os.path.isfile(a)]
+
+    if len(files) > 0:
+        frames = LoadRecording(files[0])
+        print(f"Loaded {len(frames)} frames from {files[0]}")
+    else:
+        frames = BuildSyntheticFrames()
+        print(f"Using {len(frames)} synthetic frames")
+    if len(frames) == 0:
+        print("No frames found.")
+        return
+    print(f"Average frame size: {sum(len(f) for f in frames) / len(frames) / 1024:.1f} KB")
+    print("")
+
+    withLength = BuildStream(frames, True)
+    withoutLength = BuildStream(frames, False)
+
+    base = Run("old: read 300 + split + append", OldParse, withLength, seconds)
+    new = Run("new: parser, Content-Length", NewParse, withLength, seconds)
+    Run("new: parser, Content-Length, keep copy", NewParseAndKeep, withLength, seconds)
+    Run("new: parser, SOI/EOI scan", NewParse, withoutLength, seconds)
+    Run("new: parser, SOI/EOI scan, keep copy", NewParseAndKeep, withoutLength, seconds)
+    print("")
+    print(f"Speedup with Content-Length: {new / base:.1f}x")
+
+
+if __name__ == '__main__':
+    Main()
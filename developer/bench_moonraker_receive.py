@@ -0,0 +1,170 @@
+#
+# Micro-benchmark for the Moonraker websocket receive path.
+#
+# This measures how many messages per second MoonrakerClient._onWsMsg can get through before the message
+# is handed off to the queue, comparing the old "parse everything" path with the method sniff and the json codec backends.
+#
+# Usage:
+#   python3 developer/bench_moonraker_receive.py [recording] [--debug] [--seconds N]
+#
+# The recording is optional. It's a text file with one websocket message per line. Lines copied from a DEBUG log
+# work as well, anything before the "<- " marker is ignored. If no recording is given, a synthetic recording is
+# generated that matches the traffic of a printing Klipper machine.
+#
+import os
+import sys
+import json
+import time
+import random
+
+# Allow the benchmark to be run from anywhere in the repo.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+#pylint: disable=wrong-import-position
+from moonraker_octoapp.jsoncodec import JsonCodec
+from moonraker_octoapp.notificationdispatcher import NotificationDispatcher
+
+# A dispatcher with the same registrations as MoonrakerClient, but with handlers that do nothing.
+# It also decides which notifications are parsed, the same way MoonrakerClient does.
+Dispatcher = NotificationDispatcher()
+Dispatcher.RegisterMethodHandler("notify_history_changed", lambda params: None)
+Dispatcher.RegisterMethodHandler("notify_webcams_changed", lambda params: None)
+Dispatcher.RegisterMethodHandler("notify_filelist_changed", lambda params: None)
+Dispatcher.RegisterStatusHandler(["print_stats", "virtual_sdcard"], lambda status, eventTime: None)
+
+
+def LoadRecording(path:str):
+    msgs = []
+    with open(path, "rb") as f:
+        for line in f:
+            marker = line.find(b"<- ")
+            if marker != -1:
+                line = line[marker + 3:]
+            line = line.strip()
+            if len(line) == 0 or line.startswith(b"{") is False:
+                continue
+            msgs.append(line)
+    return msgs
+
+
+# Builds about a minute of traffic from a printing machine.
+def BuildSyntheticRecording():
+    rnd = random.Random(42)
+    msgs = []
+    eventTime = 1000.0
+    msgId = 0
+    for second in range(60):
+        # Moonraker's process stats, once a second.
+        msgs.append(json.dumps({"jsonrpc": "2.0", "method": "notify_proc_stat_update", "params": [{
+            "moonraker_stats": {"time": eventTime, "cpu_usage": rnd.random() * 10, "memory": 42000, "mem_units": "kB"},
+            "cpu_temp": 45.5, "network": {"lo": {"rx_bytes": 1000000, "tx_bytes": 1000000, "bandwidth": 1234.5}, "wlan0": {"rx_bytes": 2000000, "tx_bytes": 3000000, "bandwidth": 4321.0}},
+            "system_cpu_usage": {"cpu": 12.5, "cpu0": 10.0, "cpu1": 15.0, "cpu2": 11.0, "cpu3": 14.0},
+            "system_memory": {"total": 3800000, "available": 3000000, "used": 800000},
+            "websocket_connections": 3}]}))
+        # Status updates, about 4 a second while printing.
+        for _ in range(4):
+            eventTime += 0.25
+            msgs.append(json.dumps({"jsonrpc": "2.0", "method": "notify_status_update", "params": [{
+                "toolhead": {"position": [rnd.random() * 200, rnd.random() * 200, 0.2 + second * 0.01, 1234.5], "estimated_print_time": eventTime},
+                "gcode_move": {"gcode_position": [rnd.random() * 200, rnd.random() * 200, 0.2 + second * 0.01, 1234.5], "position": [1, 2, 3, 4]},
+                "virtual_sdcard": {"progress": second / 600.0, "file_position": second * 1000},
+                "print_stats": {"print_duration": eventTime - 900, "total_duration": eventTime - 880, "filament_used": second * 10.0},
+                "extruder": {"temperature": 215.0 + rnd.random()},
+                "heater_bed": {"temperature": 60.0 + rnd.random()}}, eventTime]}))
+        # Some console traffic and a response now and then.
+        if second % 5 == 0:
+            msgs.append(json.dumps({"jsonrpc": "2.0", "method": "notify_gcode_response", "params": ["// Klipper state: Ready"]}))
+        if second % 10 == 0:
+            msgs.append(json.dumps({"jsonrpc": "2.0", "result": {"klippy_state": "ready", "components": ["database", "file_manager"]}, "id": msgId}))
+            msgId += 1
+    return [m.encode("utf-8") for m in msgs]
+
+
+# The receive path before the sniff, parse every message and decode it again for the debug log check.
+def OldPath(msgBytes, debug:bool):
+    msgObj = json.loads(msgBytes)
+    if debug:
+        msgStr = msgBytes.decode(encoding="utf-8")
+        if "moonraker_stats" not in msgStr:
+            pass
+    return msgObj
+
+
+# The new receive path, sniff the method first and only parse messages we handle.
+def NewPath(msgBytes, debug:bool):
+    method = JsonCodec.SniffJsonRpcMethod(msgBytes)
+    if method is not None and Dispatcher.IsHandled(method) is False:
+        return None
+    msgObj = JsonCodec.Loads(msgBytes)
+    if debug:
+        _ = msgBytes.decode(encoding="utf-8")
+    return msgObj
+
+
+# The new receive path, plus the dispatch the message worker does.
+def NewPathWithDispatch(msgBytes, debug:bool):
+    msgObj = NewPath(msgBytes, debug)
+    if msgObj is not None and "method" in msgObj:
+        Dispatcher.Dispatch(msgObj)
+    return msgObj
+
+
+def Run(name:str, func, msgs, debug:bool, seconds:float):
+    count = 0
+    start = time.perf_counter()
+    end = start + seconds
+    while time.perf_counter() < end:
+        for m in msgs:
+            func(m, debug)
+        count += len(msgs)
+    elapsed = time.perf_counter() - start
+    rate = count / elapsed
+    print(f"{name:<32} {rate:>12,.0f} msg/s  ({1000000.0 / rate:.2f} us/msg)")
+    return rate
+
+
+def Main():
+    args = sys.argv[1:]
+    debug = "--debug" in args
+    seconds = 2.0
+    if "--seconds" in args:
+        seconds = float(args[args.index("--seconds") + 1])
+    files = [a for a in args if a.startswith("--") is False and os.path.isfile(a)]
+
+    if len(files) > 0:
+        msgs = LoadRecording(files[0])
+        print(f"Loaded {len(msgs)} messages from {files[0]}")
+    else:
+        msgs = BuildSyntheticRecording()
+        print(f"Using {len(msgs)} synthetic messages")
+
+    dropped = sum(1 for m in msgs if NewPath(m, False) is None)
+    print(f"Messages dropped by the method sniff: {dropped} of {len(msgs)}")
+    print(f"Debug log decode: {debug}")
+    print("")
+
+    base = Run("old: json.loads everything", OldPath, msgs, debug, seconds)
+    JsonCodec.SetBackend("json")
+    Run("new: sniff + json", NewPath, msgs, debug, seconds)
+    if JsonCodec.SetBackend("orjson"):
+        new = Run("new: sniff + orjson", NewPath, msgs, debug, seconds)
+        Run("new: sniff + orjson + dispatch", NewPathWithDispatch, msgs, debug, seconds)
+    else:
+        print("orjson isn't installed, skipping the orjson backend.")
+        new = None
+    if new is not None:
+        print("")
+        print(f"Speedup with orjson: {new / base:.1f}x")
+
+    print("")
+    print("Dispatch time per method:")
+    for method, stats in Dispatcher.GetStats().items():
+        print(f"  {method:<26} count: {stats['Count']:>9}  avg: {stats['AvgMs'] * 1000.0:.2f} us  max: {stats['MaxMs'] * 1000.0:.2f} us")
+
+
+if __name__ == '__main__':
+    # Sentry needs a logger, even though we don't log much.
+    import logging
+    from octoapp.sentry import Sentry
+    Sentry.Init(logging.getLogger("bench"), "bench", True)
+    Main()
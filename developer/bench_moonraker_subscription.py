@@ -0,0 +1,183 @@
+#
+# Measures how many notify_status_update messages a printer object subscription causes.
+#
+# Moonraker only pushes a status update when a subscribed field changed, so this replays a recording of status updates
+# made with a broad subscription, filters each one down to what a narrower subscription would get, and counts the
+# messages and bytes per minute that would still be sent.
+#
+# Usage:
+#   python3 developer/bench_moonraker_subscription.py [recording]
+#
+# The recording is optional. It's a text file with one websocket message per line, lines copied from a DEBUG log
+# work as well. The recording must be made with a subscription that includes everything in the "before" subscription
+# below, for example with the old one. If no recording is given, a synthetic print is generated.
+#
+import os
+import sys
+import json
+import random
+
+# Allow the benchmark to be run from anywhere in the repo.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+#pylint: disable=wrong-import-position
+from moonraker_octoapp.printerobjectsubscription import PrinterObjectSubscription
+
+# The subscription before it was built from the registered fields.
+c_BeforeSubscription = {
+    "print_stats": None,
+    "webhooks": None,
+    "virtual_sdcard": None,
+    "history" : None,
+    "toolhead": None,
+    "gcode_move": None,
+}
+
+# Must match the fields MoonrakerClient and MoonrakerCompat register.
+c_RegisteredFields = {
+    "PrintStatusUpdate": {
+        "print_stats": ["state"],
+        "virtual_sdcard": ["progress"],
+    },
+    "MoonrakerCompat": {
+        "print_stats": ["state", "filename", "print_duration", "total_duration", "filament_used", "info"],
+        "virtual_sdcard": ["progress"],
+        "gcode_move": ["speed_factor", "gcode_position"],
+        "toolhead": ["position"],
+    },
+}
+
+
+def LoadRecording(path:str):
+    msgs = []
+    with open(path, "rb") as f:
+        for line in f:
+            marker = line.find(b"<- ")
+            if marker != -1:
+                line = line[marker + 3:]
+            line = line.strip()
+            if len(line) == 0 or line.startswith(b"{") is False:
+                continue
+            try:
+                msg = json.loads(line)
+            except Exception:
+                continue
+            if msg.get("method", None) == "notify_status_update":
+                msgs.append(msg)
+    return msgs
+
+
+# Builds the status updates of a print, 2 minutes of heating, 10 minutes of printing and 2 minutes idle.
+# Moonraker sends at most one update every 250ms, with all of the fields that changed in that time.
+def BuildSyntheticRecording():
+    rnd = random.Random(42)
+    msgs = []
+    eventTime = 1000.0
+    printDuration = 0.0
+    totalDuration = 0.0
+    filePosition = 0
+    fileSize = 2000000
+    z = 0.2
+
+    def add(status):
+        msgs.append({"jsonrpc": "2.0", "method": "notify_status_update", "params": [status, eventTime]})
+
+    # Start, the state changes once.
+    add({"print_stats": {"state": "printing", "filename": "benchy.gcode"}, "virtual_sdcard": {"is_active": True, "file_path": "/gcodes/benchy.gcode"}})
+    for phase, seconds in (("heating", 120), ("printing", 600), ("idle", 120)):
+        if phase == "idle":
+            add({"print_stats": {"state": "complete"}, "virtual_sdcard": {"is_active": False}})
+        for _ in range(seconds * 4):
+            eventTime += 0.25
+            # The toolhead time moves all the time, even when idle.
+            status = {"toolhead": {"estimated_print_time": eventTime - 900, "print_time": eventTime - 899}}
+            if phase != "idle":
+                totalDuration += 0.25
+                status["print_stats"] = {"total_duration": totalDuration}
+            if phase == "printing":
+                printDuration += 0.25
+                filePosition += rnd.randint(500, 1500)
+                if rnd.random() < 0.01:
+                    z += 0.2
+                    status["print_stats"]["info"] = {"current_layer": int(z / 0.2), "total_layer": 240}
+                x = rnd.random() * 200
+                y = rnd.random() * 200
+                status["print_stats"]["print_duration"] = printDuration
+                status["print_stats"]["filament_used"] = printDuration * 3.2
+                status["virtual_sdcard"] = {"file_position": filePosition, "progress": round(filePosition / fileSize, 4)}
+                status["toolhead"]["position"] = [x, y, z, printDuration * 3.2]
+                status["gcode_move"] = {"gcode_position": [x, y, z, printDuration * 3.2], "position": [x, y, z, printDuration * 3.2]}
+            add(status)
+    return msgs
+
+
+# Filters the status update down to what the subscription would send. Returns None if nothing would be sent.
+def FilterForSubscription(msg:dict, subscribeObjects:dict):
+    out = {}
+    for p in msg.get("params", []):
+        if isinstance(p, dict) is False:
+            continue
+        for objectName, fields in p.items():
+            if objectName not in subscribeObjects or isinstance(fields, dict) is False:
+                continue
+            subscribed = subscribeObjects[objectName]
+            if subscribed is None:
+                out[objectName] = fields
+            else:
+                filtered = {k: v for k, v in fields.items() if k in subscribed}
+                if len(filtered) > 0:
+                    out[objectName] = filtered
+    if len(out) == 0:
+        return None
+    return {"jsonrpc": "2.0", "method": "notify_status_update", "params": [out, msg["params"][-1]]}
+
+
+def Measure(name:str, msgs, subscribeObjects:dict, minutes:float):
+    count = 0
+    totalBytes = 0
+    for m in msgs:
+        filtered = FilterForSubscription(m, subscribeObjects)
+        if filtered is None:
+            continue
+        count += 1
+        totalBytes += len(json.dumps(filtered))
+    print(f"{name:<8} {count / minutes:>9,.0f} msgs/min {totalBytes / minutes / 1024.0:>9,.1f} KB/min   {json.dumps(subscribeObjects)}")
+    return count
+
+
+def Main():
+    files = [a for a in sys.argv[1:] if os.path.isfile(a)]
+    if len(files) > 0:
+        msgs = LoadRecording(files[0])
+        print(f"Loaded {len(msgs)} status updates from {files[0]}")
+    else:
+        msgs = BuildSyntheticRecording()
+        print(f"Using {len(msgs)} synthetic status updates")
+    if len(msgs) == 0:
+        return
+
+    # Use the eventtime to find how long the recording is.
+    eventTimes = [p for m in msgs for p in m.get("params", []) if isinstance(p, (int, float))]
+    minutes = 1.0
+    if len(eventTimes) > 1:
+        minutes = max((max(eventTimes) - min(eventTimes)) / 60.0, 1.0 / 60.0)
+    print(f"Recording length: {minutes:.1f} minutes")
+    print("")
+
+    subscription = PrinterObjectSubscription()
+    for consumerName, objectFields in c_RegisteredFields.items():
+        subscription.Register(consumerName, objectFields)
+
+    before = Measure("before", msgs, c_BeforeSubscription, minutes)
+    after = Measure("after", msgs, subscription.BuildSubscribeObjects(), minutes)
+    if before > 0:
+        print("")
+        print(f"Messages reduced by {(1.0 - after / before) * 100.0:.0f}%")
+
+
+if __name__ == '__main__':
+    # Sentry needs a logger, even though we don't log much.
+    import logging
+    from octoapp.sentry import Sentry
+    Sentry.Init(logging.getLogger("bench"), "bench", True)
+    Main()
@@ -0,0 +1,241 @@
+#
+# Benchmark for the notification snapshot transform.
+#
+# This measures how long it takes to flip, rotate, resize and re-encode snapshots, comparing the old pipeline, which
+# decoded the full image and did a pass for each flip and the rotation before re-encoding at quality 95, with the
+# SnapshotTransform, which uses jpeg draft mode, one transpose and the quality picked by the requester.
+#
+# Each variant runs in its own process, so the peak RSS reported is only from that variant.
+#
+# Usage:
+#   python3 developer/bench_snapshot_transform.py [frames...] [--iterations N]
+#
+# The frames are optional, they can be jpeg files or folders of them, like snapshots saved from the printer's camera.
+# If none are given, synthetic 1080p frames are generated. This needs Pillow installed.
+#
+import io
+import os
+import math
+import sys
+import json
+import time
+import resource
+import tempfile
+import subprocess
+
+# Allow the benchmark to be run from anywhere in the repo.
+sys.path.insert(0, os.path.abspath(os.path.join(os.path.dirname(__file__), "..")))
+
+#pylint: disable=wrong-import-position
+from PIL import Image
+from octoapp.snapshotresizeparams import SnapshotResizeParams
+from octoapp.snapshottransform import SnapshotTransform
+
+
+# name -> (resize params factory, flipH, flipV, rotation)
+Scenarios = {
+    # The default for notifications, which does nothing for a 1080p camera unless it's flipped or rotated.
+    "notification 1080, flip h+v":      (lambda q: SnapshotResizeParams(1080, True, False, False, q), True, True, 0),
+    "notification 1080, rotate 90":     (lambda q: SnapshotResizeParams(1080, True, False, False, q), False, False, 90),
+    "max height 720, flip h":           (lambda q: SnapshotResizeParams(720, True, False, False, q), True, False, 0),
+    "max height 480, flip v, rotate 270": (lambda q: SnapshotResizeParams(480, True, False, False, q), False, True, 270),
+    "gadget center crop 300":           (lambda q: SnapshotResizeParams(300, False, False, True, q), False, False, 0),
+}
+
+# name -> (function, quality)
+Variants = {
+    "old q95":  ("old", 95),
+    "new q95":  ("new", 95),
+    "new q85":  ("new", 85),
+}
+
+
+# Builds frames that compress like a camera image, smooth areas with some noise, rather than pure noise.
+def BuildSyntheticFrames() -> list:
+    frames = []
+    for i in range(5):
+        gradient = Image.radial_gradient("L").resize((1920, 1080))
+        noise = Image.effect_noise((1920, 1080), 24 + i * 4)
+        image = Image.merge("RGB", (gradient, noise, Image.linear_gradient("L").resize((1920, 1080))))
+        buffer = io.BytesIO()
+        image.save(buffer, format="JPEG", quality=90)
+        frames.append(buffer.getvalue())
+    return frames
+
+
+def LoadFrames(paths:list) -> list:
+    frames = []
+    for path in paths:
+        files = [path]
+        if os.path.isdir(path):
+            files = sorted(os.path.join(path, f) for f in os.listdir(path) if f.lower().endswith((".jpg", ".jpeg")))
+        for file in files:
+            with open(file, "rb") as f:
+                frames.append(f.read())
+    return frames
+
+
+# The pipeline as it was in NotificationsHandler.GetNotificationSnapshot, copied so it doesn't change with SnapshotTransform.
+def OldTransform(snapshot, snapshotResizeParams, flipH, flipV, rotation, quality):
+    # In pillow ~9.1.0 these constants moved.
+    # pylint: disable=no-member
+    OE_FLIP_LEFT_RIGHT = 0
+    OE_FLIP_TOP_BOTTOM = 0
+    try:
+        OE_FLIP_LEFT_RIGHT = Image.FLIP_LEFT_RIGHT
+        OE_FLIP_TOP_BOTTOM = Image.FLIP_TOP_BOTTOM
+    except Exception:
+        OE_FLIP_LEFT_RIGHT = Image.Transpose.FLIP_LEFT_RIGHT
+        OE_FLIP_TOP_BOTTOM = Image.Transpose.FLIP_TOP_BOTTOM
+    # pylint: enable=no-member
+
+    pilImage = Image.open(io.BytesIO(snapshot))
+    if flipH:
+        pilImage = pilImage.transpose(OE_FLIP_LEFT_RIGHT)
+    if flipV:
+        pilImage = pilImage.transpose(OE_FLIP_TOP_BOTTOM)
+    if rotation != 0:
+        pilImage = pilImage.rotate(360 - rotation)
+
+    if snapshotResizeParams is not None:
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            if pilImage.height >= snapshotResizeParams.Size and pilImage.width >= snapshotResizeParams.Size:
+                if pilImage.height < pilImage.width:
+                    snapshotResizeParams.ResizeToHeight = True
+                    snapshotResizeParams.ResizeToWidth = False
+                else:
+                    snapshotResizeParams.ResizeToHeight = False
+                    snapshotResizeParams.ResizeToWidth = True
+
+        resizeHeight = None
+        resizeWidth = None
+        if snapshotResizeParams.ResizeToHeight:
+            if pilImage.height > snapshotResizeParams.Size:
+                resizeHeight = snapshotResizeParams.Size
+                resizeWidth = int((float(snapshotResizeParams.Size) / float(pilImage.height)) * float(pilImage.width))
+        if snapshotResizeParams.ResizeToWidth:
+            if pilImage.width > snapshotResizeParams.Size:
+                resizeHeight = int((float(snapshotResizeParams.Size) / float(pilImage.width)) * float(pilImage.height))
+                resizeWidth = snapshotResizeParams.Size
+        if resizeHeight is not None and resizeWidth is not None:
+            pilImage = pilImage.resize((resizeWidth, resizeHeight))
+
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            if snapshotResizeParams.ResizeToHeight:
+                centerX = math.floor(float(pilImage.width) / 2.0)
+                halfWidth = math.floor(float(snapshotResizeParams.Size) / 2.0)
+                upper = 0
+                lower = snapshotResizeParams.Size
+                left = centerX - halfWidth
+                right = (snapshotResizeParams.Size - halfWidth) + centerX
+            else:
+                centerY = math.floor(float(pilImage.height) / 2.0)
+                halfHeight = math.floor(float(snapshotResizeParams.Size) / 2.0)
+                upper = centerY - halfHeight
+                lower = (snapshotResizeParams.Size - halfHeight) + centerY
+                left = 0
+                right = snapshotResizeParams.Size
+            if not (left < 0 or left > right or right > pilImage.width or upper > 0 or upper > lower or lower > pilImage.height):
+                pilImage = pilImage.crop((left, upper, right, lower))
+
+    buffer = io.BytesIO()
+    pilImage.save(buffer, format="JPEG", quality=quality)
+    return buffer.getvalue()
+
+
+def NewTransform(snapshot, params, flipH, flipV, rotation, _):
+    return SnapshotTransform.Apply(snapshot, params, flipH, flipV, rotation)
+
+
+# On Linux ru_maxrss is carried over from the parent through fork and exec, so it would report the parent's peak.
+# VmHWM is the peak of this process alone.
+def GetPeakRssKb() -> float:
+    try:
+        with open("/proc/self/status", "r", encoding="utf-8") as f:
+            for line in f:
+                if line.startswith("VmHWM:"):
+                    return float(line.split()[1])
+    except Exception:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # macOS reports bytes
+    return peak / 1024.0 if sys.platform == "darwin" else float(peak)
+
+
+# Runs one variant of one scenario in this process and prints the result as json.
+def RunOne(scenarioName:str, variantName:str, iterations:int, paths:list):
+    frames = LoadFrames(paths)
+    paramsFactory, flipH, flipV, rotation = Scenarios[scenarioName]
+    func, quality = Variants[variantName]
+    func = OldTransform if func == "old" else NewTransform
+
+    # The growth is measured from after the frames are loaded, so it's what the transform itself needs.
+    # One warm up run, so the lazy imports in PIL aren't counted in the times.
+    baseRssKb = GetPeakRssKb()
+    func(frames[0], paramsFactory(quality), flipH, flipV, rotation, quality)
+
+    times = []
+    outBytes = 0
+    for i in range(iterations):
+        frame = frames[i % len(frames)]
+        start = time.perf_counter()
+        out = func(frame, paramsFactory(quality), flipH, flipV, rotation, quality)
+        times.append(time.perf_counter() - start)
+        outBytes += len(out)
+    peakRssKb = GetPeakRssKb()
+    times.sort()
+    print(json.dumps({
+        "MedianMs": times[len(times) // 2] * 1000.0,
+        "P95Ms": times[min(len(times) - 1, int(len(times) * 0.95))] * 1000.0,
+        "PeakRssMb": peakRssKb / 1024.0,
+        "PeakRssGrowthMb": (peakRssKb - baseRssKb) / 1024.0,
+        "AvgOutKb": outBytes / iterations / 1024.0,
+    }))
+
+
+def Main():
+    args = sys.argv[1:]
+    iterations = 20
+    if "--iterations" in args:
+        iterations = int(args[args.index("--iterations") + 1])
+        del args[args.index("--iterations"):args.index("--iterations") + 2]
+    if "--run" in args:
+        i = args.index("--run")
+        scenarioName, variantName = args[i + 1], args[i + 2]
+        RunOne(scenarioName, variantName, iterations, args[:i] + args[i + 3:])
+        return
+
+    paths = [a for a in args if os.path.exists(a)]
+    isSynthetic = len(paths) == 0
+    if isSynthetic:
+        # Written to files, so the variant processes only hold the jpeg bytes and not the images used to make them.
+        tempDir = tempfile.mkdtemp()
+        for i, frame in enumerate(BuildSyntheticFrames()):
+            with open(os.path.join(tempDir, f"frame{i}.jpg"), "wb") as f:
+                f.write(frame)
+        paths = [tempDir]
+    frames = LoadFrames(paths)
+    if len(frames) == 0:
+        print("No frames found.")
+        return
+    size = Image.open(io.BytesIO(frames[0])).size
+    print(f"Using {len(frames)} {'synthetic ' if isSynthetic else ''}frames, {size[0]}x{size[1]}, average {sum(len(f) for f in frames) / len(frames) / 1024:.1f} KB")
+    print(f"{iterations} iterations per variant")
+    print("")
+    print(f"{'scenario':<36} {'variant':<9} {'median':>9} {'p95':>9} {'peak rss':>10} {'growth':>9} {'out size':>9}")
+    for scenarioName in Scenarios:
+        for variantName in Variants:
+            cmd = [sys.executable, os.path.abspath(__file__), "--run", scenarioName, variantName, "--iterations", str(iterations)] + paths
+            output = subprocess.run(cmd, check=True, capture_output=True, text=True).stdout
+            r = json.loads(output.strip().splitlines()[-1])
+            print(f"{scenarioName:<36} {variantName:<9} {r['MedianMs']:>7.1f}ms {r['P95Ms']:>7.1f}ms {r['PeakRssMb']:>8.1f}MB {r['PeakRssGrowthMb']:>7.1f}MB {r['AvgOutKb']:>7.1f}KB")
+        print("")
+
+    if isSynthetic:
+        for file in os.listdir(paths[0]):
+            os.remove(os.path.join(paths[0], file))
+        os.rmdir(paths[0])
+
+
+if __name__ == '__main__':
+    Main()
@@ -30,6 +30,8 @@ class Config:
     WebcamFlipH = "flip_horizontally"
     WebcamFlipV = "flip_vertically"
     WebcamRotation = "rotate"
+    WebcamSnapshotCacheTtlMs = "snapshot_cache_ttl_ms"
+    WebcamSnapshotStreamReader = "snapshot_stream_reader"
 
     # This allows us to add comments into our config.
     # The objects must have two parts, first, a string they target. If the string is found, the comment will be inserted above the target string. This can be a section or value.
@@ -38,6 +40,8 @@ class Config:
         # { "Target": RelayFrontEndPortKey,  "Comment": "The port used for http relay. If your desired frontend runs on a different port, change this value. The OctoApp plugin service needs to be restarted before changes will take effect."},
         # { "Target": RelayFrontEndTypeHintKey,  "Comment": "A string only used by the UI to hint at what web interface this port is."},
         { "Target": LogLevelKey,  "Comment": "The active logging level. Valid values include: DEBUG, INFO, WARNING, or ERROR."},
+        { "Target": WebcamSnapshotCacheTtlMs,  "Comment": "How long a webcam snapshot is reused, in milliseconds, so the camera isn't asked for the same frame more than once. Valid values are 0 to 10000, 0 turns the reuse off."},
+        { "Target": WebcamSnapshotStreamReader,  "Comment": "If there's no snapshot url, keep the webcam stream open while snapshots are needed, instead of opening it for every snapshot. Valid values are True or False"},
         # { "Target": WebcamNameToUseAsPrimary,  "Comment": "This is the webcam name OctoApp will use. This much match the camera 'Name' from your Mainsail of Fluidd webcam settings. The default value of 'Default' will pick whatever camera the system can find."},
         # { "Target": WebcamAutoSettings,  "Comment": "Enables or disables auto webcam setting detection. If enabled, OctoApp will find the webcam settings configured via the frontend (Fluidd, Mainsail, etc) and use them. Disable to manually set the values and have them not be overwritten."},
         # { "Target": WebcamStreamUrl,  "Comment": "Webcam streaming URL. This can be a local relative path (ex: /webcam/?action=stream) or absolute http URL (ex: http://10.0.0.1:8080/webcam/?action=stream or http://webcam.local/webcam/?action=stream)"},
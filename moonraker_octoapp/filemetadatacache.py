@@ -1,10 +1,26 @@
+import collections
+import threading
+
 from octoapp.sentry import Sentry
 
 # A helper class that caches known file metadata info, so we don't have to pull it often.
+#
+# The cache holds the metadata for the most recently used files. An entry stays valid until Moonraker tells us the file
+# changed with notify_filelist_changed. Files are keyed by name, and entries also remember the file's modified time,
+# so a change notification for the same version of the file doesn't throw away a good entry.
+#
+# Misses are single-flight, if a few threads ask for the same file at once only one server.files.metadata call is made,
+# and when a print is added we prefetch the file's metadata, so the first lookups of a print don't wait on the RPC.
 class FileMetadataCache:
 
     _Instance = None
 
+    # How many files we keep the metadata for.
+    c_MaxEntries = 20
+
+    # How long a caller will wait for someone else's in-flight metadata call.
+    c_InFlightWaitTimeoutSec = 30.0
+
     @staticmethod
     def Init(moonrakerClient):
         FileMetadataCache._Instance = FileMetadataCache(moonrakerClient)
@@ -17,103 +33,134 @@ class FileMetadataCache:
 
     def __init__(self, moonrakerClient) -> None:
         self.MoonrakerClient = moonrakerClient
-        self.FileName:str = None
-        self.EstimatedPrintTimeSec:float = -1.0
-        self.EstimatedFilamentUsageMm:int = -1
-        self.FileSizeKBytes:int = -1
-        self.LayerCount:float = -1.0
-        self.FirstLayerHeight:float = -1.0
-        self.LayerHeight:float = -1.0
-        self.ObjectHeight:float = -1.0
-        self.ResetCache()
+        self.Lock = threading.Lock()
+        # File name -> _FileMetadata, in LRU order, the most recently used is at the end.
+        self.Entries = collections.OrderedDict()
+        # File name -> threading.Event, for metadata calls that are in flight.
+        self.InFlight = {}
+        # Bumped each time the cache is cleared, so a fetch that was in flight during a clear doesn't add a stale entry.
+        self.Generation = 0
+        # Metrics
+        self.HitCount = 0
+        self.MissCount = 0
+        self.JoinedInFlightCount = 0
+        self.InvalidationCount = 0
+
+        # Moonraker tells us when files change, that's when we need to drop them from the cache.
+        self.MoonrakerClient.NotificationDispatcher.RegisterMethodHandler("notify_filelist_changed", self._OnFileListChanged)
 
 
     # Clears the cache from all current values.
+    # This is needed after a reconnect, since we might have missed file change notifications.
     def ResetCache(self):
-        self.FileName = None
-        self.EstimatedPrintTimeSec = -1.0
-        self.EstimatedFilamentUsageMm = -1
-        self.FileSizeKBytes = -1
-        self.LayerCount = -1.0
-        self.FirstLayerHeight = -1.0
-        self.LayerHeight = -1.0
-        self.ObjectHeight = -1.0
+        with self.Lock:
+            self.Entries.clear()
+            self.Generation += 1
+
+
+    # Starts getting the metadata for the file on a background thread, if it's not already cached or being fetched.
+    # Used when we know a file is about to be used, like when a print is added.
+    def Prefetch(self, filename:str) -> None:
+        if filename is None or len(filename) == 0:
+            return
+        with self.Lock:
+            if filename in self.Entries or filename in self.InFlight:
+                return
+        t = threading.Thread(target=self._GetEntry, args=(filename,))
+        t.daemon = True
+        t.start()
 
 
     # If the estimated time for the print can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1.0
     def GetEstimatedPrintTimeSec(self, filename:str) -> float:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedPrintTimeSec
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedPrintTimeSec
+        return self._GetEntry(filename).EstimatedPrintTimeSec
 
 
     # If the filament usage can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetEstimatedFilamentUsageMm(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.EstimatedFilamentUsageMm
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.EstimatedFilamentUsageMm
+        return self._GetEntry(filename).EstimatedFilamentUsageMm
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # It it's not known, returns -1
     def GetFileSizeKBytes(self, filename:str) -> int:
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return self.FileSizeKBytes
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return self.FileSizeKBytes
+        return self._GetEntry(filename).FileSizeKBytes
 
 
     # If the file size can be gotten from the file metadata, this will return it.
     # Any of the values will return -1 if they are unknown.
     def GetLayerInfo(self, filename:str):
-        # Check to see if we have checked for this file before.
-        if self.FileName is not None:
-            # Check if it's the same file, case sensitive.
-            if self.FileName == filename:
-                # Return the last result, this maybe valid or not.
-                return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-        # The filename changed or we don't have one at all, do a refresh now.
-        self._RefreshFileMetaDataCache(filename)
-
-        # Return the value, which could still be -1 if it failed.
-        return (self.LayerCount, self.LayerHeight, self.FirstLayerHeight, self.ObjectHeight)
-
-
-    # Does a refresh of the file name metadata cache.
-    def _RefreshFileMetaDataCache(self, filename:str) -> None:
-
-        # Reset everything.
-        self.ResetCache()
-
+        entry = self._GetEntry(filename)
+        return (entry.LayerCount, entry.LayerHeight, entry.FirstLayerHeight, entry.ObjectHeight)
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Entries": len(self.Entries),
+                "Hits": self.HitCount,
+                "Misses": self.MissCount,
+                "JoinedInFlight": self.JoinedInFlightCount,
+                "Invalidations": self.InvalidationCount,
+            }
+
+
+    # Returns the cached entry for the file, or gets it from moonraker.
+    # This always returns an entry, if the metadata can't be gotten all of the values will be -1.
+    def _GetEntry(self, filename:str):
+        while True:
+            with self.Lock:
+                entry = self.Entries.get(filename, None)
+                if entry is not None:
+                    self.Entries.move_to_end(filename)
+                    self.HitCount += 1
+                    return entry
+                inFlightEvent = self.InFlight.get(filename, None)
+                if inFlightEvent is None:
+                    # We are the one who will make the call.
+                    self.MissCount += 1
+                    inFlightEvent = threading.Event()
+                    self.InFlight[filename] = inFlightEvent
+                    generation = self.Generation
+                    break
+                self.JoinedInFlightCount += 1
+
+            # Someone else is getting this file, wait for them. If they failed, the entry won't be there and we will try ourselves.
+            inFlightEvent.wait(FileMetadataCache.c_InFlightWaitTimeoutSec)
+            with self.Lock:
+                entry = self.Entries.get(filename, None)
+                if entry is not None:
+                    return entry
+                # If the call is still running, it's stuck, don't wait on it again.
+                if self.InFlight.get(filename, None) is inFlightEvent:
+                    return _FileMetadata()
+
+        entry = None
+        try:
+            entry = self._FetchFileMetadata(filename)
+        except Exception as e:
+            Sentry.Exception("FileMetadataCache failed to fetch file metadata.", e)
+        finally:
+            with self.Lock:
+                # Only add the entry if the cache wasn't cleared while we were getting it.
+                if entry is not None and generation == self.Generation:
+                    self.Entries[filename] = entry
+                    while len(self.Entries) > FileMetadataCache.c_MaxEntries:
+                        self.Entries.popitem(last=False)
+                self.InFlight.pop(filename, None)
+            inFlightEvent.set()
+
+        # If we failed, the entry isn't cached so the next call will try again.
+        if entry is None:
+            return _FileMetadata()
+        return entry
+
+
+    # Gets the file name metadata from moonraker.
+    # Returns None on failure.
+    def _FetchFileMetadata(self, filename:str):
         # Make the call.
         result = self.MoonrakerClient.SendJsonRpcRequest("server.files.metadata",
         {
@@ -122,42 +169,99 @@ class FileMetadataCache:
 
         # If we fail this call, just return, which will keep the cache invalid.
         if result.HasError():
-            Sentry.Error("Metadata Cache", "_RefreshFileMetaDataCache failed to get file meta. "+result.GetLoggingErrorStr())
-            return
+            Sentry.Error("Metadata Cache", "_FetchFileMetadata failed to get file meta. "+result.GetLoggingErrorStr())
+            return None
 
         # If we got here, we know we got a good result.
-        # Set the cached vars so we don't call again, even though we might not be able to get them, meaning the file doesn't have them.
-        self.FileName = filename
+        # We cache the entry so we don't call again, even though we might not be able to get the values, meaning the file doesn't have them.
+        entry = _FileMetadata()
 
         # Get the value, if it exists and it's valid.
         res = result.GetResult()
-        if "estimated_time" in res:
+        if "modified" in res and res["modified"] is not None:
+            entry.Modified = float(res["modified"])
+        if "estimated_time" in res and res["estimated_time"] is not None:
             value = float(res["estimated_time"])
             if value > 0.001:
-                self.EstimatedPrintTimeSec = value
-        if "size" in res:
+                entry.EstimatedPrintTimeSec = value
+        if "size" in res and res["size"] is not None:
             value = int(res["size"])
             if value > 0:
-                self.FileSizeKBytes = int(value / 1024)
-        if "filament_total" in res:
+                entry.FileSizeKBytes = int(value / 1024)
+        if "filament_total" in res and res["filament_total"] is not None:
             value = int(res["filament_total"])
             if value > 0:
-                self.EstimatedFilamentUsageMm = value
+                entry.EstimatedFilamentUsageMm = value
         if "layer_count" in res and res["layer_count"] is not None:
             value = float(res["layer_count"])
             if value > 0:
-                self.LayerCount = value
+                entry.LayerCount = value
         if "first_layer_height" in res and res["first_layer_height"] is not None:
             value = float(res["first_layer_height"])
             if value > 0:
-                self.FirstLayerHeight = value
+                entry.FirstLayerHeight = value
         if "layer_height" in res and res["layer_height"] is not None:
             value = float(res["layer_height"])
             if value > 0:
-                self.LayerHeight = value
+                entry.LayerHeight = value
         if "object_height" in res and res["object_height"] is not None:
             value = float(res["object_height"])
             if value > 0:
-                self.ObjectHeight = value
+                entry.ObjectHeight = value
+
+        Sentry.Info("Metadata Cache", f"FileMetadataCache updated for file [{filename}]; est time: {str(entry.EstimatedPrintTimeSec)}, size: {str(entry.FileSizeKBytes)}, filament usage: {str(entry.EstimatedFilamentUsageMm)}")
+        return entry
 
-        Sentry.Info("Metadata Cache", f"FileMetadataCache updated for file [{filename}]; est time: {str(self.EstimatedPrintTimeSec)}, size: {str(self.FileSizeKBytes)}, filament usage: {str(self.EstimatedFilamentUsageMm)}")
+
+    # Called when moonraker reports a file or folder change.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#filelist-changed
+    def _OnFileListChanged(self, params:dict):
+        action = params.get("action", None)
+        item = params.get("item", None)
+        if item is None or item.get("root", "gcodes") != "gcodes":
+            return
+        path = item.get("path", None)
+        with self.Lock:
+            # If a folder changed, we don't know which files were in it, so drop everything.
+            if action is not None and action.endswith("_dir"):
+                if len(self.Entries) > 0:
+                    self.InvalidationCount += 1
+                self.Entries.clear()
+                self.Generation += 1
+                return
+            # For moves, the old path is gone.
+            sourceItem = params.get("source_item", None)
+            if sourceItem is not None:
+                self._InvalidateUnderLock(sourceItem.get("path", None), None)
+            self._InvalidateUnderLock(path, item.get("modified", None))
+
+
+    # Removes the file from the cache, unless the modified time shows the cached entry is the same version of the file.
+    # Must be called under lock.
+    def _InvalidateUnderLock(self, path:str, modified_CanBeNone) -> None:
+        if path is None:
+            return
+        entry = self.Entries.get(path, None)
+        if entry is None:
+            # If the file is being fetched right now, the result might be from before the change, so don't let it be added.
+            if path in self.InFlight:
+                self.Generation += 1
+            return
+        if modified_CanBeNone is not None and entry.Modified is not None and float(modified_CanBeNone) == entry.Modified:
+            return
+        del self.Entries[path]
+        self.InvalidationCount += 1
+
+
+# The metadata we keep for one file. Any value that's not known is -1.
+class _FileMetadata:
+
+    def __init__(self) -> None:
+        self.Modified:float = None
+        self.EstimatedPrintTimeSec:float = -1.0
+        self.EstimatedFilamentUsageMm:int = -1
+        self.FileSizeKBytes:int = -1
+        self.LayerCount:float = -1.0
+        self.FirstLayerHeight:float = -1.0
+        self.LayerHeight:float = -1.0
+        self.ObjectHeight:float = -1.0
@@ -0,0 +1,157 @@
+import json
+
+from octoapp.sentry import Sentry
+
+# orjson is much faster than the built in json module, but it's not installed on every system.
+# If it's there we use it, otherwise we fall back to the built in module.
+try:
+    import orjson
+except Exception as _:
+    orjson = None
+
+
+# The built in json module, which is always available.
+class _StdlibJsonBackend:
+
+    Name = "json"
+
+    @staticmethod
+    def Loads(buf):
+        return json.loads(buf)
+
+    @staticmethod
+    def Dumps(obj) -> str:
+        # default=str makes the json dump use the str function if it fails to serialize something.
+        return json.dumps(obj, default=str)
+
+
+# The orjson backend. orjson is a little stricter than the built in module (for example it doesn't allow NaN),
+# so if it fails we fall back to the built in module for that one message.
+class _OrjsonJsonBackend:
+
+    Name = "orjson"
+
+    @staticmethod
+    def Loads(buf):
+        try:
+            return orjson.loads(buf)  # pylint: disable=no-member
+        except Exception:
+            return json.loads(buf)
+
+    @staticmethod
+    def Dumps(obj) -> str:
+        try:
+            return orjson.dumps(obj, default=str, option=orjson.OPT_NON_STR_KEYS).decode("utf-8")  # pylint: disable=no-member
+        except Exception:
+            return json.dumps(obj, default=str)
+
+
+# The json codec used on the Moonraker websocket.
+# This also has a helper that can sniff the JSON-RPC method out of a raw message without parsing it,
+# so we can drop the notifications we don't use before paying for the full parse.
+class JsonCodec:
+
+    _Backend = _OrjsonJsonBackend if orjson is not None else _StdlibJsonBackend
+
+    # The JSON-RPC method key is always one of the first keys Moonraker sends, so we only look for it in the start of the message.
+    # Limiting the search also makes sure we don't match a "method" key deep inside of a result object.
+    c_MethodSniffWindow = 64
+
+    # The prefixes Moonraker's json libs produce for notifications, with and without whitespace.
+    _c_MethodPrefixesStr = ('{"jsonrpc": "2.0", "method": "', '{"jsonrpc":"2.0","method":"')
+    _c_MethodPrefixesBytes = (b'{"jsonrpc": "2.0", "method": "', b'{"jsonrpc":"2.0","method":"')
+
+
+    @staticmethod
+    def Loads(buf):
+        return JsonCodec._Backend.Loads(buf)
+
+
+    @staticmethod
+    def Dumps(obj) -> str:
+        return JsonCodec._Backend.Dumps(obj)
+
+
+    @staticmethod
+    def GetBackendName() -> str:
+        return JsonCodec._Backend.Name
+
+
+    # Sets the backend by name, "json" or "orjson". Returns False if the backend isn't available.
+    # This is mostly useful for benchmarking.
+    @staticmethod
+    def SetBackend(name:str) -> bool:
+        if name == _OrjsonJsonBackend.Name:
+            if orjson is None:
+                return False
+            JsonCodec._Backend = _OrjsonJsonBackend
+        elif name == _StdlibJsonBackend.Name:
+            JsonCodec._Backend = _StdlibJsonBackend
+        else:
+            return False
+        Sentry.Info("JsonCodec", "Json codec backend set to "+name)
+        return True
+
+
+    # Given the raw message, as bytes or a str, this tries to find the top level JSON-RPC method without parsing the message.
+    # Returns the method string if found, otherwise None.
+    # None doesn't mean there's no method, it only means it couldn't be found cheaply, so the message must be fully parsed.
+    @staticmethod
+    def SniffJsonRpcMethod(buf):
+        # This is called for every message, so it needs to be a lot cheaper than the parse it's trying to avoid.
+        # Moonraker always sends notifications starting with the same prefix, depending on which json lib it uses,
+        # so check for those first.
+        isStr = isinstance(buf, str)
+        for prefix in (JsonCodec._c_MethodPrefixesStr if isStr else JsonCodec._c_MethodPrefixesBytes):
+            if buf.startswith(prefix):
+                valueStart = len(prefix)
+                valueEnd = buf.find('"' if isStr else b'"', valueStart, valueStart + 128)
+                if valueEnd == -1:
+                    return None
+                return JsonCodec._ToStr(buf[valueStart:valueEnd])
+        return JsonCodec._SniffJsonRpcMethodSlow(buf, isStr)
+
+
+    # The general case, if the message doesn't start with one of the known prefixes.
+    @staticmethod
+    def _SniffJsonRpcMethodSlow(buf, isStr:bool):
+        if isStr:
+            keyToken = '"method"'
+            quote = '"'
+            openObj = '{'
+            openArray = '['
+        else:
+            keyToken = b'"method"'
+            quote = b'"'
+            openObj = b'{'
+            openArray = b'['
+
+        keyStart = buf.find(keyToken, 0, JsonCodec.c_MethodSniffWindow)
+        if keyStart == -1:
+            return None
+
+        # Make sure the key is in the top level object. The only thing before it should be the opening brace
+        # and other simple top level values like "jsonrpc": "2.0".
+        prefix = buf[:keyStart]
+        if prefix.count(openObj) != 1 or prefix.count(openArray) != 0:
+            return None
+
+        # Find the opening quote of the value, which can be after a colon and any amount of whitespace.
+        valueStart = buf.find(quote, keyStart + len(keyToken), keyStart + len(keyToken) + 8)
+        if valueStart == -1:
+            return None
+        valueStart += 1
+        valueEnd = buf.find(quote, valueStart, valueStart + 128)
+        if valueEnd == -1:
+            return None
+        return JsonCodec._ToStr(buf[valueStart:valueEnd])
+
+
+    @staticmethod
+    def _ToStr(value):
+        if isinstance(value, str):
+            return value
+        try:
+            return value.decode("utf-8")
+        except Exception:
+            return None
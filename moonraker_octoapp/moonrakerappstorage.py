@@ -1,22 +1,64 @@
 from octoapp.sentry import Sentry
 from .moonrakerdatabase import MoonrakerDatabase
 from octoapp.appsstorage import AppInstance, AppStorageHelper
+import threading
+import time
 import uuid
 
 class MoonrakerAppStorage:
 
+    # The apps are registered by the apps themselves, by writing directly to the moonraker database.
+    # Moonraker doesn't tell us when that happens, so once the registry is older than this we reload it.
+    # The reload happens in the background, and the cached registry is used while it runs.
+    c_RegistryRevalidateAfterSec = 60.0
+
+    # If the registry is older than this, like after the printer was idle for a while, it's reloaded before it's used.
+    # Otherwise the first push after an idle time, like the print start, would go to a target list that's hours old.
+    c_RegistryMaxAgeSec = 180.0
+
     def __init__(self, database):
         self.First = False
         self.Database = database
 
+        # The app registry, fcmToken -> AppInstance. None until it's loaded for the first time.
+        # This is kept current by write-through for our own changes, and reloaded from the database periodically.
+        self.RegistryLock = threading.Lock()
+        self.Registry_CanBeNone = None
+        self.RegistryLoadedAt = 0.0
+        self.RegistryReloadRunning = False
+        # Bumped on every write, so a reload that started before a write doesn't bring removed apps back.
+        self.RegistryGeneration = 0
+
 
     # !! Platform Command Handler Interface Function !!
     #
     # This must return a list of AppInstance
     #
     def GetAllApps(self) -> [AppInstance]:
-        apps = self.Database.GetAppsEntry()
-        return list(map(lambda app: AppInstance.FromDict(app), apps))        
+        with self.RegistryLock:
+            registry = self.Registry_CanBeNone
+            age = time.time() - self.RegistryLoadedAt
+            if registry is not None and age <= MoonrakerAppStorage.c_RegistryMaxAgeSec:
+                # If the registry is stale, start a reload, but return what we have now.
+                if age > MoonrakerAppStorage.c_RegistryRevalidateAfterSec and self.RegistryReloadRunning is False:
+                    self.RegistryReloadRunning = True
+                    t = threading.Thread(target=self._ReloadRegistryInBackground)
+                    t.daemon = True
+                    t.start()
+                return list(registry.values())
+
+        # The first load is done inline, since we have nothing to return yet.
+        # If this fails, it will throw, like it did before there was a registry.
+        if registry is None:
+            return list(self._LoadRegistry().values())
+
+        # The registry is too old to use as is, so reload it inline.
+        # If that fails, the old registry is still better than nothing.
+        try:
+            return list(self._LoadRegistry().values())
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to reload the expired app registry, using the old one", e)
+            return list(registry.values())
 
 
     # !! Platform Command Handler Interface Function !!
@@ -25,11 +67,58 @@ class MoonrakerAppStorage:
     #
     def RemoveApps(self, apps:[AppInstance]):
         apps = list(map(lambda app: app.FcmToken, apps))
+        if len(apps) == 0:
+            return
+        # Write-through, update the registry first so no one sees the removed apps anymore.
+        with self.RegistryLock:
+            self.RegistryGeneration += 1
+            if self.Registry_CanBeNone is not None:
+                for fcmToken in apps:
+                    self.Registry_CanBeNone.pop(fcmToken, None)
         self.Database.RemoveAppEntries(apps)
 
+
+    # Marks the registry as stale, so it's reloaded on the next use. Used when the moonraker connection is re-established.
+    def InvalidateRegistry(self):
+        with self.RegistryLock:
+            self.RegistryLoadedAt = 0.0
+
+
     # !! Platform Command Handler Interface Function !!
     #
     # This must receive a lsit of AppInstnace
     #
     def GetOrCreateEncryptionKey(self):
-        return self.Database.GetOrCreateEncryptionKey()
\ No newline at end of file
+        return self.Database.GetOrCreateEncryptionKey()
+
+
+    # Loads the registry from the database and returns it.
+    def _LoadRegistry(self) -> dict:
+        with self.RegistryLock:
+            generation = self.RegistryGeneration
+        apps = self.Database.GetAppsEntry()
+        registry = {}
+        for app in apps:
+            appInstance = AppInstance.FromDict(app)
+            registry[appInstance.FcmToken] = appInstance
+        with self.RegistryLock:
+            # If something was written while we were loading, the result might have removed apps in it.
+            # Don't keep it, the next call will load again.
+            kept = generation == self.RegistryGeneration
+            if kept:
+                self.Registry_CanBeNone = registry
+                self.RegistryLoadedAt = time.time()
+        if kept and AppStorageHelper.Get() is not None:
+            AppStorageHelper.Get().OnAppsUpdated(list(registry.values()))
+        return registry
+
+
+    def _ReloadRegistryInBackground(self):
+        try:
+            Sentry.Debug("APPS", "Reloading app registry")
+            self._LoadRegistry()
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to reload app registry", e)
+        finally:
+            with self.RegistryLock:
+                self.RegistryReloadRunning = False
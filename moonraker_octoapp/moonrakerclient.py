@@ -2,9 +2,10 @@ import os
 import threading
 import time
 import json
-import queue
 import logging
 import math
+import random
+import concurrent.futures
 
 import configparser
 from octoapp.compat import Compat
@@ -14,6 +15,12 @@ from octoapp.websocketimpl import Client
 from octoapp.notificationshandler import NotificationsHandler
 from .moonrakercredentailmanager import MoonrakerCredentialManager
 from .filemetadatacache import FileMetadataCache
+from .printerstatemirror import PrinterStateMirror
+from .printerobjectsubscription import PrinterObjectSubscription
+from .querycoalescer import PrinterObjectsQueryCoalescer
+from .jsoncodec import JsonCodec
+from .notificationdispatcher import NotificationDispatcher
+from .nonresponsemsgqueue import NonResponseMsgQueue
 from .observerconfigfile import ObserverConfigFile
 
 # The response object for a json rpc request.
@@ -58,6 +65,22 @@ class MoonrakerClient:
     # For some reason, some calls seem to take a really long time to complete (like database calls), so we make this timeout quite high.
     RequestTimeoutSec = 60.0
 
+    # Reconnect backoff. After each failed connection the delay doubles, up to the max, with jitter so a lot of clients
+    # don't all hit Moonraker at the same moment. The backoff is reset once a connection makes it to klippy ready.
+    c_ReconnectBackoffMinSec = 0.25
+    c_ReconnectBackoffMaxSec = 30.0
+    # If a connection stays up this long, we also reset the backoff, even if klippy never got ready.
+    c_ReconnectBackoffResetAfterSec = 60.0
+
+    # We get notify_klippy_ready when klippy becomes ready, so polling server.info is only a fallback in case we miss it.
+    c_KlippyReadyFallbackPollSec = 10.0
+
+    # The printer object fields _OnPrintStatusUpdate reads.
+    c_PrintStatusUpdateFields = {
+        "print_stats": ["state"],
+        "virtual_sdcard": ["progress"],
+    }
+
     # Logic for a static singleton
     _Instance = None
 
@@ -87,12 +110,40 @@ class MoonrakerClient:
         self.JsonRpcIdCounter = 0
         self.JsonRpcWaitingContexts = {}
 
+        # The number of notifications we dropped without parsing, since nothing handles them.
+        self.DroppedNotificationCount = 0
+
+        # Routes the non-response messages to the handlers that want them.
+        # Any notification that has no handler is dropped as soon as it's received, before it's parsed.
+        # Moonraker sends a lot of notifications we never use, like notify_proc_stat_update every second.
+        self.NotificationDispatcher = NotificationDispatcher()
+        self.NotificationDispatcher.RegisterMethodHandler("notify_history_changed", self._OnHistoryChanged)
+        self.NotificationDispatcher.RegisterMethodHandler("notify_webcams_changed", self._OnWebcamsChanged)
+        self.NotificationDispatcher.RegisterStatusHandler(["print_stats", "virtual_sdcard"], self._OnPrintStatusUpdate)
+        self.NotificationDispatcher.RegisterStatusHandler(["print_stats", "gcode_move"], self._OnLayerStatusUpdate)
+
+        # Holds the state of the printer objects we are subscribed to, fed by notify_status_update.
+        self.PrinterStateMirror = PrinterStateMirror()
+
+        # Any printer.objects.query that can't be served by the mirror goes through the coalescer, so queries
+        # that happen at the same time share one RPC.
+        self.QueryCoalescer = PrinterObjectsQueryCoalescer(lambda objectsDict: self.SendJsonRpcRequest("printer.objects.query", { "objects": objectsDict }), JsonRpcResponse)
+
         # Setup the Moonraker compat helper object.
         self.MoonrakerCompat = MoonrakerCompat(printerId)
 
+        # We only subscribe to the printer object fields someone reads, so Moonraker doesn't push the ones we don't use.
+        # The interface functions read from the state mirror, which is fed by the subscription, so their fields are registered as well.
+        self.PrinterObjectSubscriptionLock = threading.Lock()
+        self.PrinterObjectSubscription = PrinterObjectSubscription()
+        self.PrinterObjectSubscription.Register("PrintStatusUpdate", MoonrakerClient.c_PrintStatusUpdateFields)
+        self.PrinterObjectSubscription.Register("MoonrakerCompat", MoonrakerCompat.c_PrinterObjectFields)
+        self.PrinterObjectSubscription.SetOnChangedCallback(self._OnPrinterObjectSubscriptionChanged)
+
         # Setup the non response message thread
         # See _NonResponseMsgQueueWorker to why this is needed.
-        self.NonResponseMsgQueue = queue.Queue(20000)
+        # The queue is bounded and merges status updates that are waiting, so a slow handler doesn't replay old state.
+        self.NonResponseMsgQueue = NonResponseMsgQueue()
         self.NonResponseMsgThread = threading.Thread(target=self._NonResponseMsgQueueWorker)
         self.NonResponseMsgThread.start()
 
@@ -107,6 +158,16 @@ class MoonrakerClient:
         self.WebSocketKlippyReady = False
         self.WebSocketLock = threading.Lock()
 
+        # Set when notify_klippy_ready is received. A new event is made for each websocket connection.
+        self.KlippyReadyEvent = threading.Event()
+
+        # Used to track how long it takes to get from a lost (or new) connection back to ready.
+        self.ReconnectAttempt = 0
+        self.ConnectionLostAt = time.time()
+        self.WebSocketOpenedAt = None
+        self.LastTimeToReadySec = None
+        self.LastTimeFromOpenToReadySec = None
+
 
     def GetNotificationHandler(self) -> NotificationsHandler:
         return self.MoonrakerCompat.GetNotificationHandler()
@@ -196,6 +257,22 @@ class MoonrakerClient:
     # https://moonraker.readthedocs.io/en/latest/web_api/#websocket-setup
     #
     def SendJsonRpcRequest(self, method:str, paramsDict = None) -> JsonRpcResponse:
+        return self.WaitForJsonRpcResponse(self.SendJsonRpcRequestAsync(method, paramsDict))
+
+
+    # Sends an agent event, which moonraker passes on to all connected clients as notify_agent_event.
+    # This doesn't wait for the response, so it's fine to call from the shared scheduler threads.
+    # https://moonraker.readthedocs.io/en/latest/web_api/#send-an-agent-event
+    def SendAgentEvent(self, event:str, data:dict) -> None:
+        self.SendJsonRpcRequestAsync("connection.send_event", {"event": event, "data": data})
+
+
+    # Sends a rpc request via the connected websocket, but doesn't wait for the response.
+    # Returns a JsonRpcFuture, which will always be resolved with a JsonRpcResponse, even on errors and timeouts.
+    # Any number of requests can be in flight at once, so callers that need a few independent values can send them all
+    # and then wait once. Use WaitForJsonRpcResponse or WaitForJsonRpcResponses to get the results.
+    # This will not throw.
+    def SendJsonRpcRequestAsync(self, method:str, paramsDict = None) -> "JsonRpcFuture":
         msgId = 0
         waitContext = None
         with self.JsonRpcIdLock:
@@ -204,10 +281,13 @@ class MoonrakerClient:
             self.JsonRpcIdCounter += 1
 
             # Add our waiting context.
-            waitContext = JsonRpcWaitingContext(msgId)
+            waitContext = JsonRpcWaitingContext(msgId, method, time.time() + MoonrakerClient.RequestTimeoutSec)
             self.JsonRpcWaitingContexts[msgId] = waitContext
 
-        # From now on, we need to always make sure to clean up the wait context, even in error.
+            # Since not every future is waited on, use this chance to time out any requests that have been waiting too long.
+            self._ExpireTimedOutJsonRpcRequestsUnderLock()
+
+        # From now on, we need to always make sure the context is resolved, even in error.
         try:
             # Create the request object
             obj = {
@@ -219,50 +299,77 @@ class MoonrakerClient:
             if paramsDict is not None:
                 obj["params"] = paramsDict
 
-            # Try to send. default=str makes the json dump use the str function if it fails to serialize something.
-            jsonStr = json.dumps(obj, default=str)
+            # Try to send. The codec uses the str function if it fails to serialize something.
+            jsonStr = JsonCodec.Dumps(obj)
             Sentry.Debug("Client", "Moonraker RPC Request - "+str(msgId)+" : "+method+" "+jsonStr)
             if self._WebSocketSend(jsonStr) is False:
                 Sentry.Info("Client", "Moonraker client failed to send JsonRPC request "+method)
-                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED)
-
-            # Wait for a response
-            waitContext.GetEvent().wait(MoonrakerClient.RequestTimeoutSec)
-
-            # Check if we got a result.
-            result = waitContext.GetResult()
-            if result is None:
-                Sentry.Info("Client", "Moonraker client timeout while waiting for request. "+str(id)+" "+method)
-                return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT)
-
-            # Check for an error if found, return the error state.
-            if "error" in result:
-                # Get the error parts
-                errorCode = JsonRpcResponse.OE_ERROR_EXCEPTION
-                errorStr = "Unknown"
-                if "code" in result["error"]:
-                    errorCode = result["error"]["code"]
-                if "message" in result["error"]:
-                    errorStr = result["error"]["message"]
-                return JsonRpcResponse(None, errorCode, errorStr)
-
-            # If there's a result, return the entire response
-            if "result" in result:
-                return JsonRpcResponse(result["result"])
-
-            # Finally, both are missing?
-            Sentry.Error("Client", "Moonraker client json rpc got a response that didn't have an error or result object? "+json.dumps(result))
-            return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, "No result or error object")
+                self._CompleteJsonRpcRequest(msgId, JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_WS_NOT_CONNECTED))
 
         except Exception as e:
             Sentry.Exception("Moonraker client json rpc request failed to send.", e)
+            self._CompleteJsonRpcRequest(msgId, JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e)))
+
+        return waitContext.GetFuture()
+
+
+    # Waits for a future returned by SendJsonRpcRequestAsync and returns the JsonRpcResponse.
+    # If the response doesn't come back before the request's timeout, this returns a timeout error.
+    # This will not throw.
+    def WaitForJsonRpcResponse(self, future:"JsonRpcFuture") -> JsonRpcResponse:
+        try:
+            return future.result(max(0.0, future.TimeoutAt - time.time()))
+        except concurrent.futures.TimeoutError:
+            # We didn't get a response in time, resolve the request as timed out.
+            # If the response came in just now, the completion is a no-op and we return the real response.
+            self._CompleteJsonRpcRequest(future.Id, JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT))
+            return future.result()
+        except Exception as e:
+            Sentry.Exception("Moonraker client json rpc wait failed.", e)
             return JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, str(e))
 
-        finally:
-            # Before leaving, always clean up any waiting contexts.
-            with self.JsonRpcIdLock:
-                if msgId in self.JsonRpcWaitingContexts:
-                    del self.JsonRpcWaitingContexts[msgId]
+
+    # Waits for all of the given futures and returns a list of the JsonRpcResponses, in the same order.
+    # Since all of the requests are already in flight, this takes as long as the slowest request, not the sum of them.
+    def WaitForJsonRpcResponses(self, futures) -> list:
+        return [self.WaitForJsonRpcResponse(f) for f in futures]
+
+
+    # Resolves the waiting context for the given id with the response, if it's still waiting.
+    # Only the first call for an id has any effect.
+    def _CompleteJsonRpcRequest(self, msgId:int, response:JsonRpcResponse) -> None:
+        with self.JsonRpcIdLock:
+            waitContext = self.JsonRpcWaitingContexts.pop(msgId, None)
+        if waitContext is not None:
+            waitContext.SetResponse(response)
+
+
+    # Must be called under the JsonRpcIdLock. Resolves any request that's past its timeout.
+    def _ExpireTimedOutJsonRpcRequestsUnderLock(self) -> None:
+        now = time.time()
+        expired = [c for c in self.JsonRpcWaitingContexts.values() if c.TimeoutAt < now]
+        for c in expired:
+            del self.JsonRpcWaitingContexts[c.Id]
+            c.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT))
+
+
+    # Returns the current state of the given printer objects, in the same format as a printer.objects.query result.
+    # If the printer state mirror holds all of the requested objects, the result comes from memory. Otherwise
+    # this falls back to doing the query, which is coalesced with any other queries made at the same time.
+    # This will not throw, it will always return a JsonRpcResponse which can be checked for errors or success.
+    def QueryPrinterObjects(self, objectsDict:dict) -> JsonRpcResponse:
+        status = self.PrinterStateMirror.TryGetStatus(objectsDict)
+        if status is not None:
+            return JsonRpcResponse({"eventtime": self.PrinterStateMirror.GetEventTime(), "status": status})
+        return self.QueryCoalescer.Query(objectsDict)
+
+
+    # Returns the counters of the printer object query paths, so we can see how many RPCs the mirror and coalescer saved.
+    def GetPrinterObjectQueryStats(self) -> dict:
+        return {
+            "StateMirror": self.PrinterStateMirror.GetStats(),
+            "QueryCoalescer": self.QueryCoalescer.GetStats(),
+        }
 
 
     # Sends a string to the connected websocket.
@@ -292,36 +399,87 @@ class MoonrakerClient:
         return True
 
 
+    # Registers the printer object fields a consumer reads, in the printer.objects.subscribe "objects" format.
+    # If this changes what we are subscribed to, we re-subscribe.
+    def RegisterPrinterObjectFields(self, consumerName:str, objectFields:dict) -> None:
+        self.PrinterObjectSubscription.Register(consumerName, objectFields)
+
+
+    # Sends printer.objects.subscribe with the fields our consumers registered, and seeds the state mirror with the result.
+    # Returns False on failure.
+    def _SubscribeToPrinterObjects(self) -> bool:
+        # https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
+        # https://moonraker.readthedocs.io/en/latest/printer_objects/
+        #
+        # A subscribe replaces the last one, so this is locked to make sure the mirror is seeded from the last subscribe sent.
+        #
+        # The subscribe result contains the current state of the objects, which we use to seed the printer state mirror.
+        # From then on the mirror is kept up to date by the status updates, so the objects can be read without a query.
+        with self.PrinterObjectSubscriptionLock:
+            subscribeObjects = self.PrinterObjectSubscription.BuildSubscribeObjects()
+            self.PrinterStateMirror.BeginSync()
+            result = self.SendJsonRpcRequest("printer.objects.subscribe",
+            {
+                "objects": subscribeObjects
+            })
+
+            # Verify success.
+            if result.HasError():
+                Sentry.Error("Client", "Failed to setup moonraker notification subs. "+result.GetLoggingErrorStr())
+                self.PrinterStateMirror.Invalidate()
+                return False
+
+            # Seed the state mirror.
+            resultObj = result.GetResult()
+            if resultObj is not None and "status" in resultObj:
+                self.PrinterStateMirror.Seed(resultObj["status"], resultObj.get("eventtime", None), subscribeObjects)
+            else:
+                Sentry.Warn("Client", "Moonraker subscribe result had no status object, the printer state mirror will not be used.")
+                self.PrinterStateMirror.Invalidate()
+            return True
+
+
+    # Called when a consumer changes the fields it reads.
+    def _OnPrinterObjectSubscriptionChanged(self):
+        with self.WebSocketLock:
+            if self.WebSocketKlippyReady is False:
+                # We will subscribe with the new fields when the connection is ready.
+                return
+        t = threading.Thread(target=self._ResubscribeToPrinterObjects)
+        t.daemon = True
+        t.start()
+
+
+    def _ResubscribeToPrinterObjects(self):
+        Sentry.Info("Client", "Printer object subscription changed, re-subscribing.")
+        if self._SubscribeToPrinterObjects() is False:
+            self._RestartWebsocket()
+
+
     # Called when a new websocket is connected and klippy is ready.
     # At this point, we should setup anything we need to do and sync any state required.
     # This is called on a background thread, so we can block this.
     def _OnWsOpenAndKlippyReady(self):
         Sentry.Info("Client", "Moonraker client setting up default notification hooks")
-        # First, we need to setup our notification subs
-        # https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
-        # https://moonraker.readthedocs.io/en/latest/printer_objects/
-        #result = self.SendJsonRpcRequest("printer.objects.list")
-        result = self.SendJsonRpcRequest("printer.objects.subscribe",
-        {
-            "objects":
-            {
-                # Using None allows us to get all of the data from the notification types.
-                # For some types, using None has way too many updates, so we filter them down.
-                "print_stats": { "state", "filename", "message" },
-                "webhooks": None,
-                "virtual_sdcard": None,
-                "history" : None,
-            }
-        })
+        # The state sync also needs the printer name, so we send those requests first, and they are in flight while we subscribe.
+        # That way the whole re-sync is one round trip, since the print state comes from the subscribe result.
+        printerNameFutures = self.MoonrakerDatabase.GetPrinterNameAsync()
 
-        # Verify success.
-        if result.HasError():
-            Sentry.Error("Client", "Failed to setup moonraker notification subs. "+result.GetLoggingErrorStr())
+        # Setup our notification subs
+        if self._SubscribeToPrinterObjects() is False:
             self._RestartWebsocket()
             return
 
         # Call the event handler
-        self.MoonrakerCompat.OnMoonrakerClientConnected()
+        self.MoonrakerCompat.OnMoonrakerClientConnected(printerNameFutures)
+
+        # Report how long it took to get back to ready.
+        nowSec = time.time()
+        self.LastTimeToReadySec = nowSec - self.ConnectionLostAt
+        openedAt = self.WebSocketOpenedAt
+        if openedAt is not None:
+            self.LastTimeFromOpenToReadySec = nowSec - openedAt
+        Sentry.Info("Client", f"Moonraker connection ready and synced {round(self.LastTimeToReadySec, 2)}s after the connection was lost, {round(self.LastTimeFromOpenToReadySec or 0, 2)}s after the websocket opened.")
 
         # Finally, tell the host that we are connected and ready.
         self.ConnectionStatusHandler.OnMoonrakerClientConnected()
@@ -329,105 +487,102 @@ class MoonrakerClient:
 
     # Called when the websocket gets any other message that's not a RPC response.
     # If we throw from here, the websocket will close and restart.
-    def _OnWsNonResponseMessage(self, msg:str):
-        # Get the common method string
-        if "method" not in msg:
-            Sentry.Warn("Client", "Moonraker WS message received with no method "+json.dumps(msg))
-            return
-        method = msg["method"].lower()
-
-        # These objects can come in all shapes and sizes. So we only look for exactly what we need, if we don't find it
-        # We ignore the object, someone else might match it.
-
-        # Used to watch for print starts, ends, and failures.
-        if method == "notify_history_changed":
-            actionContainerObj = self._GetWsMsgParam(msg, "action")
-            if actionContainerObj is not None:
-                action = actionContainerObj["action"]
-                if action == "added":
-                    jobContainerObj = self._GetWsMsgParam(msg, "job")
-                    if jobContainerObj is not None:
-                        jobObj = jobContainerObj["job"]
-                        if "filename" in jobObj:
-                            fileName = jobObj["filename"]
-                            self.MoonrakerCompat.OnPrintStart(fileName)
-                            return
-                elif action == "finished":
-                    # This can be a finish canceled or failed.
-                    # Oddly, this doesn't fire for print complete.
-                    #
-                    # We need to be able to find filename, total_duration, and status.
-                    jobContainerObj = self._GetWsMsgParam(msg, "job")
-                    if jobContainerObj is not None:
-                        jobObj = jobContainerObj["job"]
-                        if "filename" in jobObj:
-                            fileName = jobObj["filename"]
-                            if "total_duration" in jobObj:
-                                totalDurationSecFloat = jobObj["total_duration"]
-                                if "status" in jobObj:
-                                    status = jobObj["status"]
-                                    # We have everything we need
-                                    if status == "cancelled":
-                                        self.MoonrakerCompat.OnFailedOrCancelled(fileName, totalDurationSecFloat)
-                                        return
-
-        if method == "notify_status_update":
-            # This is shared by a few things, so get it once.
-            progressFloat_CanBeNone = self._GetProgressFromMsg(msg)
-
-            # Check for a state container
-            stateContainerObj = self._GetWsMsgParam(msg, "print_stats")
-            if stateContainerObj is not None:
-                ps = stateContainerObj["print_stats"]
-                if "state" in ps:
-                    state = ps["state"]
-                    # Check for pause
-                    if state == "paused":
-                        self.MoonrakerCompat.OnPrintPaused()
-                        return
-                    # Resume is hard, because it's hard to tell the difference between printing we get from the starting message
-                    # and printing we get from a resume. So the way we do it is by looking at the progress, to see if it's just starting or not.
-                    # 0.01 == 1%, so if the print is resumed before then, this won't fire. For small prints, we need to have a high threshold,
-                    # so they don't trigger something too much lower too easily.
-                    elif state == "printing":
-                        if progressFloat_CanBeNone is None or progressFloat_CanBeNone > 0.01:
-                            self.MoonrakerCompat.OnPrintResumed()
-                            return
-                    elif state == "complete":
-                        self.MoonrakerCompat.OnDone()
-                        return
+    def _OnWsNonResponseMessage(self, msg:dict):
+        self.NotificationDispatcher.Dispatch(msg)
 
-            # Report progress. Do this after the others so they will report before a potential progress update.
-            # Progress updates super frequently (like once a second) so there's plenty of chances.
-            if progressFloat_CanBeNone is not None:
-                self.MoonrakerCompat.OnPrintProgress(progressFloat_CanBeNone)
 
-        # When the webcams change, kick the webcam helper.
-        if method == "notify_webcams_changed":
-            self.ConnectionStatusHandler.OnWebcamSettingsChanged()
+    # Returns the per method dispatch time stats.
+    def GetNotificationDispatchStats(self) -> dict:
+        return self.NotificationDispatcher.GetStats()
 
 
-    # If the message has a progress contained in the virtual_sdcard, this returns it. The progress is a float from 0.0->1.0
-    # Otherwise None
-    def _GetProgressFromMsg(self, msg):
-        vsdContainerObj = self._GetWsMsgParam(msg, "virtual_sdcard")
-        if vsdContainerObj is not None:
-            vsd = vsdContainerObj["virtual_sdcard"]
-            if "progress" in vsd:
-                return vsd["progress"]
-        return None
+    # Returns the non-response message queue metrics, like the high-water mark, merge counts and queue latency.
+    def GetNonResponseMsgQueueStats(self) -> dict:
+        return self.NonResponseMsgQueue.GetStats()
 
 
-    # Given a property name, returns the correct param object that contains that object.
-    def _GetWsMsgParam(self, msg, paramName):
-        if "params" not in msg:
-            return None
-        paramArray = msg["params"]
-        for p in paramArray:
-            # Only test things that are dicts.
-            if isinstance(p, dict) and paramName in p:
-                return p
-        return None
+    # These objects can come in all shapes and sizes. So we only look for exactly what we need, if we don't find it
+    # We ignore the object, someone else might match it.
+
+    # Used to watch for print starts, ends, and failures.
+    def _OnHistoryChanged(self, params:dict):
+        action = params.get("action", None)
+        jobObj = params.get("job", None)
+        if action is None or jobObj is None:
+            return
+        if action == "added":
+            if "filename" in jobObj:
+                fileName = jobObj["filename"]
+                # Start getting the file metadata now, so it's ready by the time the print start logic needs it.
+                FileMetadataCache.Get().Prefetch(fileName)
+                self.MoonrakerCompat.OnPrintStart(fileName)
+        elif action == "finished":
+            # This can be a finish canceled or failed.
+            # Oddly, this doesn't fire for print complete.
+            #
+            # We need to be able to find filename, total_duration, and status.
+            if "filename" in jobObj and "total_duration" in jobObj and "status" in jobObj:
+                fileName = jobObj["filename"]
+                totalDurationSecFloat = jobObj["total_duration"]
+                status = jobObj["status"]
+                # We have everything we need
+                if status == "cancelled":
+                    self.MoonrakerCompat.OnFailedOrCancelled(fileName, totalDurationSecFloat)
+
+
+    # Called for status updates that contain print_stats or virtual_sdcard.
+    def _OnPrintStatusUpdate(self, status:dict, eventTime):
+        # This is shared by a few things, so get it once.
+        # The progress is a float from 0.0->1.0
+        progressFloat_CanBeNone = None
+        vsd = status.get("virtual_sdcard", None)
+        if vsd is not None and "progress" in vsd:
+            progressFloat_CanBeNone = vsd["progress"]
+
+        # Check for a state change
+        ps = status.get("print_stats", None)
+        if ps is not None and "state" in ps:
+            state = ps["state"]
+            # Check for pause
+            if state == "paused":
+                self.MoonrakerCompat.OnPrintPaused()
+                return
+            # Resume is hard, because it's hard to tell the difference between printing we get from the starting message
+            # and printing we get from a resume. So the way we do it is by looking at the progress, to see if it's just starting or not.
+            # 0.01 == 1%, so if the print is resumed before then, this won't fire. For small prints, we need to have a high threshold,
+            # so they don't trigger something too much lower too easily.
+            elif state == "printing":
+                if progressFloat_CanBeNone is None or progressFloat_CanBeNone > 0.01:
+                    self.MoonrakerCompat.OnPrintResumed()
+                    return
+            elif state == "complete":
+                self.MoonrakerCompat.OnDone()
+                return
+
+        # Report progress. Do this after the others so they will report before a potential progress update.
+        # Progress updates super frequently (like once a second) so there's plenty of chances.
+        if progressFloat_CanBeNone is not None:
+            self.MoonrakerCompat.OnPrintProgress(progressFloat_CanBeNone)
+
+
+    # Called for status updates that contain print_stats or gcode_move. The current layer comes from print_stats.info, or
+    # is computed from the gcode_move position, so if either changed we tell the notification handler.
+    # The values come from the state mirror, which already has this update applied.
+    def _OnLayerStatusUpdate(self, status:dict, eventTime):
+        notificationHandler = self.MoonrakerCompat.GetNotificationHandler()
+        if notificationHandler.IsLayerTrackingActive() is False:
+            return
+        ps = status.get("print_stats", None)
+        gm = status.get("gcode_move", None)
+        if (ps is None or "info" not in ps) and (gm is None or "gcode_position" not in gm):
+            return
+        currentLayer, totalLayers = self.MoonrakerCompat.GetCurrentLayerInfo()
+        notificationHandler.OnCurrentLayerChanged(currentLayer, totalLayers)
+
+
+    # When the webcams change, kick the webcam helper.
+    def _OnWebcamsChanged(self, params:dict):
+        self.ConnectionStatusHandler.OnWebcamSettingsChanged()
 
 
     def RunBlocking(self):
@@ -457,27 +612,59 @@ class MoonrakerClient:
             except Exception as e:
                 Sentry.Exception("Moonraker client exception in main WS loop.", e)
 
-            # Inform that we lost the connection.
-            Sentry.Info("Client", "Moonraker client websocket connection lost. We will try to restart it soon.")
-
             # Set that the websocket is disconnected.
+            # Remember if this connection was healthy, so we know if we should reset the backoff.
             with self.WebSocketLock:
+                wasHealthy = self.WebSocketKlippyReady or (self.WebSocketOpenedAt is not None and time.time() - self.WebSocketOpenedAt > MoonrakerClient.c_ReconnectBackoffResetAfterSec)
                 self.WebSocketConnected = False
                 self.WebSocketKlippyReady = False
+                self.WebSocketOpenedAt = None
+                self.ConnectionLostAt = time.time()
+                # Wake up the klippy ready waiter, if there is one, so it sees the websocket is gone.
+                self.KlippyReadyEvent.set()
+
+            # We can't know what changed while we were disconnected, so the mirror is stale until we subscribe again.
+            self.PrinterStateMirror.Invalidate()
 
             # When the websocket closes, we need to clear out all pending waiting contexts.
+            # These will never get a response, so they are resolved as timed out.
             with self.JsonRpcIdLock:
-                for context in self.JsonRpcWaitingContexts.values():
-                    context.SetSocketClosed()
+                contexts = list(self.JsonRpcWaitingContexts.values())
+                self.JsonRpcWaitingContexts.clear()
+            for context in contexts:
+                context.SetSocketClosed()
 
             # This will only happen if the websocket closes or there was an error.
-            # Sleep for a bit so we don't spam the system with attempts.
-            time.sleep(2.0)
+            # Sleep for a bit so we don't spam the system with attempts. If the last connection was healthy we reconnect
+            # right away, since this is most likely a restart, otherwise we back off.
+            if wasHealthy:
+                self.ReconnectAttempt = 0
+            delaySec = self._GetReconnectDelaySec(self.ReconnectAttempt)
+            self.ReconnectAttempt += 1
+            Sentry.Info("Client", f"Moonraker client websocket connection lost. We will try to restart it in {round(delaySec, 2)}s.")
+            time.sleep(delaySec)
+
+
+    # Returns the delay before the next connection attempt, exponential with jitter.
+    # Half of the delay is fixed and the other half is random, so we never retry instantly, but clients still spread out.
+    def _GetReconnectDelaySec(self, attempt:int) -> float:
+        baseSec = min(MoonrakerClient.c_ReconnectBackoffMaxSec, MoonrakerClient.c_ReconnectBackoffMinSec * (2 ** min(attempt, 16)))
+        return (baseSec / 2.0) + random.uniform(0, baseSec / 2.0)
+
+
+    # Returns how long it took the last connection to get to ready.
+    def GetConnectionStats(self) -> dict:
+        return {
+            "ReconnectAttempt": self.ReconnectAttempt,
+            "LastTimeToReadySec": self.LastTimeToReadySec,
+            "LastTimeFromOpenToReadySec": self.LastTimeFromOpenToReadySec,
+        }
 
 
     # Based on the docs: https://moonraker.readthedocs.io/en/latest/web_api/#websocket-setup
     # After the websocket is open, we need to do this sequence to make sure the system is healthy and ready.
-    def _AfterOpenReadyWaiter(self, targetWsObjRef):
+    # klippyReadyEvent is set when notify_klippy_ready is received on this websocket connection.
+    def _AfterOpenReadyWaiter(self, targetWsObjRef, klippyReadyEvent:threading.Event):
 
         logCounter = 0
         Sentry.Info("Client", "Moonraker client waiting for klippy ready...")
@@ -558,11 +745,13 @@ class MoonrakerClient:
 
                 if state == "startup" or state == "error" or state == "shutdown" or state == "initializing":
                     logCounter += 1
-                    # 2 seconds * 150 = one log every 5 minutes. We don't want to log a ton if the printer is offline for a long time.
-                    if logCounter % 150 == 1:
+                    # 10 seconds * 30 = one log every 5 minutes. We don't want to log a ton if the printer is offline for a long time.
+                    if logCounter % 30 == 1:
                         Sentry.Info("Client", "Moonraker client got klippy state '"+state+"', waiting for ready...")
-                    # We need to wait until ready. The doc suggest we wait 2 seconds.
-                    time.sleep(2.0)
+                    # We need to wait until ready. Moonraker sends notify_klippy_ready when it is, so we wait for that
+                    # and only poll again as a fallback, in case we miss it.
+                    klippyReadyEvent.wait(MoonrakerClient.c_KlippyReadyFallbackPollSec)
+                    klippyReadyEvent.clear()
                     continue
 
                 # Unknown state
@@ -592,17 +781,28 @@ class MoonrakerClient:
         # Set that the websocket is open.
         with self.WebSocketLock:
             self.WebSocketConnected = True
+            self.WebSocketOpenedAt = time.time()
+            self.KlippyReadyEvent = threading.Event()
+            klippyReadyEvent = self.KlippyReadyEvent
 
         # According to the docs, there's a startup sequence we need to before sending requests.
         # We use a new thread to do the startup sequence, since we can't block this or we won't get messages.
-        t = threading.Thread(target=self._AfterOpenReadyWaiter, args=(ws,))
+        t = threading.Thread(target=self._AfterOpenReadyWaiter, args=(ws, klippyReadyEvent))
         t.start()
 
 
     def _onWsMsg(self, ws, msgBytes: bytes):
         try:
+            # Before we do the full parse, try to sniff the method from the raw message.
+            # If it's a notification nothing handles, drop it now. This also drops the really chatty moonraker_stats
+            # messages, which are sent in notify_proc_stat_update.
+            sniffedMethod_CanBeNone = JsonCodec.SniffJsonRpcMethod(msgBytes)
+            if sniffedMethod_CanBeNone is not None and self.NotificationDispatcher.IsHandled(sniffedMethod_CanBeNone) is False:
+                self.DroppedNotificationCount += 1
+                return
+
             # Parse the incoming message.
-            msgObj = json.loads(msgBytes)
+            msgObj = JsonCodec.Loads(msgBytes)
 
             # Get the method if there is one.
             method_CanBeNone = None
@@ -611,22 +811,27 @@ class MoonrakerClient:
 
             # Print for debugging
             if Sentry.Logger.isEnabledFor(logging.DEBUG):
-                # Exclude this really chatty message.
-                msgStr = msgBytes.decode(encoding="utf-8")
-                if "moonraker_stats" not in msgStr:
-                    Sentry.Debug("Client WS", "<- %s" % msgStr)
+                msgStr = msgBytes if isinstance(msgBytes, str) else msgBytes.decode(encoding="utf-8")
+                Sentry.Debug("Client WS", "<- %s" % msgStr)
 
             # Check if this is a response to a request
             # info: https://moonraker.readthedocs.io/en/latest/web_api/#json-rpc-api-overview
             if "id" in msgObj:
+                idInt = int(msgObj["id"])
                 with self.JsonRpcIdLock:
-                    idInt = int(msgObj["id"])
-                    if idInt in self.JsonRpcWaitingContexts:
-                        self.JsonRpcWaitingContexts[idInt].SetResultAndEvent(msgObj)
-                    else:
-                        Sentry.Warn("Client", "Moonraker RPC response received for request "+str(idInt) + ", but there is no waiting context.")
-                    # If once the response is handled, we are done.
-                    return
+                    waitContext = self.JsonRpcWaitingContexts.pop(idInt, None)
+                if waitContext is not None:
+                    waitContext.SetResultMsg(msgObj)
+                else:
+                    Sentry.Warn("Client", "Moonraker RPC response received for request "+str(idInt) + ", but there is no waiting context.")
+                # If once the response is handled, we are done.
+                return
+
+            # Klippy is ready, wake up the klippy ready waiter if it's waiting.
+            if method_CanBeNone == "notify_klippy_ready":
+                Sentry.Info("Client", "Moonraker client received notify_klippy_ready.")
+                self.KlippyReadyEvent.set()
+                return
 
             # Check for a special message that indicates the klippy connection has been lost.
             # According to the docs, in this case, we should restart the klippy ready process, so we will
@@ -635,16 +840,22 @@ class MoonrakerClient:
             # it seems to use notify_klippy_disconnected. We handle them both as the same.
             if method_CanBeNone is not None and (method_CanBeNone == "notify_klippy_disconnected" or method_CanBeNone == "notify_klippy_shutdown"):
                 Sentry.Info("Client", "Moonraker client received %s notification, so we will restart our client connection." % method_CanBeNone)
+                self.PrinterStateMirror.Invalidate()
                 self._RestartWebsocket()
                 self.MoonrakerCompat.KlippyDisconnectedOrShutdown()
                 return
 
+            # Status updates are applied to the state mirror here, on the receive thread, so the mirror is always in order
+            # with the RPC responses we hand out. This is just a dict merge, so it's fast.
+            if method_CanBeNone == "notify_status_update":
+                self._ApplyStatusUpdateToMirror(msgObj)
+
             # We use a queue to handle all non reply messages to prevent this thread from getting blocked.
             # The problem is if any of the code paths upstream from the non reply notification tried to issue a request/response
             # they would never get it, because this receive thread would be blocked.
             #
-            # If this queue is full, it will throw, but it has a huge capacity, so that would be bad.
-            self.NonResponseMsgQueue.put_nowait(msgObj)
+            # The queue never blocks, if it's full status updates are merged and anything else goes over the limit.
+            self.NonResponseMsgQueue.Put(msgObj)
 
         except Exception as e:
             Sentry.Exception("Exception while handing moonraker client websocket message.", e)
@@ -652,11 +863,27 @@ class MoonrakerClient:
             raise e
 
 
+    # Given a notify_status_update message, this applies the status delta to the printer state mirror.
+    # The params are [statusDict, eventtime]
+    def _ApplyStatusUpdateToMirror(self, msg) -> None:
+        if "params" not in msg:
+            return
+        statusDict = None
+        eventTime = None
+        for p in msg["params"]:
+            if isinstance(p, dict):
+                statusDict = p
+            elif isinstance(p, (float, int)):
+                eventTime = p
+        if statusDict is not None:
+            self.PrinterStateMirror.ApplyStatusUpdate(statusDict, eventTime)
+
+
     def _NonResponseMsgQueueWorker(self):
         try:
             while True:
                 # Wait for a message to process.
-                msg = self.NonResponseMsgQueue.get()
+                msg = self.NonResponseMsgQueue.Get()
                 # Process and then wait again.
                 self._OnWsNonResponseMessage(msg)
         except Exception as e:
@@ -674,37 +901,78 @@ class MoonrakerClient:
         Sentry.Exception("Exception rased from moonraker client websocket connection. The connection will be closed.", exception)
 
 
-# A helper class used for waiting rpc requests
-class JsonRpcWaitingContext:
+# The future returned by SendJsonRpcRequestAsync. It's always resolved with a JsonRpcResponse.
+class JsonRpcFuture(concurrent.futures.Future):
 
-    def __init__(self, msgId) -> None:
+    def __init__(self, msgId:int, method:str, timeoutAt:float) -> None:
+        super().__init__()
         self.Id = msgId
-        self.WaitEvent = threading.Event()
-        self.Result = None
-
+        self.Method = method
+        self.TimeoutAt = timeoutAt
 
-    def GetEvent(self):
-        return self.WaitEvent
 
+# A helper class used for waiting rpc requests
+class JsonRpcWaitingContext:
 
-    def GetResult(self):
-        return self.Result
+    def __init__(self, msgId:int, method:str, timeoutAt:float) -> None:
+        self.Id = msgId
+        self.Method = method
+        self.TimeoutAt = timeoutAt
+        self.Future = JsonRpcFuture(msgId, method, timeoutAt)
+
+
+    def GetFuture(self) -> JsonRpcFuture:
+        return self.Future
+
+
+    # Sets the final response, this can only be called once per context.
+    def SetResponse(self, response:JsonRpcResponse):
+        if response.GetErrorCode() == JsonRpcResponse.OE_ERROR_TIMEOUT:
+            Sentry.Info("Client", "Moonraker client timeout while waiting for request. "+str(self.Id)+" "+self.Method)
+        self.Future.set_result(response)
+
+
+    # Parses the raw json rpc response message and sets the response.
+    def SetResultMsg(self, msgObj):
+        # Check for an error if found, return the error state.
+        if "error" in msgObj:
+            # Get the error parts
+            errorCode = JsonRpcResponse.OE_ERROR_EXCEPTION
+            errorStr = "Unknown"
+            if "code" in msgObj["error"]:
+                errorCode = msgObj["error"]["code"]
+            if "message" in msgObj["error"]:
+                errorStr = msgObj["error"]["message"]
+            self.SetResponse(JsonRpcResponse(None, errorCode, errorStr))
+            return
 
+        # If there's a result, return the entire response
+        if "result" in msgObj:
+            self.SetResponse(JsonRpcResponse(msgObj["result"]))
+            return
 
-    def SetResultAndEvent(self, result):
-        self.Result = result
-        self.WaitEvent.set()
+        # Finally, both are missing?
+        Sentry.Error("Client", "Moonraker client json rpc got a response that didn't have an error or result object? "+json.dumps(msgObj))
+        self.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_EXCEPTION, "No result or error object"))
 
 
     def SetSocketClosed(self):
-        self.Result = None
-        self.WaitEvent.set()
+        self.SetResponse(JsonRpcResponse(None, JsonRpcResponse.OE_ERROR_TIMEOUT))
 
 
 # The goal of this class it add any needed compatibility logic to allow the moonraker system plugin into the
 # common OctoApp logic.
 class MoonrakerCompat:
 
+    # The printer object fields the interface functions below read.
+    # If any of them need a new field, it must be added here, otherwise the query will miss the state mirror.
+    c_PrinterObjectFields = {
+        "print_stats": ["state", "filename", "print_duration", "total_duration", "filament_used", "info"],
+        "virtual_sdcard": ["progress"],
+        "gcode_move": ["speed_factor", "gcode_position"],
+        "toolhead": ["position"],
+    }
+
     def __init__(self, printerId:str) -> None:
 
         # This indicates if we are ready to process notifications, so we don't
@@ -748,12 +1016,13 @@ class MoonrakerCompat:
 
 
     # Called when a new websocket is established to moonraker.
-    def OnMoonrakerClientConnected(self):
+    # If the printer name requests were already sent, the futures are passed so we don't need another round trip.
+    def OnMoonrakerClientConnected(self, printerNameFutures = None):
 
         # This is the hardest of all the calls. The reason being, this call can happen if our service or moonraker restarted, an print
         # can be running while either of those restart. So we need to sync the state here, and make sure things like Gadget and the
         # notification system having their progress threads running correctly.
-        self._InitPrintStateForFreshConnect()
+        self._InitPrintStateForFreshConnect(printerNameFutures)
 
         # We are ready to process notifications!
         self.IsReadyToProcessNotifications = True
@@ -801,9 +1070,8 @@ class MoonrakerCompat:
         # Get our name
         self._updatePrinterName()
     
-        # Since this is a new print, reset the cache. The file name might be the same as the last, but have
-        # different props, so we will always reset. We know when we are printing the same file name will have the same props.
-        FileMetadataCache.Get().ResetCache()
+        # The file name might be the same as the last print, but with different props. We don't need to reset the cache
+        # for that, since the cache drops files when moonraker reports they changed.
 
         # Try to get the starting file info if we can.
         filamentUsageMm = FileMetadataCache.Get().GetEstimatedFilamentUsageMm(fileName)
@@ -816,9 +1084,13 @@ class MoonrakerCompat:
         # Fire on started.
         self.NotificationHandler.OnStarted(fileName, fileSizeKBytes, filamentUsageMm)
 
-    def _updatePrinterName(self):
+    # If the printer name requests were already sent with GetPrinterNameAsync, pass the futures so we just wait on them.
+    def _updatePrinterName(self, printerNameFutures = None):
         # Get our name
-        name = MoonrakerClient.Get().MoonrakerDatabase.GetPrinterName()
+        database = MoonrakerClient.Get().MoonrakerDatabase
+        if printerNameFutures is None:
+            printerNameFutures = database.GetPrinterNameAsync()
+        name = database.WaitForPrinterName(printerNameFutures)
         self.NotificationHandler.NotificationSender.PrinterName = name
         Sentry.Info("Client", "Printer is called %s" % name)
 
@@ -897,13 +1169,11 @@ class MoonrakerCompat:
     # This function will get the estimated time remaining for the current print.
     # Returns -1 if the estimate is unknown.
     def GetPrintTimeRemainingEstimateInSeconds(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "virtual_sdcard": None,
-                "print_stats": None,
-                "gcode_move": None,
-            }
+            "virtual_sdcard": ["progress"],
+            "print_stats": ["print_duration", "filament_used", "filename"],
+            "gcode_move": ["speed_factor"],
         })
         # Like on OctoPrint, this logic is complicated.
         # So we use a shared common function to handle it.
@@ -914,12 +1184,10 @@ class MoonrakerCompat:
     # If the printer is warming up, this value would be -1. The First Layer Notification logic depends upon this!
     # Returns the current zoffset if known, otherwise -1.
     def GetCurrentZOffset(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "toolhead": None,
-                "print_stats": None
-            }
+            "toolhead": ["position"],
+            "print_stats": ["state", "print_duration"]
         })
         if result.HasError():
             Sentry.Error("Client", "GetCurrentZOffset failed to query toolhead objects: "+result.GetLoggingErrorStr())
@@ -947,12 +1215,10 @@ class MoonrakerCompat:
     #          Note that total layers will always be > 0, but current layer can be 0!
     def GetCurrentLayerInfo(self):
         try:
-            result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+            result = MoonrakerClient.Get().QueryPrinterObjects(
             {
-                "objects": {
-                    "print_stats": None,
-                    "gcode_move": None
-                }
+                "print_stats": ["filename", "info", "print_duration"],
+                "gcode_move": ["gcode_position"]
             })
             if result.HasError():
                 Sentry.Error("Client", "GetCurrentLayerInfo failed to query toolhead objects: "+result.GetLoggingErrorStr())
@@ -1040,11 +1306,9 @@ class MoonrakerCompat:
         # For moonraker, we have found that if the print_stats reports a state of "printing"
         # but the "print_duration" is still 0, it means we are warming up. print_duration is the time actually spent printing
         # so it doesn't increment while the system is heating.
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "print_stats": None
-            }
+            "print_stats": ["state", "print_duration"]
         })
         # Use the common helper function.
         return self.CheckIfPrinterIsWarmingUp_WithPrintStats(result)
@@ -1054,7 +1318,11 @@ class MoonrakerCompat:
     # Helpers
     #
 
-    def _InitPrintStateForFreshConnect(self):
+    def _InitPrintStateForFreshConnect(self, printerNameFutures = None):
+        # Send the printer name lookups first, so they are in flight while we get the print stats.
+        if printerNameFutures is None:
+            printerNameFutures = MoonrakerClient.Get().MoonrakerDatabase.GetPrinterNameAsync()
+
         # Get the current state
         stats = self._GetCurrentPrintStats()
         if stats is None:
@@ -1068,18 +1336,21 @@ class MoonrakerCompat:
         fileName_CanBeNone = stats["filename"]
         totalDurationFloatSec_CanBeNone = stats["total_duration"] # Use the total duration
         Sentry.Info("Client", "Printer state at socket connect is: "+state)
-        self._updatePrinterName()
+        # We might have missed file changes while we were disconnected, so start fresh.
+        # If there's a print running, start getting the metadata now, since the notification handler will need it soon.
+        FileMetadataCache.Get().ResetCache()
+        if state == "printing" or state == "paused":
+            FileMetadataCache.Get().Prefetch(fileName_CanBeNone)
+        self._updatePrinterName(printerNameFutures)
         self.NotificationHandler.OnRestorePrintIfNeeded(state, fileName_CanBeNone, totalDurationFloatSec_CanBeNone)
 
 
     # Queries moonraker for the current printer stats.
     # Returns null if the call falls or the resulting object DOESN'T contain at least: filename, state, total_duration, print_duration
     def _GetCurrentPrintStats(self):
-        result = MoonrakerClient.Get().SendJsonRpcRequest("printer.objects.query",
+        result = MoonrakerClient.Get().QueryPrinterObjects(
         {
-            "objects": {
-                "print_stats": None
-            }
+            "print_stats": ["state", "filename", "total_duration", "print_duration"]
         })
         # Validate
         if result.HasError():
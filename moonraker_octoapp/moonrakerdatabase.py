@@ -5,6 +5,7 @@ import uuid
 
 from octoapp.sentry import Sentry
 from octoapp.appsstorage import AppInstance
+from octoapp.taskscheduler import TaskScheduler
 
 from .moonrakerclient import MoonrakerClient
 
@@ -16,6 +17,8 @@ class MoonrakerDatabase:
         self.PluginVersion = pluginVersion
         self.PresenceAnnouncementRunning = False
         self.CachedEncryptionKey = None
+        self.PresenceTaskLock = threading.Lock()
+        self.PresenceTask = None
         self._continuouslyAnnouncePresence()
        
 
@@ -40,22 +43,33 @@ class MoonrakerDatabase:
         return out
 
     def GetPrinterName(self) -> str:
-        mainsailResult = MoonrakerClient.Get().SendJsonRpcRequest("server.database.get_item",
+        return self.WaitForPrinterName(self.GetPrinterNameAsync())
+
+
+    # Sends the printer name lookups for all of the frontends we know at once.
+    # The returned futures must be passed to WaitForPrinterName.
+    def GetPrinterNameAsync(self):
+        mainsailFuture = MoonrakerClient.Get().SendJsonRpcRequestAsync("server.database.get_item",
         {
             "namespace": "mainsail",
             "key": "general.printername",
         })
-        if mainsailResult.HasError() is False and  mainsailResult.GetResult() is not None:
-            return mainsailResult.GetResult()["value"]
-
-        fluiddResult = MoonrakerClient.Get().SendJsonRpcRequest("server.database.get_item",
+        fluiddFuture = MoonrakerClient.Get().SendJsonRpcRequestAsync("server.database.get_item",
         {
             "namespace": "fluidd",
             "key": "uiSettings.general.instanceName",
         })
-        if fluiddResult.HasError() is False and mainsailResult.GetResult() is not None:
+        return [mainsailFuture, fluiddFuture]
+
+
+    def WaitForPrinterName(self, futures) -> str:
+        mainsailResult, fluiddResult = MoonrakerClient.Get().WaitForJsonRpcResponses(futures)
+        if mainsailResult.HasError() is False and  mainsailResult.GetResult() is not None:
             return mainsailResult.GetResult()["value"]
 
+        if fluiddResult.HasError() is False and fluiddResult.GetResult() is not None:
+            return fluiddResult.GetResult()["value"]
+
         if mainsailResult.HasError() is True and mainsailResult.GetErrorCode() != 404 and mainsailResult.GetErrorCode() != -3260:
             Sentry.Error("Database", "Failed to load Mainsail printer name"+mainsailResult.GetLoggingErrorStr())
 
@@ -63,7 +77,7 @@ class MoonrakerDatabase:
             Sentry.Error("Database", "Failed to load Fluidd printer name"+fluiddResult.GetLoggingErrorStr())
 
         return "Klipper"
-    
+
 
     def GetOrCreateEncryptionKey(self):
         if self.CachedEncryptionKey is None:
@@ -98,12 +112,16 @@ class MoonrakerDatabase:
     def RemoveAppEntries(self, apps: []):
         Sentry.Info("Database", "Removing apps: %s" % apps)
 
+        # Send all of the deletes at once and then wait for them, so removing many apps is one round trip.
+        futures = []
         for appId in apps:
-            result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.delete_item",
+            futures.append(MoonrakerClient.Get().SendJsonRpcRequestAsync("server.database.delete_item",
             {
                 "namespace": "octoapp",
                 "key": "apps.%s" % appId,
-            })
+            }))
+        results = MoonrakerClient.Get().WaitForJsonRpcResponses(futures)
+        for appId, result in zip(apps, results):
             if result.HasError():
                 Sentry.Error("Database", "Unable to remove app %s: %s" % (appId, result.GetLoggingErrorStr()))
 
@@ -138,38 +156,48 @@ class MoonrakerDatabase:
         except Exception as e:
             Sentry.Exception("_Debug_EnumerateDataBase exception.", e)
 
+    # Starts the presence announcement task, if it's not already running.
     def _continuouslyAnnouncePresence(self):
-        t = threading.Thread(target=self._doContinuouslyAnnouncePresence)
-        t.daemon = True
-        t.start()
-
-    def _doContinuouslyAnnouncePresence(self):
-        Sentry.Info("Database", "Starting continuous update")
-        while True:
-            try:
-                if MoonrakerClient.Get() is None:
-                    Sentry.Info("Database", "Connection not ready...")
-                    time.sleep(5)
-                    continue
-
-                Sentry.Info("Database", "Updating presence")
-                result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.post_item",
-                {
-                    "namespace": "octoapp",
-                    "key": "public",
-                    "value": {
-                        "pluginVersion": self.PluginVersion,
-                        "lastSeen": time.time(),
-                        "printerId": self.PrinterId,
-                        "encryptionKey": self.GetOrCreateEncryptionKey()
-                    }
-                })
+        with self.PresenceTaskLock:
+            if self.PresenceTask is not None:
+                return
+            Sentry.Info("Database", "Starting continuous update")
+            self.PresenceTask = TaskScheduler.Get().Schedule("AnnouncePresence", 300, self._doAnnouncePresence, initialDelaySec=0, lane=TaskScheduler.c_LaneMoonraker)
 
-                if result.HasError():
-                    Sentry.Error("Database", "Ensure database entry item plugin version failed. "+result.GetLoggingErrorStr())
-                    time.sleep(60)
-                else:
-                    time.sleep(300)
-            except Exception as e:
-                Sentry.ExceptionNoSend("Failed to update presence", e)
-                time.sleep(30)
+    # Runs on the scheduler, the interval is set for the next run based on how this one went.
+    def _doAnnouncePresence(self):
+        try:
+            if MoonrakerClient.Get() is None:
+                Sentry.Info("Database", "Connection not ready...")
+                self._setPresenceInterval(5)
+                return
+
+            Sentry.Info("Database", "Updating presence")
+            result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.post_item",
+            {
+                "namespace": "octoapp",
+                "key": "public",
+                "value": {
+                    "pluginVersion": self.PluginVersion,
+                    "lastSeen": time.time(),
+                    "printerId": self.PrinterId,
+                    "encryptionKey": self.GetOrCreateEncryptionKey()
+                }
+            })
+
+            if result.HasError():
+                Sentry.Error("Database", "Ensure database entry item plugin version failed. "+result.GetLoggingErrorStr())
+                self._setPresenceInterval(60)
+            else:
+                self._setPresenceInterval(300)
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to update presence", e)
+            self._setPresenceInterval(30)
+
+
+    def _setPresenceInterval(self, intervalSec:int):
+        # The lock makes sure the task is set, since the first run can start before Schedule returns.
+        with self.PresenceTaskLock:
+            task = self.PresenceTask
+        if task is not None:
+            task.SetInterval(intervalSec)
@@ -11,6 +11,7 @@ from octoapp.Proto.ServerHost import ServerHost
 from octoapp.localip import LocalIpHelper
 from octoapp.compat import Compat
 from octoapp.appsstorage import AppStorageHelper
+from octoapp.notificationtracing import NotificationLatencyStats
 
 from .config import Config
 from .secrets import Secrets
@@ -35,6 +36,7 @@ class MoonrakerHost:
         # When we create our class, make sure all of our core requirements are created.
         self.MoonrakerWebcamHelper = None
         self.MoonrakerDatabase = None
+        self.MoonrakerAppStorage = None
         self.Secrets = None
 
         # Let the compat system know this is an Moonraker host.
@@ -114,8 +116,8 @@ class MoonrakerHost:
             self.MoonrakerDatabase = MoonrakerDatabase(printerId, pluginVersionStr)
 
             # Setup app storage
-            moonrakerAppStorage = MoonrakerAppStorage(self.MoonrakerDatabase)
-            AppStorageHelper.Init(moonrakerAppStorage)
+            self.MoonrakerAppStorage = MoonrakerAppStorage(self.MoonrakerDatabase)
+            AppStorageHelper.Init(self.MoonrakerAppStorage)
 
             # Setup the credential manager.
             MoonrakerCredentialManager.Init(moonrakerConfigFilePath, isObserverMode)
@@ -142,6 +144,8 @@ class MoonrakerHost:
             # Setup the snapshot helper
             self.MoonrakerWebcamHelper = MoonrakerWebcamHelper(self.Config)
             WebcamHelper.Init(self.MoonrakerWebcamHelper, localStorageDir)
+            WebcamHelper.Get().SetSnapshotCacheTtlSec(self.Config.GetIntIfInRange(Config.WebcamSection, Config.WebcamSnapshotCacheTtlMs, int(WebcamHelper.c_DefaultSnapshotCacheTtlSec * 1000), 0, int(WebcamHelper.c_MaxSnapshotCacheTtlSec * 1000)) / 1000.0)
+            WebcamHelper.Get().SetStreamReaderEnabled(self.Config.GetBool(Config.WebcamSection, Config.WebcamSnapshotStreamReader, True))
 
             # Setup our smart pause helper
             SmartPause.Init()
@@ -154,6 +158,12 @@ class MoonrakerHost:
             # Init our file meta data cache helper
             FileMetadataCache.Init(MoonrakerClient.Get())
 
+            # Keep the notifications that aren't sent yet on disk, so they survive a restart.
+            MoonrakerClient.Get().GetNotificationHandler().EnableOutbox(localStorageDir)
+
+            # Publish the notification latency summary to the connected clients, as an agent event.
+            NotificationLatencyStats.Get().AddSummaryListener(lambda stats: MoonrakerClient.Get().SendAgentEvent("octoapp_notification_latency", stats))
+
             # If we have a local dev server, set it in the notification handler.
             if DevLocalServerAddress_CanBeNone is not None:
                 MoonrakerClient.Get().GetNotificationHandler().SetServerProtocolAndDomain("http://"+DevLocalServerAddress_CanBeNone)
@@ -284,4 +294,5 @@ class MoonrakerHost:
     # MoonrakerClient ConnectionStatusHandler Interface - Called by the MoonrakerClient when the moonraker connection has been established and klippy is fully ready to use.
     #
     def OnMoonrakerClientConnected(self):
-        pass
+        # Apps might have registered while we were disconnected, so reload the app registry on the next use.
+        self.MoonrakerAppStorage.InvalidateRegistry()
@@ -188,19 +188,24 @@ class MoonrakerWebcamHelper():
         try:
             Sentry.Debug("Webcam Helper", "Starting auto webcam settings update...")
 
+            # Send both the new webcam API and the old database queries at once, so if we need the fallback
+            # we don't have to wait for another round trip.
+            apiFuture = MoonrakerClient.Get().SendJsonRpcRequestAsync("server.webcams.list")
+            # TODO - This should eventually be removed.
+            databaseFuture = MoonrakerClient.Get().SendJsonRpcRequestAsync("server.database.get_item",
+                {
+                    "namespace": "webcams",
+                }
+            )
+
             # First, try to use the newer webcam API.
             # It seems that even if the frontend still uses the older DB based entry, it will still showup in this new API.
-            if self._TryToFindWebcamFromApi():
+            if self._TryToFindWebcamFromApi(MoonrakerClient.Get().WaitForJsonRpcResponse(apiFuture)):
                 # On success, we found the webcam we want, so we are done.
                 return
 
             # Fallback to the old database system.
-            # TODO - This should eventually be removed.
-            result = MoonrakerClient.Get().SendJsonRpcRequest("server.database.get_item",
-                {
-                    "namespace": "webcams",
-                }
-            )
+            result = MoonrakerClient.Get().WaitForJsonRpcResponse(databaseFuture)
 
             # If we failed don't do anything.
             if result.HasError():
@@ -243,9 +248,9 @@ class MoonrakerWebcamHelper():
             Sentry.Exception("Webcam helper - _DoAutoSettingsUpdate exception. ", e)
 
 
-    def _TryToFindWebcamFromApi(self) -> bool:
+    # Takes the result of server.webcams.list
+    def _TryToFindWebcamFromApi(self, result:JsonRpcResponse) -> bool:
         # It seems that even if the frontend still uses the older DB based entry, it will still showup in this new API.
-        result = MoonrakerClient.Get().SendJsonRpcRequest("server.webcams.list")
 
         # If we failed don't do anything.
         if result.HasError():
@@ -0,0 +1,187 @@
+import collections
+import threading
+import time
+
+from octoapp.sentry import Sentry
+
+# The queue between the websocket receive thread and the non-response message worker.
+#
+# When a handler blocks for a while (RPCs, snapshots, sending notifications), messages pile up. Most of them are
+# notify_status_update deltas, which are only useful as the latest state. So while a status update is waiting in the
+# queue, newer status updates are merged into it instead of being added, and the worker only sees the latest state.
+# Every other message, like history and klippy events, is always queued as is and never dropped.
+#
+# Merging would hide state transitions from the handlers, for example a print going to paused and back to printing while
+# the worker is blocked. So an update that changes a transition field the queued update already has isn't merged.
+class NonResponseMsgQueue:
+
+    # Once the queue holds this many messages, status updates are always merged into the newest queued status update,
+    # even across transitions, so the queue can't grow without bound while the worker is stuck.
+    c_DefaultMaxSize = 1000
+
+    c_StatusUpdateMethod = "notify_status_update"
+
+    # Object name -> the fields that represent a state transition the handlers need to see.
+    c_TransitionFields = {
+        "print_stats": ("state",),
+    }
+
+    # The queue depth at which we first log about the queue backing up. Doubles after each log.
+    c_FirstDepthLogThreshold = 50
+
+
+    def __init__(self, maxSize:int = c_DefaultMaxSize) -> None:
+        self.MaxSize = maxSize
+        self.Condition = threading.Condition()
+        self.Items = collections.deque()
+        # Metrics
+        self.EnqueuedCount = 0
+        self.DequeuedCount = 0
+        self.MergedCount = 0
+        self.ForcedMergeCount = 0
+        self.OverflowCount = 0
+        self.HighWaterMark = 0
+        self.NextDepthLogThreshold = NonResponseMsgQueue.c_FirstDepthLogThreshold
+        self.TotalLatencySec = 0.0
+        self.MaxLatencySec = 0.0
+        self.LastLatencySec = 0.0
+
+
+    # Adds a message to the queue. This never blocks, since it's called on the websocket receive thread.
+    def Put(self, msg:dict) -> None:
+        isStatusUpdate = msg.get("method", None) == NonResponseMsgQueue.c_StatusUpdateMethod
+        with self.Condition:
+            self.EnqueuedCount += 1
+            if isStatusUpdate and len(self.Items) > 0:
+                # If the newest message in the queue is a status update, merge into it.
+                tail = self.Items[-1]
+                if tail.IsStatusUpdate and tail.CanMerge(msg):
+                    tail.Merge(msg)
+                    self.MergedCount += 1
+                    return
+
+            if len(self.Items) >= self.MaxSize:
+                if isStatusUpdate:
+                    # We are full, so merge into the newest status update we have, even if that hides a transition.
+                    for item in reversed(self.Items):
+                        if item.IsStatusUpdate:
+                            item.Merge(msg)
+                            self.ForcedMergeCount += 1
+                            return
+                # Anything else is never dropped, so we go over the limit.
+                self.OverflowCount += 1
+
+            self.Items.append(_QueueItem(msg, isStatusUpdate))
+            depth = len(self.Items)
+            if depth > self.HighWaterMark:
+                self.HighWaterMark = depth
+                if depth >= self.NextDepthLogThreshold:
+                    self.NextDepthLogThreshold *= 2
+                    Sentry.Warn("MsgQueue", f"Non-response message queue is backing up, depth {depth}. {self.GetStatsUnderLock()}")
+            self.Condition.notify()
+
+
+    # Blocks until a message is available, then returns it.
+    def Get(self) -> dict:
+        with self.Condition:
+            while len(self.Items) == 0:
+                self.Condition.wait()
+            item = self.Items.popleft()
+            self.DequeuedCount += 1
+            latencySec = time.time() - item.EnqueuedAt
+            self.LastLatencySec = latencySec
+            self.TotalLatencySec += latencySec
+            self.MaxLatencySec = max(self.MaxLatencySec, latencySec)
+            return item.Msg
+
+
+    def GetDepth(self) -> int:
+        with self.Condition:
+            return len(self.Items)
+
+
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return self.GetStatsUnderLock()
+
+
+    # Must be called under lock.
+    def GetStatsUnderLock(self) -> dict:
+        avgLatencyMs = 0.0
+        if self.DequeuedCount > 0:
+            avgLatencyMs = (self.TotalLatencySec / self.DequeuedCount) * 1000.0
+        return {
+            "Depth": len(self.Items),
+            "HighWaterMark": self.HighWaterMark,
+            "Enqueued": self.EnqueuedCount,
+            "Dequeued": self.DequeuedCount,
+            "Merged": self.MergedCount,
+            "ForcedMerges": self.ForcedMergeCount,
+            "Overflow": self.OverflowCount,
+            "AvgLatencyMs": round(avgLatencyMs, 3),
+            "MaxLatencyMs": round(self.MaxLatencySec * 1000.0, 3),
+            "LastLatencyMs": round(self.LastLatencySec * 1000.0, 3),
+        }
+
+
+# One message in the queue.
+class _QueueItem:
+
+    def __init__(self, msg:dict, isStatusUpdate:bool) -> None:
+        self.Msg = msg
+        self.IsStatusUpdate = isStatusUpdate
+        # The latency is measured from the oldest data in the item, so merges don't hide how far behind we are.
+        self.EnqueuedAt = time.time()
+        # Once something is merged into this item, this holds our own copy of the status, so we never modify a
+        # parsed message someone else might hold.
+        self.MergedStatus = None
+
+
+    # Returns True if the status update can be merged into this item without hiding a transition.
+    def CanMerge(self, msg:dict) -> bool:
+        newStatus, _ = _QueueItem._SplitParams(msg)
+        currentStatus = self.MergedStatus
+        if currentStatus is None:
+            currentStatus, _ = _QueueItem._SplitParams(self.Msg)
+        for objectName, fieldNames in NonResponseMsgQueue.c_TransitionFields.items():
+            newObj = newStatus.get(objectName, None)
+            currentObj = currentStatus.get(objectName, None)
+            if newObj is None or currentObj is None:
+                continue
+            for fieldName in fieldNames:
+                if fieldName in newObj and fieldName in currentObj and newObj[fieldName] != currentObj[fieldName]:
+                    return False
+        return True
+
+
+    # Merges the newer status update into this item. Newer field values replace older ones.
+    def Merge(self, msg:dict) -> None:
+        if self.MergedStatus is None:
+            currentStatus, _ = _QueueItem._SplitParams(self.Msg)
+            self.MergedStatus = {k: dict(v) for k, v in currentStatus.items() if isinstance(v, dict)}
+        newStatus, newEventTime = _QueueItem._SplitParams(msg)
+        for objectName, fields in newStatus.items():
+            if isinstance(fields, dict) is False:
+                continue
+            existing = self.MergedStatus.get(objectName, None)
+            if existing is None:
+                self.MergedStatus[objectName] = dict(fields)
+            else:
+                existing.update(fields)
+        params = [self.MergedStatus]
+        if newEventTime is not None:
+            params.append(newEventTime)
+        self.Msg = {"jsonrpc": "2.0", "method": NonResponseMsgQueue.c_StatusUpdateMethod, "params": params}
+
+
+    # The status update params are [statusDict, eventtime]
+    @staticmethod
+    def _SplitParams(msg:dict):
+        statusDict = {}
+        eventTime = None
+        for p in msg.get("params", []):
+            if isinstance(p, dict):
+                statusDict.update(p)
+            elif isinstance(p, (float, int)):
+                eventTime = p
+        return (statusDict, eventTime)
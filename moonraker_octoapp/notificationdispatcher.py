@@ -0,0 +1,163 @@
+import threading
+import time
+
+from octoapp.sentry import Sentry
+
+# Routes Moonraker notifications to the handlers that registered for them.
+#
+# Handlers register for a notification method, or for notify_status_update with the printer objects they care about.
+# Each status update is flattened once into a dict keyed by object name, and then only the handlers that registered
+# interest in one of the objects in the update are called. So adding a handler doesn't add any cost to messages it doesn't care about.
+#
+# All handlers are called on the non-response message thread, so they are allowed to block and make RPC calls.
+class NotificationDispatcher:
+
+    c_StatusUpdateMethod = "notify_status_update"
+
+    # These notifications are handled by MoonrakerClient on the websocket receive thread, not by the dispatcher.
+    c_ReceiveThreadMethods = {
+        "notify_klippy_disconnected",
+        "notify_klippy_shutdown",
+        "notify_klippy_ready",
+    }
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Method name -> list of handlers. handler(paramsDict)
+        self.MethodHandlers = {}
+        # Object name -> list of handlers. handler(statusDict, eventTime)
+        self.StatusHandlersByObject = {}
+        # Method name -> _DispatchStats
+        self.Stats = {}
+
+
+    # Registers a handler for a notification method. The handler is called with a dict that has all of the
+    # dict params of the notification merged together.
+    def RegisterMethodHandler(self, method:str, handler) -> None:
+        with self.Lock:
+            handlers = list(self.MethodHandlers.get(method, []))
+            handlers.append(handler)
+            self.MethodHandlers[method] = handlers
+
+
+    # Registers a handler for status updates that contain any of the given printer objects.
+    # The handler is called with the flattened status dict (object name -> changed fields) and the eventtime, which can be None.
+    # Note the status dict contains all of the objects in the update, not just the ones the handler registered for.
+    def RegisterStatusHandler(self, objectNames, handler) -> None:
+        with self.Lock:
+            for objectName in objectNames:
+                handlers = list(self.StatusHandlersByObject.get(objectName, []))
+                if handler not in handlers:
+                    handlers.append(handler)
+                self.StatusHandlersByObject[objectName] = handlers
+
+
+    # Returns True if anything will handle this method. Used to drop messages before they are parsed.
+    def HasHandlers(self, method:str) -> bool:
+        if method == NotificationDispatcher.c_StatusUpdateMethod:
+            return len(self.StatusHandlersByObject) > 0
+        return method in self.MethodHandlers
+
+
+    # Returns True if anything needs this notification, either the receive thread or a handler.
+    # The printer state mirror needs all of the status updates, even if no handler is interested in them.
+    # Anything else can be dropped before it's parsed.
+    def IsHandled(self, method:str) -> bool:
+        if method in NotificationDispatcher.c_ReceiveThreadMethods or method == NotificationDispatcher.c_StatusUpdateMethod:
+            return True
+        return self.HasHandlers(method)
+
+
+    # Dispatches a parsed notification message.
+    def Dispatch(self, msg:dict) -> None:
+        method = msg.get("method", None)
+        if method is None:
+            Sentry.Warn("Dispatcher", "Moonraker WS message received with no method.")
+            return
+        start = time.perf_counter()
+        if method == NotificationDispatcher.c_StatusUpdateMethod:
+            self._DispatchStatusUpdate(msg)
+        else:
+            handlers = self.MethodHandlers.get(method, None)
+            if handlers is not None:
+                paramsDict = NotificationDispatcher.FlattenParams(msg)
+                for h in handlers:
+                    h(paramsDict)
+        self._RecordDispatchTime(method, time.perf_counter() - start)
+
+
+    def _DispatchStatusUpdate(self, msg:dict) -> None:
+        # The params are [statusDict, eventtime]
+        statusDict = {}
+        eventTime = None
+        for p in msg.get("params", []):
+            if isinstance(p, dict):
+                statusDict.update(p)
+            elif isinstance(p, (float, int)):
+                eventTime = p
+
+        # Find everyone who cares about any of these objects, but only call each handler once.
+        toCall = []
+        for objectName in statusDict:
+            handlers = self.StatusHandlersByObject.get(objectName, None)
+            if handlers is None:
+                continue
+            for h in handlers:
+                if h not in toCall:
+                    toCall.append(h)
+        for h in toCall:
+            h(statusDict, eventTime)
+
+
+    # Merges all of the dict params of a notification into one dict.
+    @staticmethod
+    def FlattenParams(msg:dict) -> dict:
+        paramsDict = {}
+        for p in msg.get("params", []):
+            if isinstance(p, dict):
+                paramsDict.update(p)
+        return paramsDict
+
+
+    def _RecordDispatchTime(self, method:str, durationSec:float) -> None:
+        stats = self.Stats.get(method, None)
+        if stats is None:
+            with self.Lock:
+                stats = self.Stats.get(method, None)
+                if stats is None:
+                    stats = _DispatchStats()
+                    self.Stats[method] = stats
+        stats.Add(durationSec)
+
+
+    # Returns the dispatch time stats for each method.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {method: stats.ToDict() for method, stats in self.Stats.items()}
+
+
+# Tracks how long dispatching takes for one method.
+class _DispatchStats:
+
+    def __init__(self) -> None:
+        self.Count = 0
+        self.TotalSec = 0.0
+        self.MaxSec = 0.0
+
+
+    def Add(self, durationSec:float) -> None:
+        self.Count += 1
+        self.TotalSec += durationSec
+        self.MaxSec = max(self.MaxSec, durationSec)
+
+
+    def ToDict(self) -> dict:
+        avgMs = 0.0
+        if self.Count > 0:
+            avgMs = (self.TotalSec / self.Count) * 1000.0
+        return {
+            "Count": self.Count,
+            "AvgMs": round(avgMs, 3),
+            "MaxMs": round(self.MaxSec * 1000.0, 3),
+            "TotalMs": round(self.TotalSec * 1000.0, 3),
+        }
@@ -0,0 +1,102 @@
+import threading
+
+from octoapp.sentry import Sentry
+
+# Builds the printer.objects.subscribe request from the fields our consumers actually read.
+#
+# Subscribing to a whole object (None) makes Moonraker push every field that changes, like virtual_sdcard.file_position
+# or toolhead.estimated_print_time, which change several times a second even when nothing is printing.
+# Instead each consumer registers the object fields it reads, and we only subscribe to the union of those.
+# https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
+#
+# When the registered fields change, the changed callback is called so the client can re-subscribe.
+class PrinterObjectSubscription:
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # Consumer name -> dict of object name -> None for all fields, or a set of field names.
+        self.Consumers = {}
+        # Called with no args when the subscription changes.
+        self.OnChangedCallback_CanBeNone = None
+
+
+    def SetOnChangedCallback(self, callback) -> None:
+        self.OnChangedCallback_CanBeNone = callback
+
+
+    # Registers the fields a consumer reads, in the same format as the printer.objects.subscribe "objects" param.
+    # If the consumer was already registered, its fields are replaced.
+    def Register(self, consumerName:str, objectFields:dict) -> None:
+        fields = {}
+        for objectName, fieldNames in objectFields.items():
+            fields[objectName] = None if fieldNames is None else set(fieldNames)
+        with self.Lock:
+            before = self._BuildUnderLock()
+            self.Consumers[consumerName] = fields
+            changed = before != self._BuildUnderLock()
+        if changed:
+            self._FireChanged(consumerName)
+
+
+    def Unregister(self, consumerName:str) -> None:
+        with self.Lock:
+            if consumerName not in self.Consumers:
+                return
+            before = self._BuildUnderLock()
+            del self.Consumers[consumerName]
+            changed = before != self._BuildUnderLock()
+        if changed:
+            self._FireChanged(consumerName)
+
+
+    # Returns the objects param for printer.objects.subscribe.
+    # The field sets are returned as sorted lists, so they serialize as json arrays.
+    def BuildSubscribeObjects(self) -> dict:
+        with self.Lock:
+            objects = self._BuildUnderLock()
+        return {k: (None if v is None else sorted(v)) for k, v in objects.items()}
+
+
+    # Returns True if the objects dict, in the printer.objects.query format, only asks for objects and fields that are subscribed.
+    @staticmethod
+    def Covers(subscribeObjects:dict, objectsDict:dict) -> bool:
+        for objectName, fields in objectsDict.items():
+            if objectName not in subscribeObjects:
+                return False
+            subscribed = subscribeObjects[objectName]
+            if subscribed is None:
+                continue
+            if fields is None:
+                return False
+            for f in fields:
+                if f not in subscribed:
+                    return False
+        return True
+
+
+    # Must be called under lock.
+    def _BuildUnderLock(self) -> dict:
+        objects = {}
+        for consumerFields in self.Consumers.values():
+            for objectName, fieldNames in consumerFields.items():
+                if objectName in objects:
+                    current = objects[objectName]
+                    # None means all fields, so it wins over any field list.
+                    if current is None or fieldNames is None:
+                        objects[objectName] = None
+                    else:
+                        current.update(fieldNames)
+                else:
+                    objects[objectName] = None if fieldNames is None else set(fieldNames)
+        return objects
+
+
+    def _FireChanged(self, consumerName:str) -> None:
+        Sentry.Debug("Subscription", f"Printer object subscription changed by {consumerName}: {self.BuildSubscribeObjects()}")
+        callback = self.OnChangedCallback_CanBeNone
+        if callback is None:
+            return
+        try:
+            callback()
+        except Exception as e:
+            Sentry.Exception("PrinterObjectSubscription changed callback failed.", e)
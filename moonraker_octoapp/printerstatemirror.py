@@ -0,0 +1,129 @@
+import threading
+
+from octoapp.sentry import Sentry
+from .printerobjectsubscription import PrinterObjectSubscription
+
+# Keeps an in-memory copy of the printer objects we are subscribed to, so the printer state interface functions
+# don't need to issue a printer.objects.query every time they are called.
+#
+# The mirror is seeded with the full object state returned by printer.objects.subscribe and then kept up to date
+# by the notify_status_update notifications, which only contain the fields that changed since the last update.
+# https://moonraker.readthedocs.io/en/latest/web_api/#subscribe-to-printer-object-status
+#
+# The mirror is only trusted while the websocket it was seeded on is still connected. Whenever it's invalidated,
+# the objects are considered stale and the callers need to fall back to a query.
+class PrinterStateMirror:
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # A dict of object name -> dict of the object's fields.
+        self.Objects = {}
+        # The objects param of the subscription the mirror was seeded from, object name -> None or a list of field names.
+        # The mirror can only answer for the fields that are subscribed, since the others aren't kept up to date.
+        self.SubscribedObjects = {}
+        # The eventtime of the most recent status we have applied.
+        self.EventTime = 0.0
+        # While a subscribe is in flight, we buffer the status updates so none are lost between the subscribe
+        # response and the seed call. If this is None, there's no sync pending.
+        self.PendingUpdates_CanBeNone = None
+        # Stats, so we can see how often the mirror is used.
+        self.HitCount = 0
+        self.MissCount = 0
+
+
+    # Must be called before the subscribe request is sent.
+    # Any status updates that come in before Seed is called are held, so they can be applied after the seed if they are newer.
+    def BeginSync(self) -> None:
+        with self.Lock:
+            self.PendingUpdates_CanBeNone = []
+
+
+    # Seeds the mirror with the status object from the printer.objects.subscribe result.
+    # subscribeObjects is the objects param the subscribe request was sent with.
+    # This replaces all known state.
+    def Seed(self, statusDict:dict, eventTime:float, subscribeObjects:dict) -> None:
+        with self.Lock:
+            self.SubscribedObjects = subscribeObjects
+            self.Objects = {}
+            for objectName, fields in statusDict.items():
+                if isinstance(fields, dict):
+                    self.Objects[objectName] = dict(fields)
+            self.EventTime = eventTime if eventTime is not None else 0.0
+
+            # Apply anything that came in while we were waiting for the subscribe response.
+            # Updates older than the seed are already contained in it.
+            pending = self.PendingUpdates_CanBeNone
+            self.PendingUpdates_CanBeNone = None
+            if pending is not None:
+                for (update, updateEventTime) in pending:
+                    if updateEventTime is None or updateEventTime >= self.EventTime:
+                        self._ApplyUnderLock(update, updateEventTime)
+        Sentry.Debug("StateMirror", "Printer state mirror seeded with objects: "+str(list(self.Objects.keys())))
+
+
+    # Applies a status delta from a notify_status_update notification.
+    def ApplyStatusUpdate(self, statusDict:dict, eventTime:float) -> None:
+        with self.Lock:
+            if self.PendingUpdates_CanBeNone is not None:
+                self.PendingUpdates_CanBeNone.append((statusDict, eventTime))
+                return
+            self._ApplyUnderLock(statusDict, eventTime)
+
+
+    # Must be called under lock.
+    def _ApplyUnderLock(self, statusDict:dict, eventTime:float) -> None:
+        for objectName, fields in statusDict.items():
+            # Only merge into objects that were seeded, otherwise we would end up with a partial object.
+            obj = self.Objects.get(objectName, None)
+            if obj is not None and isinstance(fields, dict):
+                # Moonraker sends top level fields as a whole, so a shallow update is correct.
+                obj.update(fields)
+        if eventTime is not None:
+            self.EventTime = eventTime
+
+
+    # Drops all state, after this call the mirror is stale until seeded again.
+    # Called when the websocket or klippy connection is lost, since we can't know what we missed.
+    def Invalidate(self) -> None:
+        with self.Lock:
+            self.Objects = {}
+            self.SubscribedObjects = {}
+            self.EventTime = 0.0
+            self.PendingUpdates_CanBeNone = None
+
+
+    # If all of the requested objects and fields are in the mirror, this returns a dict in the same format as the "status" object
+    # of a printer.objects.query result. The objects dict is in the printer.objects.query format, object name -> None or a list of fields.
+    # If anything requested isn't subscribed, this returns None and the caller should do a query.
+    # The returned object dicts are copies, so they can be used without holding the lock.
+    def TryGetStatus(self, objectsDict:dict) -> dict:
+        with self.Lock:
+            if self.PendingUpdates_CanBeNone is not None or PrinterObjectSubscription.Covers(self.SubscribedObjects, objectsDict) is False:
+                self.MissCount += 1
+                return None
+            status = {}
+            for objectName, fields in objectsDict.items():
+                obj = self.Objects.get(objectName, None)
+                if obj is None:
+                    self.MissCount += 1
+                    return None
+                if fields is None:
+                    status[objectName] = dict(obj)
+                else:
+                    status[objectName] = {k: v for k, v in obj.items() if k in fields}
+            self.HitCount += 1
+            return status
+
+
+    # Returns the eventtime of the last applied status.
+    def GetEventTime(self) -> float:
+        return self.EventTime
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Hits": self.HitCount,
+                "Misses": self.MissCount,
+                "Objects": list(self.Objects.keys()),
+            }
@@ -0,0 +1,168 @@
+import threading
+import time
+
+from octoapp.sentry import Sentry
+
+# Merges printer.objects.query calls that happen at about the same time into one RPC.
+#
+# Things like BuildCommonEventArgs, Gadget and the first layer timer all ask for printer objects at the same moment.
+# Instead of sending a query for each, the first caller opens a short window, everyone who shows up in that window
+# is added to the same batch, and one query is sent for the union of the objects. Callers that ask for objects an
+# in-flight query already covers just wait for that query. Each caller gets back only the objects and fields it asked for.
+class PrinterObjectsQueryCoalescer:
+
+    # How long the first caller waits for others to join the batch.
+    # This is added to the latency of every query that isn't served by the state mirror, so it needs to stay small.
+    c_BatchWindowSec = 0.025
+
+    # How long a follower will wait for the batch leader before giving up.
+    # This is longer than the RPC timeout, since the leader will always report back after the RPC timeout.
+    c_FollowerMaxWaitSec = 90.0
+
+    # sendQueryFunc is called with an objects dict and must return a JsonRpcResponse.
+    def __init__(self, sendQueryFunc, jsonRpcResponseType) -> None:
+        self.SendQueryFunc = sendQueryFunc
+        self.JsonRpcResponseType = jsonRpcResponseType
+        self.Lock = threading.Lock()
+        self.OpenBatch_CanBeNone = None
+        self.InFlightBatches = []
+        # Counters
+        self.RequestCount = 0
+        self.RpcCount = 0
+        self.JoinedWindowCount = 0
+        self.JoinedInFlightCount = 0
+
+
+    # Queries the given objects, in the same format as the printer.objects.query "objects" param.
+    # This will not throw, it will always return a JsonRpcResponse which can be checked for errors or success.
+    def Query(self, objectsDict:dict):
+        isLeader = False
+        with self.Lock:
+            self.RequestCount += 1
+            batch = None
+            # First, see if there's a query already on the wire that has everything we need.
+            for b in self.InFlightBatches:
+                if b.Covers(objectsDict):
+                    batch = b
+                    batch.CallerCount += 1
+                    self.JoinedInFlightCount += 1
+                    break
+            # If not, join the open batch or start a new one.
+            if batch is None:
+                if self.OpenBatch_CanBeNone is None:
+                    self.OpenBatch_CanBeNone = _QueryBatch()
+                    isLeader = True
+                else:
+                    self.JoinedWindowCount += 1
+                batch = self.OpenBatch_CanBeNone
+                batch.Merge(objectsDict)
+
+        if isLeader:
+            self._RunBatch(batch)
+        elif batch.DoneEvent.wait(PrinterObjectsQueryCoalescer.c_FollowerMaxWaitSec) is False:
+            Sentry.Warn("QueryCoalescer", "Timed out waiting on a coalesced printer objects query.")
+            return self.JsonRpcResponseType(None, self.JsonRpcResponseType.OE_ERROR_TIMEOUT)
+        return batch.GetSlice(objectsDict, self.JsonRpcResponseType)
+
+
+    # Called by the leader, sends the batch and wakes up everyone waiting on it.
+    def _RunBatch(self, batch) -> None:
+        response = None
+        try:
+            # Give anyone else a chance to join.
+            time.sleep(PrinterObjectsQueryCoalescer.c_BatchWindowSec)
+            with self.Lock:
+                # Close the batch, anyone who shows up from now on either joins the in-flight query or starts a new batch.
+                self.OpenBatch_CanBeNone = None
+                self.InFlightBatches.append(batch)
+                self.RpcCount += 1
+            if batch.CallerCount > 1:
+                Sentry.Debug("QueryCoalescer", f"Sending one printer objects query for {batch.CallerCount} callers. {list(batch.Objects.keys())}")
+            # The field sets need to be lists, so they serialize as json arrays.
+            response = self.SendQueryFunc({k: (None if v is None else sorted(v)) for k, v in batch.Objects.items()})
+        except Exception as e:
+            Sentry.Exception("PrinterObjectsQueryCoalescer failed to run a batch.", e)
+            response = self.JsonRpcResponseType(None, self.JsonRpcResponseType.OE_ERROR_EXCEPTION, str(e))
+        finally:
+            with self.Lock:
+                if self.OpenBatch_CanBeNone is batch:
+                    self.OpenBatch_CanBeNone = None
+                if batch in self.InFlightBatches:
+                    self.InFlightBatches.remove(batch)
+            batch.SetResponse(response)
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Requests": self.RequestCount,
+                "Rpcs": self.RpcCount,
+                "RpcsSaved": self.RequestCount - self.RpcCount,
+                "JoinedWindow": self.JoinedWindowCount,
+                "JoinedInFlight": self.JoinedInFlightCount,
+            }
+
+
+# A single query that one or more callers are waiting on.
+class _QueryBatch:
+
+    def __init__(self) -> None:
+        # Object name -> None for all fields, or a set of field names.
+        self.Objects = {}
+        self.CallerCount = 0
+        self.DoneEvent = threading.Event()
+        self.Response = None
+
+
+    # Adds the requested objects to this batch. Must be called under the coalescer lock.
+    def Merge(self, objectsDict:dict) -> None:
+        self.CallerCount += 1
+        for objectName, fields in objectsDict.items():
+            if objectName in self.Objects:
+                current = self.Objects[objectName]
+                # None means all fields, so it wins over any field list.
+                if current is None or fields is None:
+                    self.Objects[objectName] = None
+                else:
+                    current.update(fields)
+            else:
+                self.Objects[objectName] = None if fields is None else set(fields)
+
+
+    # Returns True if this batch will return everything the objects dict asks for. Must be called under the coalescer lock.
+    def Covers(self, objectsDict:dict) -> bool:
+        for objectName, fields in objectsDict.items():
+            if objectName not in self.Objects:
+                return False
+            current = self.Objects[objectName]
+            if current is None:
+                continue
+            if fields is None or current.issuperset(fields) is False:
+                return False
+        return True
+
+
+    def SetResponse(self, response) -> None:
+        self.Response = response
+        self.DoneEvent.set()
+
+
+    # Returns a response that only contains what the caller asked for.
+    def GetSlice(self, objectsDict:dict, jsonRpcResponseType):
+        response = self.Response
+        if response is None or response.HasError():
+            return response
+        result = response.GetResult()
+        if result is None or "status" not in result:
+            return response
+        fullStatus = result["status"]
+        status = {}
+        for objectName, fields in objectsDict.items():
+            obj = fullStatus.get(objectName, None)
+            if obj is None:
+                continue
+            if fields is None:
+                status[objectName] = obj
+            else:
+                status[objectName] = {k: v for k, v in obj.items() if k in fields}
+        return jsonRpcResponseType({"eventtime": result.get("eventtime", None), "status": status})
@@ -1,11 +1,11 @@
 import os
-import threading
 import hashlib
 import random
 import string
 
 from octoapp.sentry import Sentry
 from octoapp.ostypeidentifier import OsTypeIdentifier
+from octoapp.taskscheduler import TaskScheduler
 
 from octoapp.Proto import OsType
 
@@ -36,23 +36,9 @@ class UiInjector():
         self.StaticUiJsFilePath = None
         self.StaticUiCssFilePath = None
         self.StaticFileHash = None
-        self.WorkerEvent = threading.Event()
-        self.WorkerThread = threading.Thread(target=self._Worker)
-        self.WorkerThread.start()
-
-
-    def _Worker(self):
-        while True:
-            try:
-                # Do our update logic before sleeping, so we activate right when the service loads.
-                # This function has it's own try except, so it won't throw out.
-                self._ExecuteOnce()
-
-                # Now wait on our event handle.
-                self.WorkerEvent.wait(UiInjector.c_UpdateCheckIntervalSec)
-
-            except Exception as e:
-                Sentry.Exception("UiInjector worker exception.", e)
+        # Run right away, so we activate right when the service loads.
+        # _ExecuteOnce has it's own try except, so it won't throw out.
+        self.WorkerTask = TaskScheduler.Get().Schedule("UiInjector", UiInjector.c_UpdateCheckIntervalSec, self._ExecuteOnce, initialDelaySec=0, lane=TaskScheduler.c_LaneFiles)
 
 
     # Does the work.
@@ -1,5 +1,7 @@
 
 from octoapp.sentry import Sentry
+from octoapp.taskscheduler import TaskScheduler
+import heapq
 import threading
 import time
 
@@ -67,13 +69,192 @@ class AppInstance:
             excludeNotifications=dict.get("excludeNotifications", []),
         )
 
-       
+
+
+# An index of the registered apps, used to pick the push targets without going over and sorting all apps for every push.
+#
+# The apps are grouped per phone (InstanceId), and for each phone split into live activities, iOS apps and Android apps,
+# each list ordered by LastSeenAt, newest first. There are also lookups by the fcm token and the fallback token,
+# so the invalid tokens we get back from the server can be matched without going over the full list for each one.
+#
+# The index is updated incrementally when an app is registered or removed, and rebuilt when the platform has a new full list.
+#
+# The index also keeps a min-heap of the ExpireAt deadlines, so the next app to expire is known without going over all apps.
+# Entries aren't removed from the heap when an app is removed or updated, they are skipped when they reach the top instead.
+class PushTargetIndex:
+
+    c_Activity = "activity"
+    c_Ios = "ios"
+    c_Android = "android"
+
+    def __init__(self, apps:list) -> None:
+        self.Lock = threading.Lock()
+        self.Rebuild(apps)
+
+
+    @staticmethod
+    def GetTokenType(app:AppInstance) -> str:
+        if app.FcmToken.startswith("activity:"):
+            return PushTargetIndex.c_Activity
+        if app.FcmToken.startswith("ios:"):
+            return PushTargetIndex.c_Ios
+        return PushTargetIndex.c_Android
+
+
+    # Replaces everything in the index with the given apps.
+    def Rebuild(self, apps:list) -> None:
+        # Sort once, so every list we add to below is already in order.
+        apps = sorted(apps, key=lambda app: app.LastSeenAt or 0, reverse=True)
+        with self.Lock:
+            # InstanceId -> {token type -> [AppInstance]}
+            self.Phones = {}
+            # fcmToken -> AppInstance
+            self.ByToken = {}
+            # fcmFallbackToken -> [AppInstance]
+            self.ByFallbackToken = {}
+            # A heap of (ExpireAt, Seq, AppInstance)
+            self.ExpiryHeap = []
+            self.ExpirySeq = 0
+            for app in apps:
+                self._RemoveUnderLock(app.FcmToken)
+                self._AddUnderLock(app, append=True)
+            self.BuiltAt = time.time()
+
+
+    # Adds the app, or replaces the one with the same fcm token.
+    def Upsert(self, app:AppInstance) -> None:
+        with self.Lock:
+            self._RemoveUnderLock(app.FcmToken)
+            self._AddUnderLock(app, append=False)
+
+
+    def Remove(self, fcmTokens:list) -> None:
+        with self.Lock:
+            for fcmToken in fcmTokens:
+                self._RemoveUnderLock(fcmToken)
+
+
+    # Returns all apps that use any of the tokens, as the fcm token or the fallback token.
+    def FindByTokens(self, tokens:list) -> list:
+        found = {}
+        with self.Lock:
+            for token in tokens:
+                app = self.ByToken.get(token, None)
+                if app is not None:
+                    found[app.FcmToken] = app
+                for app in self.ByFallbackToken.get(token, []):
+                    found[app.FcmToken] = app
+        return list(found.values())
+
+
+    # Returns the ExpireAt of the app that expires next, or None if no app expires.
+    def GetNextExpireAt(self) -> float:
+        with self.Lock:
+            self._DropStaleExpiryEntriesUnderLock()
+            if len(self.ExpiryHeap) == 0:
+                return None
+            return self.ExpiryHeap[0][0]
+
+
+    # Returns the apps that are expired at the given time and takes them off the expiry heap.
+    # The apps stay in the index until they are removed.
+    def TakeExpired(self, now:float) -> list:
+        expired = []
+        with self.Lock:
+            while True:
+                self._DropStaleExpiryEntriesUnderLock()
+                if len(self.ExpiryHeap) == 0 or self.ExpiryHeap[0][0] > now:
+                    break
+                expired.append(heapq.heappop(self.ExpiryHeap)[2])
+        return expired
+
+
+    # Picks the apps to send a push to, per phone:
+    #  - The most recent live activity, if there is one and preferActivity is set.
+    #  - Otherwise the most recent iOS app, if canUseNonActivity is set.
+    #    This means iOS might not be picked at all if we only can use activity but no activity is available!
+    #  - Otherwise all Android apps (might be watch + phone)
+    def PickTargets(self, preferActivity:bool, canUseNonActivity:bool) -> list:
+        targets = []
+        with self.Lock:
+            for phone in self.Phones.values():
+                activities = phone[PushTargetIndex.c_Activity]
+                ios = phone[PushTargetIndex.c_Ios]
+                if len(activities) and preferActivity:
+                    targets.append(activities[0])
+                elif len(ios) and canUseNonActivity:
+                    targets.append(ios[0])
+                else:
+                    targets.extend(phone[PushTargetIndex.c_Android])
+        return targets
+
+
+    def _AddUnderLock(self, app:AppInstance, append:bool) -> None:
+        phone = self.Phones.get(app.InstanceId, None)
+        if phone is None:
+            phone = {PushTargetIndex.c_Activity: [], PushTargetIndex.c_Ios: [], PushTargetIndex.c_Android: []}
+            self.Phones[app.InstanceId] = phone
+        appList = phone[PushTargetIndex.GetTokenType(app)]
+        lastSeenAt = app.LastSeenAt or 0
+        if append:
+            appList.append(app)
+        else:
+            # Keep the list ordered, newest first. Apps with the same time keep the order they were added in.
+            i = 0
+            while i < len(appList) and (appList[i].LastSeenAt or 0) >= lastSeenAt:
+                i += 1
+            appList.insert(i, app)
+        self.ByToken[app.FcmToken] = app
+        if app.FcmFallbackToken is not None:
+            self.ByFallbackToken.setdefault(app.FcmFallbackToken, []).append(app)
+        if app.ExpireAt is not None:
+            self.ExpirySeq += 1
+            heapq.heappush(self.ExpiryHeap, (app.ExpireAt, self.ExpirySeq, app))
+
+
+    # An entry is stale if the app was removed or replaced, or its ExpireAt changed.
+    def _DropStaleExpiryEntriesUnderLock(self) -> None:
+        while len(self.ExpiryHeap) > 0:
+            expireAt, _, app = self.ExpiryHeap[0]
+            if self.ByToken.get(app.FcmToken, None) is app and app.ExpireAt == expireAt:
+                return
+            heapq.heappop(self.ExpiryHeap)
+
+
+    def _RemoveUnderLock(self, fcmToken:str) -> None:
+        app = self.ByToken.pop(fcmToken, None)
+        if app is None:
+            return
+        phone = self.Phones.get(app.InstanceId, None)
+        if phone is not None:
+            appList = phone[PushTargetIndex.GetTokenType(app)]
+            if app in appList:
+                appList.remove(app)
+            if not any(len(l) for l in phone.values()):
+                del self.Phones[app.InstanceId]
+        if app.FcmFallbackToken is not None:
+            fallbackApps = self.ByFallbackToken.get(app.FcmFallbackToken, [])
+            if app in fallbackApps:
+                fallbackApps.remove(app)
+            if len(fallbackApps) == 0:
+                self.ByFallbackToken.pop(app.FcmFallbackToken, None)
+
 
 class AppStorageHelper:
 
     # Logic for a static singleton
     _Instance = None
 
+    c_TargetIndexRebuildAfterSec = 60.0
+
+    # The first expiry check builds the index, this gives the platform some time to start up first.
+    # It's also how long we wait to try again if a check fails.
+    c_ExpiryCheckRetrySec = 60.0
+
+    # Apps can be registered without us being told, on moonraker they write to the database themselves. So even if
+    # no app expires before then, we check again after this long, which reloads the apps if the index is stale.
+    c_ExpiryRescanSec = 300.0
+
     @staticmethod
     def Init(appStoragePlatformHelper):
         AppStorageHelper._Instance = AppStorageHelper(appStoragePlatformHelper)
@@ -84,13 +265,22 @@ class AppStorageHelper:
 
     def __init__(self, appStoragePlatformHelper):
         self.AppStoragePlatformHelper = appStoragePlatformHelper
+        # The key only changes if the stored one is replaced, so we don't need to ask the platform every time.
+        self.EncryptionKeyLock = threading.Lock()
+        self.EncryptionKey_CanBeNone = None
+        # Built on first use. The platforms tell us about changes, but since apps can also be changed outside of
+        # the plugin (on moonraker they write to the database themselves) it's also rebuilt once it's this old.
+        self.TargetIndexLock = threading.Lock()
+        self.TargetIndex_CanBeNone = None
+        # A one shot task that runs when the next app expires, see SetAppsExpiredListener
+        self.ExpiryLock = threading.Lock()
+        self.ExpiryTask_CanBeNone = None
+        self.ExpiryTaskDueAt = None
+        self.AppsExpiredListener_CanBeNone = None
 
     def GetAndroidApps(self, apps):
         return list(filter(lambda app: not app.FcmToken.startswith("activity:") and not app.FcmToken.startswith("ios:"), apps))
 
-    def GetExpiredApps(self, apps):
-        return list(filter(lambda app: app.ExpireAt is not None and time.time() > app.ExpireAt, apps))
-
     def GetIosApps(self, apps):
         return list(filter(lambda app: app.FcmToken.startswith("ios:"), apps))
 
@@ -125,8 +315,102 @@ class AppStorageHelper:
 
     def RemoveApps(self, apps: [AppInstance]):
         Sentry.Debug("APPS", "Removing %s apps" % len(apps))
+        index = self.TargetIndex_CanBeNone
+        if index is not None:
+            index.Remove([app.FcmToken for app in apps])
+            self._UpdateExpiryDeadline()
         self.AppStoragePlatformHelper.RemoveApps(apps)
         self.LogApps()
+
+    # Returns the apps a push should be sent to, see PushTargetIndex.PickTargets
+    def GetPushTargets(self, preferActivity:bool, canUseNonActivity:bool) -> [AppInstance]:
+        return self._GetTargetIndex().PickTargets(preferActivity, canUseNonActivity)
+
+    # Returns all apps that use any of the tokens as their fcm token or fallback token.
+    def FindAppsByTokens(self, tokens:list) -> [AppInstance]:
+        return self._GetTargetIndex().FindByTokens(tokens)
+
+    # Called by the platform when it has a new full list of apps, like after loading them from storage.
+    def OnAppsUpdated(self, apps: [AppInstance]):
+        with self.TargetIndexLock:
+            if self.TargetIndex_CanBeNone is None:
+                self.TargetIndex_CanBeNone = PushTargetIndex(apps)
+            else:
+                self.TargetIndex_CanBeNone.Rebuild(apps)
+        self._UpdateExpiryDeadline()
+
+    # Called by the platform when an app was registered or updated.
+    def OnAppRegistered(self, app: AppInstance):
+        index = self.TargetIndex_CanBeNone
+        if index is not None:
+            index.Upsert(app)
+            self._UpdateExpiryDeadline()
+
+    # listener(expiredApps) is called when apps expire, right at their ExpireAt.
+    # A single one shot task waits for the next deadline and is moved when the apps change. It also runs at least
+    # every c_ExpiryRescanSec, to pick up apps that were registered without us knowing.
+    def SetAppsExpiredListener(self, listener):
+        self.AppsExpiredListener_CanBeNone = listener
+        with self.ExpiryLock:
+            self._ScheduleExpiryCheckUnderLock(time.time() + AppStorageHelper.c_ExpiryCheckRetrySec)
+
+    # Moves the expiry task to the next deadline in the index, or the next rescan if that's sooner.
+    def _UpdateExpiryDeadline(self):
+        index = self.TargetIndex_CanBeNone
+        if index is None or self.AppsExpiredListener_CanBeNone is None:
+            return
+        rescanAt = time.time() + AppStorageHelper.c_ExpiryRescanSec
+        nextExpireAt = index.GetNextExpireAt()
+        with self.ExpiryLock:
+            if nextExpireAt is None or nextExpireAt > rescanAt:
+                # Don't keep pushing the rescan out every time the apps change, a rescan that's already planned sooner is fine.
+                if self.ExpiryTask_CanBeNone is not None and self.ExpiryTaskDueAt <= rescanAt:
+                    return
+                self._ScheduleExpiryCheckUnderLock(rescanAt)
+                return
+            self._ScheduleExpiryCheckUnderLock(nextExpireAt)
+
+    def _ScheduleExpiryCheckUnderLock(self, dueAt:float):
+        if self.ExpiryTask_CanBeNone is not None:
+            if self.ExpiryTaskDueAt == dueAt:
+                return
+            self.ExpiryTask_CanBeNone.Cancel()
+        self.ExpiryTaskDueAt = dueAt
+        self.ExpiryTask_CanBeNone = TaskScheduler.Get().RunAfter("AppExpiry", dueAt - time.time(), self._OnExpiryDeadline, lane=TaskScheduler.c_LaneCloud)
+
+    def _OnExpiryDeadline(self):
+        with self.ExpiryLock:
+            self.ExpiryTask_CanBeNone = None
+        try:
+            # This builds the index on the first run, after that it's only reloaded here if it's stale.
+            expired = self._GetTargetIndex().TakeExpired(time.time())
+            if len(expired) and self.AppsExpiredListener_CanBeNone is not None:
+                Sentry.Debug("APPS", "%s apps expired" % len(expired))
+                self.AppsExpiredListener_CanBeNone(expired)
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to handle expired apps", e)
+            with self.ExpiryLock:
+                self._ScheduleExpiryCheckUnderLock(time.time() + AppStorageHelper.c_ExpiryCheckRetrySec)
+            return
+        self._UpdateExpiryDeadline()
+
+    def _GetTargetIndex(self) -> PushTargetIndex:
+        index = self.TargetIndex_CanBeNone
+        if index is None or time.time() - index.BuiltAt > AppStorageHelper.c_TargetIndexRebuildAfterSec:
+            self.OnAppsUpdated(self.GetAllApps())
+            index = self.TargetIndex_CanBeNone
+        return index
      
     def GetOrCreateEncryptionKey(self):
-        return self.AppStoragePlatformHelper.GetOrCreateEncryptionKey()
+        key = self.EncryptionKey_CanBeNone
+        if key is not None:
+            return key
+        with self.EncryptionKeyLock:
+            if self.EncryptionKey_CanBeNone is None:
+                self.EncryptionKey_CanBeNone = self.AppStoragePlatformHelper.GetOrCreateEncryptionKey()
+            return self.EncryptionKey_CanBeNone
+
+    # Must be called if the stored encryption key might have changed, so it's read again on the next use.
+    def InvalidateEncryptionKey(self):
+        with self.EncryptionKeyLock:
+            self.EncryptionKey_CanBeNone = None
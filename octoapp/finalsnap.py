@@ -1,9 +1,10 @@
-import math
 import time
 import threading
+from collections import deque
 
 from .sentry import Sentry
 from .repeattimer import RepeatTimer
+from .taskscheduler import TaskScheduler
 
 # A helper class to try to capture a better "print completed" image by taking images before the complete notification
 # so we have images from shortly before the notification fires. This is needed because most printers will move the
@@ -14,11 +15,15 @@ class FinalSnap:
     # The default interval that we will snap an image at.
     c_defaultSnapIntervalSec = 1
 
-    # This is how many snapshots we will keep in our buffer.
-    # Thus, the amount of time we will keep in our buffer is seconds = (c_snapshotBufferDepth * c_defaultSnapIntervalSec)
-    # We must keep this buffer a little larger, for the extrude command logic to have enough buffer to operate in.
-    # This buffer must also be large enough to have data for the c_onCompleteSnapDelaySec time.
-    c_snapshotBufferDepth = 40
+    # The history holds the images as the camera sent them, and it's capped by the total size of the images.
+    # Only the one image we pick is transformed and resized, so the other images are never decoded.
+    # 1080p jpegs are about 200-400KB, so this holds around 30 seconds of them. With 4K cameras it holds less time,
+    # but we always keep enough images to cover c_onCompleteSnapDelaySec, which is what the complete notification uses.
+    c_snapshotBufferMaxBytes = 8 * 1024 * 1024
+
+    # We never need images older than this, so they are dropped even if they fit in the buffer.
+    # This must be large enough for the extrude command logic to have enough buffer to operate in.
+    c_snapshotBufferMaxAgeSec = 40
 
     # When the on complete notification fires, this is how long we will try to go back in time to fetch a snapshot,
     # if we don't have a last extrude command sent time.
@@ -30,8 +35,11 @@ class FinalSnap:
         self.LastExtrudeCommandSent:float = 0.0
         self.NotificationHandler = notificationHandler
         self.SnapLock = threading.Lock()
-        self.SnapHistory = []
-        self.Timer = RepeatTimer(FinalSnap.c_defaultSnapIntervalSec, self._snapCallback)
+        # A deque of (timeSec, rawSnapshot), oldest first.
+        self.SnapHistory = deque()
+        self.SnapHistoryBytes = 0
+        self.HasWarnedBufferTooSmall = False
+        self.Timer = RepeatTimer(FinalSnap.c_defaultSnapIntervalSec, self._snapCallback, lane=TaskScheduler.c_LaneCamera)
         self.Timer.start()
         Sentry.Info("FINAL_SNAP", "Starting FinalSnap")
 
@@ -51,80 +59,86 @@ class FinalSnap:
         self.Timer.Stop()
 
         # Try to find the best snap.
+        snap = None
         with self.SnapLock:
             if len(self.SnapHistory) > 0:
 
                 # Find to get our target delta time.
                 targetTimeDeltaSec:float = 0.0
+                now = time.time()
 
                 # If we have a `LastExtrudeCommandSent` and it's in our buffer, we will use it.
                 # This is the most ideal indicator, because we know it's the last time the extruder did a positive extrude
                 # But, not all platforms or even all prints (like printing from an SD card) will know this value.
                 if self.LastExtrudeCommandSent != 0:
-                    targetTimeDeltaSec = time.time() - self.LastExtrudeCommandSent
+                    targetTimeDeltaSec = now - self.LastExtrudeCommandSent
 
                 # If we still dont have a targetTimeDeltaSec value, use our fixed value.
                 if targetTimeDeltaSec <= 0.0001:
                     targetTimeDeltaSec = float(FinalSnap.c_onCompleteSnapDelaySec)
 
-                # Compute our ideal image position in our buffer.
-                # In terms of rounding, round up, to prefer a later image then the exact time.
-                targetArrayIndex = int(math.ceil(targetTimeDeltaSec / float(FinalSnap.c_defaultSnapIntervalSec)))
+                # Find the image taken closest to the target time.
+                # The images are taken at the end of the interval, so on a tie prefer the later image.
+                targetTime = now - targetTimeDeltaSec
+                oldestTime = self.SnapHistory[0][0]
+                if targetTime < oldestTime - FinalSnap.c_defaultSnapIntervalSec:
+                    Sentry.Warn("FINAL_SNAP", f"Target image time is older than our buffer. {round(now - targetTime, 1)}s {round(now - oldestTime, 1)}s {len(self.SnapHistory)}")
+                snapTime, snap = min(self.SnapHistory, key=lambda entry: (abs(entry[0] - targetTime), -entry[0]))
 
-                if targetArrayIndex < 0:
-                    Sentry.Error("FINAL_SNAP", f"Target image index is less than 0? {targetArrayIndex}")
-                    # Set something like our default snap interval.
-                    targetArrayIndex = 5
-                if targetArrayIndex >= len(self.SnapHistory):
-                    Sentry.Warn("FINAL_SNAP", f"Target image index is larger than our buffer. {targetArrayIndex} {len(self.SnapHistory)}")
-                    # Use the oldest image we have.
-                    targetArrayIndex = len(self.SnapHistory) - 1
+                # Clear the buffer to free up space of stored images, just incase this class leaks.
+                Sentry.Info("FINAL_SNAP", f"Stopping final snap and using snapshot from ~{round(now - snapTime, 1)} sec ago, target {round(targetTimeDeltaSec, 1)} sec, {len(self.SnapHistory)} images, {self.SnapHistoryBytes} bytes")
+                self._clearHistoryUnderLock()
 
-                # Return the image selected.
-                # Clear the array to free up space of stored images, just incase this class leaks.
-                Sentry.Info("FINAL_SNAP", f"Stopping final snap and using snapshot from ~{targetTimeDeltaSec} sec ago, index slot {targetArrayIndex} / {len(self.SnapHistory)}")
-                snap = self.SnapHistory[targetArrayIndex]
-                self.SnapHistory.clear()
-                return snap
+        if snap is None:
+            # If we don't have an image, just return None.
+            Sentry.Info("FINAL_SNAP", "Stopping final snap but there's no snapshot to use.")
+            return None
 
-        # If we don't have an image, just return None.
-        Sentry.Info("FINAL_SNAP", "Stopping final snap but there's no snapshot to use.")
-        return None
+        # Now do the work to transform and resize the image, only for the one we use.
+        # This is done outside of the lock, since it can take a while on slower devices.
+        return self.NotificationHandler.ProcessNotificationSnapshot(snap)
 
 
     # Fires when we should take a new snapshot.
     def _snapCallback(self):
         try:
-            # Try to get a snapshot.
-            snapshot = self.NotificationHandler.GetNotificationSnapshot()
+            # Try to get a snapshot, as it came from the camera.
+            snapshot = self.NotificationHandler.GetRawSnapshot()
             if snapshot is None:
                 Sentry.Info("FINAL_SNAP", "Failed to get a snapshot")
                 return
+            # Make sure we hold the bytes and not a view into a larger buffer.
+            snapshot = bytes(snapshot)
 
             with self.SnapLock:
                 # Make sure we are still running, otherwise there's no reason to store the image.
                 if self.Timer.IsRunning() is False:
                     return
 
-                # Add this most recent snapshot to the front.
-                self.SnapHistory.insert(0, snapshot)
-
-                # Figure out the desired buffer depth.
-                # `c_snapshotBufferDepth` should always be large enough, but we will make sure.
-                desiredBufferDepth = FinalSnap.c_snapshotBufferDepth
-                minBufferDepthForFixedTime = int(math.ceil(float(FinalSnap.c_onCompleteSnapDelaySec) / float(FinalSnap.c_defaultSnapIntervalSec)))
-                if minBufferDepthForFixedTime > desiredBufferDepth:
-                    Sentry.Warn("FINAL_SNAP", f"Final snap had to expand the default buffer size due to the time. {minBufferDepthForFixedTime}")
-                    desiredBufferDepth = minBufferDepthForFixedTime
-
-                # Sanity check.
-                if desiredBufferDepth < 1:
-                    Sentry.Warn("FINAL_SNAP", f"FinalSnap desiredImageHistoryCount is < 1!! {desiredBufferDepth}")
-                    desiredBufferDepth = 1
-
-                while len(self.SnapHistory) > desiredBufferDepth:
-                    # Remove the oldest image, which is the image at the end of the list.
-                    self.SnapHistory.pop()
+                # Add this most recent snapshot to the end.
+                now = time.time()
+                self.SnapHistory.append((now, snapshot))
+                self.SnapHistoryBytes += len(snapshot)
+
+                # Remove the oldest images, until we are under the time and size limits.
+                # We always keep what we need for the fixed complete delay, even if that goes over the size limit, and the newest image.
+                minKeepTime = now - FinalSnap.c_onCompleteSnapDelaySec - FinalSnap.c_defaultSnapIntervalSec
+                while len(self.SnapHistory) > 1:
+                    oldestTime, oldest = self.SnapHistory[0]
+                    if oldestTime >= now - FinalSnap.c_snapshotBufferMaxAgeSec and self.SnapHistoryBytes <= FinalSnap.c_snapshotBufferMaxBytes:
+                        break
+                    if oldestTime >= minKeepTime:
+                        if self.HasWarnedBufferTooSmall is False:
+                            self.HasWarnedBufferTooSmall = True
+                            Sentry.Warn("FINAL_SNAP", f"Final snap had to go over the buffer size limit to cover the complete delay. {len(self.SnapHistory)} images, {self.SnapHistoryBytes} bytes")
+                        break
+                    self.SnapHistory.popleft()
+                    self.SnapHistoryBytes -= len(oldest)
 
         except Exception as e:
             Sentry.Exception("FinalSnap::_snapCallback failed to get snapshot.", e)
+
+
+    def _clearHistoryUnderLock(self):
+        self.SnapHistory.clear()
+        self.SnapHistoryBytes = 0
@@ -4,11 +4,11 @@ import time
 import json
 import logging
 
-import requests
-
 from .sentry import Sentry
+from .httpsessions import HttpSessions
 from .snapshotresizeparams import SnapshotResizeParams
 from .repeattimer import RepeatTimer
+from .taskscheduler import TaskScheduler
 
 class Gadget:
 
@@ -26,6 +26,10 @@ class Gadget:
     # Assuming 20 second checks, 100 checks is about 30 minutes of data.
     c_maxScoreHistoryItems = 100
 
+    # The jpeg quality for the images we send to Gadget, if they have to be re-encoded.
+    # This is higher than for notifications, since compression artifacts can look like the details the model is looking for.
+    c_jpegQuality = 90
+
     def __init__(self, logger:logging.Logger, notificationHandler, printerStateInterface):
         self.Logger = logger
         self.NotificationHandler = notificationHandler
@@ -77,7 +81,7 @@ class Gadget:
             Sentry.Info("GADGET", "Gadget is now watching!")
 
             # Start a new timer.
-            self.Timer = RepeatTimer(self.Logger, Gadget.c_defaultIntervalSec, self._timerCallback)
+            self.Timer = RepeatTimer(Gadget.c_defaultIntervalSec, self._timerCallback, lane=TaskScheduler.c_LaneGadget)
             self.Timer.start()
 
 
@@ -201,10 +205,10 @@ class Gadget:
             if self.ImageScaleCenterCropSize > 1:
                 # If this is set, it takes priority over any other options.
                 # Request a center crop square of the image scaled to the desired factor.
-                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleCenterCropSize, False, False, True)
+                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleCenterCropSize, False, False, True, Gadget.c_jpegQuality)
             elif self.ImageScaleMaxHeight > 1:
                 # Request a max height of the desired size. If the image is smaller than this it will be ignored.
-                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleMaxHeight, True, False, False)
+                snapshotResizeParams = SnapshotResizeParams(self.ImageScaleMaxHeight, True, False, False, Gadget.c_jpegQuality)
 
             # Now, get the common event args, which will include the snapshot.
             requestData = self.NotificationHandler.BuildCommonEventArgs("inspect", None, None, snapshotResizeParams)
@@ -240,7 +244,7 @@ class Gadget:
                 # Since we are sending the snapshot, we must send a multipart form.
                 # Thus we must use the data and files fields, the json field will not work.
                 # Set a timeout, but make it long, so the server has time to process.
-                r = requests.post(gadgetApiUrl, data=args, files=files, timeout=10*60)
+                r = HttpSessions.Get().Post(gadgetApiUrl, data=args, files=files, timeout=(5.0, 10*60))
 
                 # Check for success. Anything but a 200 we will consider a connection failure.
                 if r.status_code != 200:
@@ -0,0 +1,129 @@
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from .sentry import Sentry
+
+# A process wide set of keep-alive HTTP sessions for our outbound cloud calls.
+#
+# A bare requests.post or requests.get makes a new TCP connection and TLS handshake for every call, which takes
+# hundreds of milliseconds and a good bit of CPU on small devices like the Pi Zero or Sonic Pad. The sessions here
+# keep the connections open and reuse them, so only the first call to a host pays for the handshake.
+#
+# There's one session per host, each with its own connection pool, so we can also keep metrics per host.
+class HttpSessions:
+
+    # Logic for a static singleton
+    _Instance = None
+    _InstanceLock = threading.Lock()
+
+    # The default (connect, read) timeout. Callers can pass their own, but should never make a call without one.
+    c_DefaultTimeoutSec = (5.0, 30.0)
+
+    # The max number of connections we keep open to one host.
+    c_PoolMaxSize = 4
+
+
+    # The sessions are created on first use, so there's no init call needed.
+    @staticmethod
+    def Get():
+        if HttpSessions._Instance is None:
+            with HttpSessions._InstanceLock:
+                if HttpSessions._Instance is None:
+                    HttpSessions._Instance = HttpSessions()
+        return HttpSessions._Instance
+
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # "scheme://host:port" -> _HostSession
+        self.Hosts = {}
+
+
+    # Makes a request with the shared session for the url's host. Takes the same kwargs as requests.request.
+    # If no timeout is given, the default is used.
+    def Request(self, method:str, url:str, **kwargs):
+        hostSession = self._GetHostSession(url)
+        if "timeout" not in kwargs or kwargs["timeout"] is None:
+            kwargs["timeout"] = HttpSessions.c_DefaultTimeoutSec
+        start = time.time()
+        try:
+            response = hostSession.Session.request(method, url, **kwargs)
+            hostSession.RecordRequest(time.time() - start, False)
+            return response
+        except Exception:
+            hostSession.RecordRequest(time.time() - start, True)
+            raise
+
+
+    def Post(self, url:str, **kwargs):
+        return self.Request("POST", url, **kwargs)
+
+
+    # Returns the metrics for each host, like the number of requests and how many new connections were needed for them.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            hosts = dict(self.Hosts)
+        return {hostKey: hostSession.GetStats() for hostKey, hostSession in hosts.items()}
+
+
+    def _GetHostSession(self, url:str):
+        parts = urlsplit(url)
+        hostKey = f"{parts.scheme}://{parts.netloc}"
+        with self.Lock:
+            hostSession = self.Hosts.get(hostKey, None)
+            if hostSession is None:
+                Sentry.Debug("HttpSessions", "Creating a new http session for "+hostKey)
+                hostSession = _HostSession()
+                self.Hosts[hostKey] = hostSession
+            return hostSession
+
+
+# The session and metrics for one host.
+class _HostSession:
+
+    def __init__(self) -> None:
+        self.Session = requests.Session()
+        # We handle retries ourselves, so the adapter doesn't retry.
+        self.Adapter = HTTPAdapter(pool_connections=1, pool_maxsize=HttpSessions.c_PoolMaxSize, max_retries=0)
+        self.Session.mount("https://", self.Adapter)
+        self.Session.mount("http://", self.Adapter)
+        self.Lock = threading.Lock()
+        self.RequestCount = 0
+        self.ErrorCount = 0
+        self.TotalSec = 0.0
+        self.MaxSec = 0.0
+
+
+    def RecordRequest(self, durationSec:float, failed:bool) -> None:
+        with self.Lock:
+            self.RequestCount += 1
+            if failed:
+                self.ErrorCount += 1
+            self.TotalSec += durationSec
+            self.MaxSec = max(self.MaxSec, durationSec)
+
+
+    def GetStats(self) -> dict:
+        # The number of connections urllib3 had to open, so we can see how well the connections are reused.
+        newConnections = 0
+        try:
+            pools = self.Adapter.poolmanager.pools
+            for key in pools.keys():
+                newConnections += pools[key].num_connections
+        except Exception:
+            newConnections = -1
+        with self.Lock:
+            avgMs = 0.0
+            if self.RequestCount > 0:
+                avgMs = (self.TotalSec / self.RequestCount) * 1000.0
+            return {
+                "Requests": self.RequestCount,
+                "Errors": self.ErrorCount,
+                "NewConnections": newConnections,
+                "AvgMs": round(avgMs, 1),
+                "MaxMs": round(self.MaxSec * 1000.0, 1),
+            }
@@ -0,0 +1,232 @@
+# An incremental parser for multipart mjpeg streams.
+#
+# The stream is read into one bytearray that's reused for every frame, and frames are returned as memoryviews into it,
+# so the frame data isn't copied on the way through the parser. The views are only valid until the next time data is
+# added, callers that want to keep a frame must copy it with bytes().
+#
+# Each part starts with a boundary line and some headers, then the frame. Most streamers send a Content-Length header,
+# which is used if it's there. If it's not, the frame is found by walking the jpeg segments from the SOI marker to
+# the start of the scan data, and then looking for the EOI marker.
+class MjpegParser:
+
+    # The buffer starts at this size and grows if a frame doesn't fit.
+    c_InitialBufferSizeBytes = 256 * 1024
+    # Even a 4K jpeg is a few MB, anything bigger than this is a broken stream.
+    c_MaxBufferSizeBytes = 16 * 1024 * 1024
+    # The most we allow for the headers of one part.
+    c_MaxHeaderSizeBytes = 16 * 1024
+
+    # How much we read at a time when we don't know the size of what's next.
+    # These are small compared to a frame, so a read doesn't block for long waiting on the next frame when the current one is already complete.
+    c_HeaderReadSizeBytes = 512
+    c_ScanReadSizeBytes = 16 * 1024
+
+    c_StateHeaders = 0
+    c_StateBody = 1
+    c_StateScan = 2
+
+    c_JpegEoi = b"\xff\xd9"
+
+
+    def __init__(self, initialBufferSizeBytes:int = c_InitialBufferSizeBytes) -> None:
+        self.Buffer = bytearray(initialBufferSizeBytes)
+        self.View = memoryview(self.Buffer)
+        # The data waiting to be parsed is Buffer[Start:End]
+        self.Start = 0
+        self.End = 0
+        self.State = MjpegParser.c_StateHeaders
+        # For the current part
+        self.ContentType = None
+        self.FrameStart = 0
+        self.FrameSize = 0
+        # Where the EOI search continues from, so the scan data isn't searched again after every read.
+        self.ScanPos = 0
+        # Stats
+        self.FramesParsed = 0
+        self.FramesWithoutLength = 0
+
+
+    # Reads from a stream object that has readinto, like requests' response.raw, until a frame is complete.
+    # Returns (contentType, memoryview) or None if the stream ended.
+    def ReadFrame(self, raw):
+        while True:
+            frame = self.NextFrame()
+            if frame is not None:
+                return frame
+            writeView = self.GetWriteBuffer(self._GetReadSize())
+            read = raw.readinto(writeView)
+            writeView.release()
+            if read is None or read == 0:
+                return None
+            self.Commit(read)
+
+
+    # Copies data into the parser. GetWriteBuffer and Commit avoid this copy.
+    def Feed(self, data) -> None:
+        size = len(data)
+        writeView = self.GetWriteBuffer(size)
+        writeView[:size] = data
+        writeView.release()
+        self.Commit(size)
+
+
+    # Returns a writable memoryview of at least minSize bytes at the end of the buffer.
+    # After writing to it, call Commit with the number of bytes written. Frame views returned before this are no longer valid.
+    def GetWriteBuffer(self, minSize:int) -> memoryview:
+        self._Reserve(minSize)
+        return self.View[self.End:self.End + minSize]
+
+
+    def Commit(self, size:int) -> None:
+        self.End += size
+
+
+    # Returns the next complete frame as (contentType, memoryview), or None if more data is needed.
+    # Throws if the stream isn't a valid mjpeg stream.
+    def NextFrame(self):
+        while True:
+            if self.State == MjpegParser.c_StateHeaders:
+                if self._ParseHeaders() is False:
+                    return None
+            elif self.State == MjpegParser.c_StateBody:
+                if self.End - self.FrameStart < self.FrameSize:
+                    return None
+                return self._FinishFrame(self.FrameStart + self.FrameSize)
+            else:
+                frameEnd = self._ScanForFrameEnd()
+                if frameEnd == -1:
+                    return None
+                self.FramesWithoutLength += 1
+                return self._FinishFrame(frameEnd)
+
+
+    def GetStats(self) -> dict:
+        return {
+            "FramesParsed": self.FramesParsed,
+            "FramesWithoutLength": self.FramesWithoutLength,
+            "BufferSizeBytes": len(self.Buffer),
+        }
+
+
+    # How much to ask the stream for, so we don't block waiting for data past the end of the current frame.
+    def _GetReadSize(self) -> int:
+        if self.State == MjpegParser.c_StateBody:
+            return max(self.FrameStart + self.FrameSize - self.End, 1)
+        if self.State == MjpegParser.c_StateScan:
+            return MjpegParser.c_ScanReadSizeBytes
+        return MjpegParser.c_HeaderReadSizeBytes
+
+
+    def _FinishFrame(self, frameEnd:int):
+        frame = (self.ContentType, self.View[self.FrameStart:frameEnd])
+        self.Start = frameEnd
+        self.State = MjpegParser.c_StateHeaders
+        self.FramesParsed += 1
+        return frame
+
+
+    # Returns False if the headers aren't complete yet.
+    # Example \r\n--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n
+    def _ParseHeaders(self) -> bool:
+        buf = self.Buffer
+        # Skip the line break that ends the last frame.
+        while self.Start < self.End and (buf[self.Start] == 0x0D or buf[self.Start] == 0x0A):
+            self.Start += 1
+        headerEnd = buf.find(b"\r\n\r\n", self.Start, self.End)
+        if headerEnd == -1:
+            if self.End - self.Start > MjpegParser.c_MaxHeaderSizeBytes:
+                raise Exception("The mjpeg part headers are too large, or the stream isn't multipart.")
+            return False
+
+        # The headers are small, so it's fine to copy them to parse them.
+        self.ContentType = None
+        self.FrameSize = 0
+        for line in bytes(self.View[self.Start:headerEnd]).split(b"\r\n"):
+            colon = line.find(b":")
+            if colon == -1:
+                # The boundary line
+                continue
+            name = line[:colon].strip().lower()
+            if name == b"content-type":
+                self.ContentType = line[colon+1:].strip().decode(errors="ignore")
+            elif name == b"content-length":
+                self.FrameSize = int(line[colon+1:].strip())
+        if self.ContentType is None:
+            self.ContentType = "image/jpeg"
+
+        self.FrameStart = headerEnd + 4
+        self.Start = self.FrameStart
+        if self.FrameSize > 0:
+            if self.FrameSize > MjpegParser.c_MaxBufferSizeBytes:
+                raise Exception(f"The mjpeg frame is too large, {self.FrameSize} bytes.")
+            self.State = MjpegParser.c_StateBody
+        else:
+            self.State = MjpegParser.c_StateScan
+            self.ScanPos = -1
+        return True
+
+
+    # Finds the end of the jpeg that starts at FrameStart. Returns the index after the EOI marker, or -1 if more data is needed.
+    def _ScanForFrameEnd(self) -> int:
+        buf = self.Buffer
+        # First, walk the segments until the start of the scan data. The segments before it can contain anything,
+        # including a thumbnail with its own EOI, so we skip over them using their lengths.
+        if self.ScanPos == -1:
+            pos = self.FrameStart
+            if self.End - pos < 2:
+                return -1
+            if buf[pos] != 0xFF or buf[pos+1] != 0xD8:
+                raise Exception("The mjpeg part has no Content-Length and isn't a jpeg.")
+            pos += 2
+            while True:
+                if self.End - pos < 4:
+                    return -1
+                if buf[pos] != 0xFF:
+                    raise Exception("The jpeg segment header didn't start with 0xff.")
+                marker = buf[pos+1]
+                # Fill bytes
+                if marker == 0xFF:
+                    pos += 1
+                    continue
+                segmentLength = (buf[pos+2] << 8) + buf[pos+3]
+                pos += 2 + segmentLength
+                if marker == 0xDA:
+                    break
+            # In the scan data every 0xFF is followed by 0x00 or a restart marker, so the next EOI is the end of the image.
+            self.ScanPos = pos
+        eoi = buf.find(MjpegParser.c_JpegEoi, self.ScanPos, self.End)
+        if eoi == -1:
+            # The marker might be split over the end of the data.
+            self.ScanPos = max(self.ScanPos, self.End - 1)
+            return -1
+        return eoi + 2
+
+
+    # Makes sure there's room for size more bytes after End.
+    def _Reserve(self, size:int) -> None:
+        if len(self.Buffer) - self.End >= size:
+            return
+        pending = self.End - self.Start
+        needed = pending + size
+        if needed <= len(self.Buffer):
+            # Move the pending data to the front. Slice assignment of the same size doesn't resize the bytearray.
+            # The source is copied first since the two ranges can overlap, it's only the start of a frame.
+            self.Buffer[0:pending] = bytes(self.View[self.Start:self.End])
+        else:
+            if needed > MjpegParser.c_MaxBufferSizeBytes:
+                raise Exception(f"The mjpeg parser buffer would be larger than {MjpegParser.c_MaxBufferSizeBytes} bytes.")
+            newSize = len(self.Buffer)
+            while newSize < needed:
+                newSize *= 2
+            newBuffer = bytearray(min(newSize, MjpegParser.c_MaxBufferSizeBytes))
+            newBuffer[0:pending] = self.View[self.Start:self.End]
+            # The old buffer might still have views handed out, so it's replaced rather than resized.
+            self.Buffer = newBuffer
+            self.View = memoryview(newBuffer)
+        # Shift all of the positions the same way.
+        shift = self.Start
+        self.Start = 0
+        self.End = pending
+        self.FrameStart -= shift
+        if self.ScanPos > 0:
+            self.ScanPos -= shift
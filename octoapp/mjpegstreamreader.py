@@ -0,0 +1,222 @@
+import os
+import socket
+import threading
+import time
+from collections import deque
+
+from .sentry import Sentry
+from .octohttprequest import OctoHttpRequest
+from .mjpegparser import MjpegParser
+
+# A frame read from a mjpeg stream.
+class MjpegFrame:
+
+    def __init__(self, contentType:str, body:bytes) -> None:
+        self.CapturedAt = time.monotonic()
+        self.ContentType = contentType
+        self.Body = body
+
+
+# Keeps a mjpeg stream open and reads the frames from it continuously, so a snapshot is always ready.
+#
+# Without a snapshot URL, the only way to get a snapshot is to open the stream, read one frame and close it again.
+# During a print the final snap asks for one every second, which is a new connection to the streamer every second.
+# Instead, while there are consumers the stream stays open, and the last few frames are kept with the time they were read.
+#
+# The reader starts when GetLatestFrame is called, and stops on its own when no one asked for a frame for c_IdleTimeoutSec.
+# If the stream stalls without closing, the read would block until the http timeout, which is very long. So the socket
+# gets a short read timeout, and if a caller waited and there was no new frame for that long, the connection is shut
+# down right away. Either way the reader counts as failed, so callers use the fallback without waiting.
+class MjpegStreamReader:
+
+    # How many of the recent frames we keep.
+    c_FrameBufferSize = 3
+
+    # If no one asked for a frame for this long, the stream is closed.
+    c_IdleTimeoutSec = 10.0
+
+    # If no data arrives for this long, the read fails and the stream is closed.
+    c_ReadTimeoutSec = 10.0
+
+
+    def __init__(self, url:str) -> None:
+        self.Url = url
+        self.Condition = threading.Condition()
+        self.Frames = deque(maxlen=MjpegStreamReader.c_FrameBufferSize)
+        self.Running = False
+        self.LastUsedAt = 0.0
+        # Set when a connection ended without reading any frames, while it was still in use.
+        self.LastFailedAt_CanBeNone = None
+        # Bumped for every connection, so a connection that was given up on can't change the state anymore.
+        self.RunId = 0
+        self.Response_CanBeNone = None
+        # When the current connection was started or last read a frame.
+        self.LastProgressAt = 0.0
+        # Stats
+        self.Connects = 0
+        self.FramesRead = 0
+        self.Stalls = 0
+
+
+    # Returns the newest frame if it's not older than maxAgeSec, otherwise waits up to waitSec for a new one.
+    # Returns None if there's no frame, like if the stream can't be read. This will start the reader if it's not running.
+    # If the stream didn't make any progress for waitSec, it's considered stalled and closed.
+    def GetLatestFrame(self, maxAgeSec:float, waitSec:float) -> MjpegFrame:
+        deadline = time.monotonic() + waitSec
+        stalledResponse = None
+        with self.Condition:
+            self.LastUsedAt = time.monotonic()
+            self._StartUnderLock()
+            while True:
+                now = time.monotonic()
+                if len(self.Frames) > 0 and now - self.Frames[-1].CapturedAt <= maxAgeSec:
+                    return self.Frames[-1]
+                if self.Running is False:
+                    return None
+                if now >= deadline:
+                    if now - self.LastProgressAt >= waitSec:
+                        stalledResponse = self._AbandonConnectionUnderLock()
+                    break
+                self.Condition.wait(deadline - now)
+        if stalledResponse is not None:
+            # Closing the response would wait on the lock the blocked read holds, but shutting down the socket
+            # makes the read return right away, so the reader thread ends.
+            try:
+                MjpegStreamReader._ShutdownSocket(stalledResponse)
+            except Exception as e:
+                Sentry.ExceptionNoSend("Mjpeg stream reader failed to shut down the stalled stream", e)
+        return None
+
+
+    # Returns the recent frames, oldest first.
+    def GetRecentFrames(self) -> list:
+        with self.Condition:
+            return list(self.Frames)
+
+
+    def IsRunning(self) -> bool:
+        return self.Running
+
+
+    # Returns True if the last connection couldn't read any frames and that was less than withinSec ago.
+    def HasFailedWithin(self, withinSec:float) -> bool:
+        failedAt = self.LastFailedAt_CanBeNone
+        return failedAt is not None and time.monotonic() - failedAt < withinSec
+
+
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return {
+                "Running": self.Running,
+                "Connects": self.Connects,
+                "FramesRead": self.FramesRead,
+                "Stalls": self.Stalls,
+            }
+
+
+    def _StartUnderLock(self) -> None:
+        if self.Running:
+            return
+        self.Running = True
+        self.Connects += 1
+        self.RunId += 1
+        self.Response_CanBeNone = None
+        self.LastProgressAt = time.monotonic()
+        t = threading.Thread(target=self._Run, args=(self.RunId,), name="MjpegStreamReader")
+        t.daemon = True
+        t.start()
+
+
+    # Gives up on the current connection, and returns the response to close, if there is one.
+    # The reader thread might stay blocked for a bit, but since the run id changed it won't touch the state anymore.
+    def _AbandonConnectionUnderLock(self):
+        Sentry.Warn("Webcam Helper", f"Mjpeg stream reader didn't get a frame for too long, closing the stream for {self.Url}")
+        self.Stalls += 1
+        self.RunId += 1
+        self.Running = False
+        self.LastFailedAt_CanBeNone = time.monotonic()
+        response = self.Response_CanBeNone
+        self.Response_CanBeNone = None
+        self.Condition.notify_all()
+        return response
+
+
+    # requests doesn't expose the socket, so we get it from the urllib3 connection. Returns None if it can't be found.
+    # If the server closes the connection to end the response, which most mjpeg streams do, http.client hands the
+    # socket to the response and the connection doesn't have it anymore.
+    @staticmethod
+    def _GetSocket(response):
+        connection = getattr(response.raw, "connection", None)
+        return getattr(connection, "sock", None)
+
+
+    # Shuts down the socket the response is read from, so any blocked read returns.
+    @staticmethod
+    def _ShutdownSocket(response) -> None:
+        sock = MjpegStreamReader._GetSocket(response)
+        if sock is not None:
+            sock.shutdown(socket.SHUT_RDWR)
+            return
+        # The response still has the socket, but only exposes the file descriptor. Shutting down a duplicate of it
+        # shuts down the connection, and closing the duplicate leaves the response's own socket alone.
+        with socket.socket(fileno=os.dup(response.raw.fileno())) as dup:
+            dup.shutdown(socket.SHUT_RDWR)
+
+
+    def _IsIdle(self) -> bool:
+        return time.monotonic() - self.LastUsedAt > MjpegStreamReader.c_IdleTimeoutSec
+
+
+    def _Run(self, runId:int) -> None:
+        framesRead = 0
+        failed = False
+        try:
+            Sentry.Debug("Webcam Helper", f"Opening the mjpeg stream reader for {self.Url}")
+            octoHttpResult = OctoHttpRequest.MakeHttpCall(Sentry.Logger, self.Url, OctoHttpRequest.GetPathType(self.Url), "GET", {}, allowRedirects=True, timeoutSec=MjpegStreamReader.c_ReadTimeoutSec)
+            if octoHttpResult is None or octoHttpResult.Result is None:
+                Sentry.Debug("Webcam Helper", "Mjpeg stream reader failed to make the web request.")
+                return
+            response = octoHttpResult.Result
+            with self.Condition:
+                if runId != self.RunId:
+                    response.close()
+                    return
+                self.Response_CanBeNone = response
+            with response:
+                if response.status_code != 200:
+                    Sentry.Info("Webcam Helper", "Mjpeg stream reader got a bad status: "+str(response.status_code))
+                    return
+                contentType = response.headers.get("content-type", "")
+                if contentType.lower().startswith("multipart/") is False:
+                    Sentry.Info("Webcam Helper", "Mjpeg stream reader got the wrong content type: "+str(contentType))
+                    return
+
+                # The parser reuses its buffer, so each frame is copied once, into the frame we keep.
+                parser = MjpegParser()
+                while self._IsIdle() is False:
+                    parsed = parser.ReadFrame(response.raw)
+                    if parsed is None:
+                        return
+                    contentType, body = parsed
+                    frame = MjpegFrame(contentType, bytes(body))
+                    framesRead += 1
+                    with self.Condition:
+                        if runId != self.RunId:
+                            return
+                        self.Frames.append(frame)
+                        self.FramesRead += 1
+                        self.LastProgressAt = time.monotonic()
+                        self.Condition.notify_all()
+                Sentry.Debug("Webcam Helper", f"Mjpeg stream reader is idle, closing the stream for {self.Url}")
+        except Exception as e:
+            # If the stream was shut down because it stalled, this is expected.
+            failed = True
+            if runId == self.RunId:
+                Sentry.ExceptionNoSend("Mjpeg stream reader failed", e)
+        finally:
+            with self.Condition:
+                if runId == self.RunId:
+                    self.Running = False
+                    self.Response_CanBeNone = None
+                    self.LastFailedAt_CanBeNone = time.monotonic() if framesRead == 0 or failed else None
+                    self.Condition.notify_all()
@@ -0,0 +1,220 @@
+import heapq
+import threading
+import time
+
+from .sentry import Sentry
+from .Proto.MessagePriority import MessagePriority
+
+# A notification event waiting to be sent.
+class QueuedNotificationEvent:
+
+    def __init__(self, event:str, args, progressOverwriteFloat, useFinalSnapSnapshot:bool, printId:str, priority:int, seq:int) -> None:
+        self.Event = event
+        self.Args = args
+        self.ProgressOverwriteFloat = progressOverwriteFloat
+        self.UseFinalSnapSnapshot = useFinalSnapSnapshot
+        self.PrintId = printId
+        self.Priority = priority
+        self.Seq = seq
+        # The event isn't sent before this time, in time.monotonic. Used to delay retries without holding a worker.
+        self.NotBefore = 0.0
+        # How many times we tried to send this event.
+        self.Attempts = 0
+        # The request args are built on the first attempt and then reused for the retries.
+        self.RequestArgs_CanBeNone = None
+        # If the event is in the outbox, this is its entry id.
+        self.OutboxId_CanBeNone = None
+        # Set when a newer version of a collapsible event replaced this one while it was waiting to retry.
+        self.Superseded = False
+        self.EnqueuedAt = time.time()
+        # Used for the latency tracing, since the wall clock can jump.
+        self.EnqueuedAtMonotonic = time.monotonic()
+
+
+# Sends the notification events on a fixed number of worker threads.
+#
+# Events are sent in priority order, using the Proto.MessagePriority levels, so things like done, error and paused
+# are sent before any progress updates that are waiting. Events of the same priority are sent in the order they were added.
+#
+# Some events, like progress, only matter as the latest value. If one of those is still waiting when a newer one
+# for the same print is added, the waiting one is updated instead of adding another.
+#
+# Retries don't hold a worker. The send function returns how long to wait before the next attempt, and the event
+# goes into a retry heap ordered by due time. The workers wait on the earliest due time, so there's one timer for all retries.
+#
+# Sending can hold a worker for a while, like when the push is waiting for others to batch with. So on top of the normal
+# workers there's a reserved one that only sends critical events, so done, error and the like never wait behind those.
+class NotificationEventQueue:
+
+    c_DefaultWorkerCount = 2
+
+    # The reserved worker only sends events with this priority or higher.
+    c_ReservedWorkerMaxPriority = MessagePriority.Critical
+
+    # If this many events are waiting to be sent, the oldest lowest priority one is dropped to make room.
+    c_MaxQueuedEvents = 100
+
+    # sendFunc(QueuedNotificationEvent) is called on a worker thread. It must return None when the event is done,
+    # sent or given up on, or the number of seconds to wait before it should be tried again.
+    # collapsibleEvents is a set of event names where only the latest waiting event per print matters.
+    # If set, discardFunc(QueuedNotificationEvent) is called for events that are dropped or superseded without being sent.
+    def __init__(self, sendFunc, collapsibleEvents:set, workerCount:int = c_DefaultWorkerCount, discardFunc = None) -> None:
+        self.SendFunc = sendFunc
+        self.DiscardFunc_CanBeNone = discardFunc
+        self.CollapsibleEvents = collapsibleEvents
+        self.Condition = threading.Condition()
+        # Events that can be sent now.
+        self.Items = []
+        # Events waiting for a retry, a heap of (NotBefore, Seq, QueuedNotificationEvent)
+        self.RetryHeap = []
+        self.SeqCounter = 0
+        # Metrics
+        self.EnqueuedCount = 0
+        self.CollapsedCount = 0
+        self.DroppedCount = 0
+        self.RetryCount = 0
+        self.SentCount = 0
+
+        for i in range(workerCount):
+            t = threading.Thread(target=self._Worker, name=f"NotificationEventWorker-{i}")
+            t.daemon = True
+            t.start()
+        t = threading.Thread(target=self._Worker, args=(NotificationEventQueue.c_ReservedWorkerMaxPriority,), name="NotificationEventWorker-Critical")
+        t.daemon = True
+        t.start()
+
+
+    # Adds an event to the queue. This never blocks.
+    def Put(self, event:str, args, progressOverwriteFloat, useFinalSnapSnapshot:bool, printId:str, priority:int = MessagePriority.Normal) -> None:
+        discarded = []
+        with self.Condition:
+            self.EnqueuedCount += 1
+            if event in self.CollapsibleEvents:
+                for item in self.Items:
+                    if item.Event == event and item.PrintId == printId:
+                        # Replace the waiting event with the newest values. It keeps its place in the queue.
+                        # If the old values were already built and put in the outbox, the new ones will supersede them when they are.
+                        item.Args = args
+                        item.ProgressOverwriteFloat = progressOverwriteFloat
+                        item.UseFinalSnapSnapshot = useFinalSnapSnapshot
+                        item.RequestArgs_CanBeNone = None
+                        self.CollapsedCount += 1
+                        self.Condition.notify()
+                        return
+                # If an older one is waiting to retry, this one replaces it.
+                for (_, _, item) in self.RetryHeap:
+                    if item.Event == event and item.PrintId == printId and item.Superseded is False:
+                        item.Superseded = True
+                        self.CollapsedCount += 1
+
+            self.SeqCounter += 1
+            self._AddUnderLock(QueuedNotificationEvent(event, args, progressOverwriteFloat, useFinalSnapSnapshot, printId, priority, self.SeqCounter), discarded)
+        self._Discard(discarded)
+
+
+    # Adds an event that was restored from the outbox. The request args were already built when it was first queued.
+    def PutRestored(self, event:str, requestArgs, printId:str, priority:int, attempts:int, outboxId:str) -> None:
+        discarded = []
+        with self.Condition:
+            self.EnqueuedCount += 1
+            self.SeqCounter += 1
+            item = QueuedNotificationEvent(event, None, None, False, printId, priority, self.SeqCounter)
+            item.RequestArgs_CanBeNone = requestArgs
+            item.Attempts = attempts
+            item.OutboxId_CanBeNone = outboxId
+            self._AddUnderLock(item, discarded)
+        self._Discard(discarded)
+
+
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return {
+                "Depth": len(self.Items),
+                "WaitingForRetry": len([i for (_, _, i) in self.RetryHeap if i.Superseded is False]),
+                "Enqueued": self.EnqueuedCount,
+                "Collapsed": self.CollapsedCount,
+                "Dropped": self.DroppedCount,
+                "Retries": self.RetryCount,
+                "Sent": self.SentCount,
+            }
+
+
+    # Must be called under lock. Any events that are dropped to make room are added to the discarded list.
+    def _AddUnderLock(self, item:QueuedNotificationEvent, discarded:list) -> None:
+        if len(self.Items) >= NotificationEventQueue.c_MaxQueuedEvents:
+            # Drop the least important event, the oldest of the lowest priority.
+            victim = max(self.Items, key=lambda i: (i.Priority, -i.Seq))
+            self.Items.remove(victim)
+            self.DroppedCount += 1
+            discarded.append(victim)
+            Sentry.Warn("NOTIFICATION", f"Notification event queue is full, dropping a waiting {victim.Event} event.")
+        self.Items.append(item)
+        # Not all workers can send every event, so wake them all.
+        self.Condition.notify_all()
+
+
+    def _Discard(self, discarded:list) -> None:
+        if self.DiscardFunc_CanBeNone is None:
+            return
+        for item in discarded:
+            try:
+                self.DiscardFunc_CanBeNone(item)
+            except Exception as e:
+                Sentry.Exception("NotificationEventQueue discard callback failed.", e)
+
+
+    # Blocks until there's an event that's ready to send and returns it.
+    # If maxPriority is set, only events with that priority or higher are returned.
+    # Any events that were superseded while waiting to retry are added to the discarded list.
+    def _Get(self, discarded:list, maxPriority:int = None) -> QueuedNotificationEvent:
+        with self.Condition:
+            while True:
+                # Move any retries that are due into the ready list.
+                now = time.monotonic()
+                while len(self.RetryHeap) > 0 and self.RetryHeap[0][0] <= now:
+                    _, _, item = heapq.heappop(self.RetryHeap)
+                    if item.Superseded:
+                        discarded.append(item)
+                        continue
+                    self.Items.append(item)
+
+                if len(self.Items) > 0:
+                    best = min(self.Items, key=lambda i: (i.Priority, i.Seq))
+                    if maxPriority is None or best.Priority <= maxPriority:
+                        self.Items.remove(best)
+                        return best
+
+                # Wait for a new event, or until the next retry is due.
+                timeoutSec = None
+                if len(self.RetryHeap) > 0:
+                    timeoutSec = max(self.RetryHeap[0][0] - now, 0.01)
+                self.Condition.wait(timeoutSec)
+
+
+    def _Worker(self, maxPriority:int = None):
+        while True:
+            discarded = []
+            item = self._Get(discarded, maxPriority)
+            self._Discard(discarded)
+            retryDelaySec = None
+            try:
+                item.Attempts += 1
+                retryDelaySec = self.SendFunc(item)
+            except Exception as e:
+                Sentry.Exception("NotificationEventQueue failed to send event "+str(item.Event), e)
+            with self.Condition:
+                if retryDelaySec is None:
+                    self.SentCount += 1
+                    continue
+                # If a newer version of a collapsible event was added while we were sending, that one wins.
+                superseded = False
+                if item.Event in self.CollapsibleEvents:
+                    superseded = any(i.Event == item.Event and i.PrintId == item.PrintId for i in self.Items)
+                if superseded is False:
+                    # Put it in the retry heap, to be tried again later.
+                    self.RetryCount += 1
+                    item.NotBefore = time.monotonic() + retryDelaySec
+                    heapq.heappush(self.RetryHeap, (item.NotBefore, item.Seq, item))
+                    self.Condition.notify_all()
+                    continue
+            self._Discard([item])
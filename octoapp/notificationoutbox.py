@@ -0,0 +1,168 @@
+import os
+import json
+import time
+import uuid
+import threading
+
+from .sentry import Sentry
+
+# A small on-disk outbox for notification events, so the ones that haven't been sent yet survive a restart.
+#
+# The outbox is an append only log of json lines in the plugin data folder. Adding an event writes an "add" record,
+# and when the event is sent or given up on a "done" record is written. On load, the log is replayed to find the events
+# that are still pending, and then it's rewritten with only those, so it never grows for long.
+#
+# For events where only the latest one matters, like progress, adding one supersedes any older pending entry
+# for the same event and print.
+class NotificationOutbox:
+
+    c_FileName = "notification_outbox.jsonl"
+
+    # Pending events older than this are dropped on load, they aren't useful anymore.
+    c_MaxEntryAgeSec = 60 * 60
+
+    # Once the log has this many records that aren't needed anymore, it's rewritten.
+    c_CompactAfterDeadRecords = 200
+
+
+    def __init__(self, dataDir:str, supersedingEvents:set) -> None:
+        self.FilePath = os.path.join(dataDir, NotificationOutbox.c_FileName)
+        self.SupersedingEvents = supersedingEvents
+        self.Lock = threading.Lock()
+        # Entry id -> entry dict, for all pending entries.
+        self.Entries = {}
+        self.DeadRecordCount = 0
+
+
+    # Loads the pending entries from disk and compacts the log.
+    # Returns the pending entries, oldest first. Each entry is a dict with Id, Event, PrintId, Priority, Args, Attempts and CreatedAt.
+    def Load(self) -> list:
+        with self.Lock:
+            self.Entries = {}
+            try:
+                if os.path.isfile(self.FilePath):
+                    with open(self.FilePath, "r", encoding="utf-8") as f:
+                        for line in f:
+                            line = line.strip()
+                            if len(line) == 0:
+                                continue
+                            try:
+                                self._ApplyRecordUnderLock(json.loads(line))
+                            except Exception as e:
+                                # A partial last line can happen if we were killed while writing, skip it.
+                                Sentry.Warn("OUTBOX", "Skipping a bad notification outbox record. "+str(e))
+            except Exception as e:
+                Sentry.ExceptionNoSend("Failed to load the notification outbox", e)
+
+            # Drop anything that's too old to matter.
+            now = time.time()
+            for entryId in [k for k, v in self.Entries.items() if now - v["CreatedAt"] > NotificationOutbox.c_MaxEntryAgeSec]:
+                Sentry.Info("OUTBOX", "Dropping expired notification outbox entry "+self.Entries[entryId]["Event"])
+                del self.Entries[entryId]
+
+            self._CompactUnderLock()
+            entries = sorted(self.Entries.values(), key=lambda e: e["CreatedAt"])
+        if len(entries) > 0:
+            Sentry.Info("OUTBOX", f"Loaded {len(entries)} pending notification events from the outbox.")
+        return entries
+
+
+    # Adds a new pending event and returns its id.
+    def Add(self, event:str, printId:str, priority:int, args:dict, attempts:int) -> str:
+        entry = {
+            "Id": uuid.uuid4().hex,
+            "Event": event,
+            "PrintId": printId,
+            "Priority": priority,
+            "Args": args,
+            "Attempts": attempts,
+            "CreatedAt": time.time(),
+        }
+        with self.Lock:
+            records = []
+            if event in self.SupersedingEvents:
+                for old in list(self.Entries.values()):
+                    if old["Event"] == event and old["PrintId"] == printId:
+                        records.append({"Op": "done", "Id": old["Id"]})
+            records.append({"Op": "add", "Entry": entry})
+            for r in records:
+                self._ApplyRecordUnderLock(r)
+            self._AppendUnderLock(records)
+        return entry["Id"]
+
+
+    # Records a send attempt for a pending entry.
+    def RecordAttempt(self, entryId:str, attempts:int) -> None:
+        with self.Lock:
+            if entryId not in self.Entries:
+                return
+            record = {"Op": "attempt", "Id": entryId, "Attempts": attempts}
+            self._ApplyRecordUnderLock(record)
+            self._AppendUnderLock([record])
+
+
+    # Removes an entry, when it was sent or given up on.
+    def Remove(self, entryId:str) -> None:
+        with self.Lock:
+            if entryId not in self.Entries:
+                return
+            record = {"Op": "done", "Id": entryId}
+            self._ApplyRecordUnderLock(record)
+            self._AppendUnderLock([record])
+            if self.DeadRecordCount >= NotificationOutbox.c_CompactAfterDeadRecords:
+                self._CompactUnderLock()
+
+
+    # Returns the outbox depth and the age of the oldest pending entry.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            oldestAgeSec = 0.0
+            if len(self.Entries) > 0:
+                oldestAgeSec = time.time() - min(e["CreatedAt"] for e in self.Entries.values())
+            return {
+                "Depth": len(self.Entries),
+                "OldestAgeSec": round(oldestAgeSec, 1),
+                "DeadRecords": self.DeadRecordCount,
+            }
+
+
+    # Must be called under lock.
+    def _ApplyRecordUnderLock(self, record:dict) -> None:
+        op = record["Op"]
+        if op == "add":
+            entry = record["Entry"]
+            self.Entries[entry["Id"]] = entry
+        elif op == "attempt":
+            entry = self.Entries.get(record["Id"], None)
+            if entry is not None:
+                entry["Attempts"] = record["Attempts"]
+            self.DeadRecordCount += 1
+        elif op == "done":
+            if self.Entries.pop(record["Id"], None) is not None:
+                # Both the add and the done record are dead now.
+                self.DeadRecordCount += 2
+
+
+    # Must be called under lock.
+    def _AppendUnderLock(self, records:list) -> None:
+        try:
+            with open(self.FilePath, "a", encoding="utf-8") as f:
+                for r in records:
+                    f.write(json.dumps(r, default=str))
+                    f.write("\n")
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to write to the notification outbox", e)
+
+
+    # Rewrites the log with only the pending entries. Must be called under lock.
+    def _CompactUnderLock(self) -> None:
+        try:
+            tmpPath = self.FilePath + ".tmp"
+            with open(tmpPath, "w", encoding="utf-8") as f:
+                for entry in sorted(self.Entries.values(), key=lambda e: e["CreatedAt"]):
+                    f.write(json.dumps({"Op": "add", "Entry": entry}, default=str))
+                    f.write("\n")
+            os.replace(tmpPath, self.FilePath)
+            self.DeadRecordCount = 0
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to compact the notification outbox", e)
@@ -4,10 +4,14 @@ import requests
 import json
 import time
 import sys
+import os
 import base64
 import hashlib
 from .sentry import Sentry
 from .appsstorage import AppStorageHelper
+from .httpsessions import HttpSessions
+from .pushbatcher import PushBatcher
+from .taskscheduler import TaskScheduler
 
 class NotificationSender:
 
@@ -27,6 +31,15 @@ class NotificationSender:
     EVENT_THIRD_LAYER_DONE="third_layer_done"
     EVENT_FIRST_LAYER_DONE="first_layer_done"
 
+    # These are always sent right away, they never wait in the batching window.
+    c_ImmediateEvents = {EVENT_DONE, EVENT_ERROR, EVENT_CANCELLED}
+
+    # These only carry the current print state, so a newer one in the same batch replaces them.
+    c_StateUpdateEvents = {EVENT_PROGRESS, EVENT_TIME_PROGRESS}
+
+    # The batching window can't be set larger than this by the remote config.
+    c_MaxBatchWindowMs = 2000
+
 
     def __init__(self):
         self.LastPrintState = {}
@@ -38,13 +51,19 @@ class NotificationSender:
             highPrecisionRangeEnd=5,
             minIntervalSecs=300,
             sendNotificationUrl="https://europe-west1-octoapp-4e438.cloudfunctions.net/sendNotificationV2",
+            # Pushes for the same targets within this window are sent in one request. 0 disables batching.
+            batchWindowMs=0,
         )
         self.CachedConfig = self.DefaultConfig
         self.CachedConfigAt = 0
-        self._continuouslyCheckActivitiesExpired()
+        self.PushBatcher = PushBatcher(self._postNotification)
+        self._watchAppsExpired()
         self._continuouslyUpdateConfig()
 
-    def SendNotification(self, event, state=None):
+    # Returns False if the notification failed to send and should be tried again, otherwise True.
+    # Having nothing to send, like no targets, counts as done.
+    # If a NotificationTrace is given, the end of each stage is marked on it.
+    def SendNotification(self, event, state=None, trace=None) -> bool:
         try:
             if state is None:
                 state = self.LastPrintState
@@ -67,34 +86,50 @@ class NotificationSender:
 
             if not targets:
                 Sentry.Debug("SENDER", "No targets, skipping notification")
-                return
+                return True
                 
             targets = self._processFilters(targets=targets, event=event)
             ios_targets = helper.GetIosApps(targets)
             activity_targets = helper.GetActivities(targets)
             android_targets = helper.GetAndroidApps(targets)
+            if trace is not None:
+                trace.Mark("targets")
             apnsData = self._createApnsPushData(event, state) if len(ios_targets) or len(activity_targets) else None
+            if trace is not None:
+                trace.Mark("apns_data")
 
             if not len(android_targets) and apnsData is None:
                 Sentry.Info("SENDER", "Skipping push, no Android targets and no APNS data, skipping notification")
-                return
+                return True
             
             if not len(android_targets) and not len(activity_targets) and apnsData.get("alert", None) is None:
                 Sentry.Info("SENDER", "Skipping push, no Android targets, no iOS targets and APNS data has no alert, skipping notification")
-                return
+                return True
+
+            androidData = self._createAndroidPushData(event, state)
+            if trace is not None:
+                trace.Mark("android_data")
 
-            self._doSendNotification(
+            sent = self._doSendNotification(
                 targets=targets,
                 highProiroty=not onlyActivities,
                 apnsData=apnsData,
-                androidData=self._createAndroidPushData(event, state)
+                androidData=androidData,
+                event=event
             )
+            # This includes the time waiting in the batch window, if batching is on.
+            if trace is not None:
+                trace.Mark("post")
+            if sent is False:
+                return False
 
             # Remove temporary apps after getting targets
             if event == self.EVENT_CANCELLED or event == self.EVENT_DONE:
                 helper.RemoveTemporaryApps()
+            return True
         except Exception as e:
             Sentry.ExceptionNoSend("Failed to send notification", e)
+        return False
     
     def _shouldSendOnlyActivities(self, event, state):
         if event == self.EVENT_STARTED:
@@ -143,12 +178,44 @@ class NotificationSender:
     
         return list(filter(lambda target: filterName not in target.ExcludeNotifications, targets))
 
-    def _doSendNotification(self, targets, highProiroty, apnsData, androidData):
-        try:
-            if not len(targets): 
-                Sentry.Info("SENDER", "No targets, skipping send")
-                return
+    # Returns False if the send failed in a way that might work if tried again, otherwise True.
+    # If the event is given and batching is enabled, the push might be sent together with others for the same targets.
+    def _doSendNotification(self, targets, highProiroty, apnsData, androidData, event=None) -> bool:
+        if not len(targets): 
+            Sentry.Info("SENDER", "No targets, skipping send")
+            return True
+
+        payload = dict(
+            highPriority=highProiroty,
+            androidData=androidData,
+            apnsData=apnsData,
+            isStateUpdate=event in self.c_StateUpdateEvents,
+        )
+        batchWindowSec = self._getBatchWindowSec()
+        if event is None or event in self.c_ImmediateEvents or batchWindowSec <= 0:
+            return self._postNotification(targets, [payload])
+        # All state updates are the same kind, so a progress and a time progress update can be merged.
+        kind = "state" if payload["isStateUpdate"] else event
+        return self.PushBatcher.Send(targets, payload, batchWindowSec, kind)
 
+
+    # Returns the batching window from the remote config, in seconds.
+    def _getBatchWindowSec(self) -> float:
+        try:
+            windowMs = float(self.CachedConfig.get("batchWindowMs", 0) or 0)
+            return max(0.0, min(windowMs, self.c_MaxBatchWindowMs)) / 1000.0
+        except Exception:
+            return 0.0
+
+
+    # Sends one request with all of the payloads for the targets.
+    # If there's more than one payload, the newest is used for the top level fields, so the request is still valid
+    # for a server that doesn't know about the batch list, and all of them are in the batch list.
+    # The PushBatcher only merges payloads of the same kind, so the newest one is always a fine stand in for the rest.
+    # Returns False if the send failed in a way that might work if tried again, otherwise True.
+    def _postNotification(self, targets, payloads) -> bool:
+        try:
+            newest = payloads[-1]
             # Base priority on onlyActivities. If the flag is set this is a low
             # priority status update
             body = dict(
@@ -157,34 +224,52 @@ class NotificationSender:
                     "fcmTokenFallback": x.FcmFallbackToken,
                     "instanceId": x.InstanceId
                 }, targets)),
-                highPriority=highProiroty,
-                androidData=androidData,
-                apnsData=apnsData,
+                highPriority=any(p["highPriority"] for p in payloads),
+                androidData=newest["androidData"],
+                apnsData=newest["apnsData"],
             )
+            if len(payloads) > 1:
+                body["batch"] = list(map(lambda p: {
+                    "highPriority": p["highPriority"],
+                    "androidData": p["androidData"],
+                    "apnsData": p["apnsData"],
+                }, payloads))
 
-            Sentry.Info("SENDER", "Sending notification: %s" % json.dumps(body))
+            # Serialize once, for the log and the request.
+            bodyJson = json.dumps(body)
+            Sentry.Info("SENDER", "Sending notification: %s" % bodyJson)
 
             # Make request and check 200
-            r = requests.post(
+            r = HttpSessions.Get().Post(
                 self.CachedConfig["sendNotificationUrl"],
-                timeout=float(10), 
-                json=body
+                timeout=(5.0, 10.0),
+                data=bodyJson.encode("utf-8"),
+                headers={"Content-Type": "application/json"}
             )
+            # The 400 class errors mean something is wrong with the request, which won't change if we try again.
+            if r.status_code > 399 and r.status_code < 500:
+                Sentry.Error("SENDER", "Notification rejected with response code %d: %s" % (r.status_code, r.text))
+                return True
             if r.status_code != requests.codes.ok:
                 raise Exception("Unexpected response code %d: %s" % (r.status_code, r.text))
             else:
                 Sentry.Info("SENDER", "Send to %s was success %s" % (len(targets), r.json()))
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to send notification %s", e)
+            return False
 
+        # The notification is sent, so a failure from here on must not cause a retry.
+        try:
             # Delete invalid tokens
-            apps = AppStorageHelper.Get().GetAllApps()
             invalid_tokens = r.json()["invalidTokens"]
-            for fcmToken in invalid_tokens:
-                Sentry.Info("SENDER", "Removing %s, no longer valid" % fcmToken)
-                apps = [app for app in apps if app.FcmToken == fcmToken or app.FcmFallbackToken == fcmToken]
-                AppStorageHelper.Get().RemoveApps(apps)
-
+            if len(invalid_tokens):
+                Sentry.Info("SENDER", "Removing %s, no longer valid" % invalid_tokens)
+                apps = AppStorageHelper.Get().FindAppsByTokens(invalid_tokens)
+                if len(apps):
+                    AppStorageHelper.Get().RemoveApps(apps)
         except Exception as e:
-            Sentry.ExceptionNoSend("Failed to send notification %s", e)
+            Sentry.ExceptionNoSend("Failed to remove invalid tokens", e)
+        return True
 
     def _createAndroidPushData(self, event, state):
         data = {}
@@ -225,15 +310,15 @@ class NotificationSender:
                 "type": type
             }
 
+        # Serialize once, the same string is encrypted or sent as is.
+        dataJson = json.dumps(data)
         try:
-            cipher = AESCipher(AppStorageHelper.Get().GetOrCreateEncryptionKey())
-            if cipher.prepare():
-                return cipher.encrypt(json.dumps(data))
-            else:
-                return json.dumps(data)
+            if AESCipher.IsAvailable() is False:
+                return dataJson
+            return AESCipher.ForKey(AppStorageHelper.Get().GetOrCreateEncryptionKey()).encrypt(dataJson)
         except Exception as e:
             Sentry.ExceptionNoSend("Failed to encrypt push notification", e)
-            return json.dumps(data)
+            return dataJson
         
     
     def _createApnsPushData(self, event, state):
@@ -405,92 +490,50 @@ class NotificationSender:
 
     def _getPushTargets(self, preferActivity, canUseNonActivity):
         Sentry.Info("SENDER", "Finding targets preferActivity=%s canUseNonActivity=%s" % (preferActivity, canUseNonActivity))
+        return AppStorageHelper.Get().GetPushTargets(preferActivity=preferActivity, canUseNonActivity=canUseNonActivity)
+
+
+    def _watchAppsExpired(self):
         helper = AppStorageHelper.Get()
-        apps = helper.GetAllApps()
-        phones = {}
-
-        # Group all apps by phone
-        for app in apps:
-            instance_id = app.InstanceId
-            phone = phones.get(instance_id, [])
-            phone.append(app)
-            phones[instance_id] = phone
-
-        # Pick activity if available, otherwise any other app
-        def pick_best_app(apps):
-            activities = helper.GetActivities(apps)
-            ios = helper.GetIosApps(apps)
-            android = helper.GetAndroidApps(apps)
-
-            # If we have an activity and we should prefer it, use it
-            if len(activities) and preferActivity:
-                return activities[0:1]
-            
-            # If we have an iOS app and we can use non-activity targets, use it
-            # This means iOS might not be picked at all if we only can use activity but no activity is available!
-            elif len(ios) and canUseNonActivity:
-                return ios[0:1]
-
-            # If we have any android devices, use all of them (might be watch + phone)
-            elif len(android):
-                return android
-            
-            # Oh no!
-            else:
-                return []
+        if helper is None:
+            Sentry.Warn("SENDER", "No app storage, not checking for expired apps")
+            return
+        Sentry.Debug("SENDER", "Checking for expired apps when they expire")
+        helper.SetAppsExpiredListener(self._onAppsExpired)
 
-        # Get apps per phone and flatten
-        apps = list(map(lambda phone: pick_best_app(phone), phones.values()))
-        apps = [app for sublist in apps for app in sublist]
-        return list(filter(lambda app: app is not None, apps))
+    def _onAppsExpired(self, expired):
+        try:
+            helper = AppStorageHelper.Get()
+            if len(expired):
+                Sentry.Debug("SENDER", "Found %s expired apps" % len(expired))
+                helper.LogApps()
+
+                expired_activities = helper.GetActivities(expired)
+                if len(expired_activities):
+                    # This will end the live activity, we currently do not send a notification to inform
+                    # the user, we can do so by setting isEnd=False and the apnsData as below
+                    apnsData=self._createActivityContentState(
+                        isEnd=True,
+                        liveActivityState="expired",
+                        state=self.LastPrintState
+                    )
+                    # apnsData["alert"] = {
+                    #     "title": "Updates paused for %s" % self.LastPrintState.get("name", ""),
+                    #     "body": "Live activities expire after 8h, open OctoApp to renew"
+                    # }
+                    self._doSendNotification(
+                        targets=expired_activities,
+                        highProiroty=True,
+                        apnsData=apnsData,
+                        androidData="none"
+                    )
+
+                helper.RemoveApps(expired)
+                Sentry.Debug("SENDER", "Cleaned up expired apps")
 
 
-    def _continuouslyCheckActivitiesExpired(self):
-        t = threading.Thread(
-            target=self._doContinuouslyCheckActivitiesExpired,
-            args=[]
-        )
-        t.daemon = True
-        t.start()
-
-    def _doContinuouslyCheckActivitiesExpired(self):
-         Sentry.Debug("SENDER", "Checking for expired apps every 60s")
-         while True:
-            time.sleep(60)
-
-            try:
-                helper = AppStorageHelper.Get()
-                expired = helper.GetExpiredApps(helper.GetAllApps())
-                if len(expired):
-                    Sentry.Debug("SENDER", "Found %s expired apps" % len(expired))
-                    helper.LogApps()
-
-                    expired_activities = helper.GetActivities(expired)
-                    if len(expired_activities):
-                        # This will end the live activity, we currently do not send a notification to inform
-                        # the user, we can do so by setting isEnd=False and the apnsData as below
-                        apnsData=self._createActivityContentState(
-                            isEnd=True,
-                            liveActivityState="expired",
-                            state=self.LastPrintState
-                        )
-                        # apnsData["alert"] = {
-                        #     "title": "Updates paused for %s" % self.LastPrintState.get("name", ""),
-                        #     "body": "Live activities expire after 8h, open OctoApp to renew"
-                        # }
-                        self._doSendNotification(
-                            targets=expired_activities,
-                            highProiroty=True,
-                            apnsData=apnsData,
-                            androidData="none"
-                        )
-
-                    helper.RemoveApps(expired)
-                    Sentry.Debug("SENDER", "Cleaned up expired apps")
-
-
-            except Exception as e:
-                Sentry.ExceptionNoSend("Failed to retire expired", e)
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to retire expired", e)
 
 
     #
@@ -499,63 +542,87 @@ class NotificationSender:
 
     def _continuouslyUpdateConfig(self):
         Sentry.Info("SENDER", "Updating config")
-        t = threading.Thread(target=self._doContinuouslyUpdateConfig)
-        t.daemon = True
-        t.start()
-
-    def _doContinuouslyUpdateConfig(self):
-        while True:
-            time.sleep(3600)
-            # If we have no config cached or the cache is older than a day, request new config
-            cache_config_max_age = time.time() - 86400
-            if self.CachedConfigAt > cache_config_max_age:
-                Sentry.Info("SENDER", "Config still valid")
-
-            # Request config, fall back to default
-            try:
-                r = requests.get(
-                    "https://www.octoapp.eu/config/plugin.json", timeout=float(15)
-                )
-                if r.status_code != requests.codes.ok:
-                    raise Exception("Unexpected response code %d" % r.status_code)
-                self.CachedConfig = r.json()
-                self.CachedConfigAt = time.time()
-        
-                Sentry.Info("SENDER", "OctoApp loaded config: %s" % self.CachedConfig)
-            except Exception as e:
-                Sentry.ExceptionNoSend("Failed to fetch config using defaults for 5 minutes", e)
-                self.CachedConfig = self.DefaultConfig
-                self.CachedConfigAt = cache_config_max_age + 300
+        # Jitter, so the plugins don't all ask for the config at the same time.
+        TaskScheduler.Get().Schedule("UpdateConfig", 3600, self._doUpdateConfig, jitterSec=300, lane=TaskScheduler.c_LaneCloud)
 
+    def _doUpdateConfig(self):
+        # If we have no config cached or the cache is older than a day, request new config
+        cache_config_max_age = time.time() - 86400
+        if self.CachedConfigAt > cache_config_max_age:
+            Sentry.Info("SENDER", "Config still valid")
+
+        # Request config, fall back to default
+        try:
+            r = HttpSessions.Get().Request("GET",
+                "https://www.octoapp.eu/config/plugin.json", timeout=(5.0, 15.0)
+            )
+            if r.status_code != requests.codes.ok:
+                raise Exception("Unexpected response code %d" % r.status_code)
+            self.CachedConfig = r.json()
+            self.CachedConfigAt = time.time()
+        
+            Sentry.Info("SENDER", "OctoApp loaded config: %s" % self.CachedConfig)
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to fetch config using defaults for 5 minutes", e)
+            self.CachedConfig = self.DefaultConfig
+            self.CachedConfigAt = cache_config_max_age + 300
+
+# Encrypts the Android push data with the shared encryption key.
+#
+# Deriving the key runs SHA-256 and getting the key can mean a settings read or a database call, so the cipher
+# for the current key is kept and only rebuilt if the key string changes. CBC needs a new random IV for every
+# message, so the AES object itself can't be shared between messages, but everything else is.
 class AESCipher(object):
+    # None until we tried to import Crypto, then True or False.
     _ready = None
+    _AES = None
+    _Lock = threading.Lock()
+    # The cipher for the last key we were asked for.
+    _Cached_CanBeNone = None
+
+    # Returns True if Crypto can be used. The import is only tried once.
+    @staticmethod
+    def IsAvailable() -> bool:
+        if AESCipher._ready is None:
+            with AESCipher._Lock:
+                if AESCipher._ready is None:
+                    try:
+                        from Crypto.Cipher import AES
+                        AESCipher._AES = AES
+                        AESCipher._ready = True
+                    except ImportError:
+                        Sentry.Warn("SENDER", "Missing Crypto, notifications will not be encrypted. This happens on Sonic Pad and K1 (maybe others)")
+                        AESCipher._ready = False
+        return AESCipher._ready
+
+
+    # Returns the cipher for this key, reusing the derived key if the key didn't change since the last call.
+    @staticmethod
+    def ForKey(key:str):
+        cached = AESCipher._Cached_CanBeNone
+        if cached is not None and cached.rawKey == key:
+            return cached
+        cipher = AESCipher(key)
+        AESCipher._Cached_CanBeNone = cipher
+        return cipher
+
 
     def __init__(self, key):
+        self.rawKey = key
         self.key = hashlib.sha256(key.encode()).digest()
 
+
     def prepare(self):
-        global AES, Random
+        return AESCipher.IsAvailable()
 
-        if AESCipher._ready is None:
-            try:
-                from Crypto.Cipher import AES
-                from Crypto import Random
-                AESCipher._ready = True
-            except ImportError as e:
-                Sentry.Warn("SENDER", "Missing Crypto, notifications will not be encrypted. This happens on Sonic Pad and K1 (maybe others)")
-                AESCipher._ready = False
-        
-        return AESCipher._ready
 
     def encrypt(self, raw):
-        global AES, Random
+        AES = AESCipher._AES
         bs = AES.block_size
-
-        def _pad(s):
-            return s + (bs - len(s) % bs) * chr(bs - len(s) % bs)
-
-        raw = _pad(raw)
-        iv = Random.new().read(bs)
+        data = raw.encode()
+        # PKCS7 padding
+        padLen = bs - len(data) % bs
+        data += bytes([padLen]) * padLen
+        iv = os.urandom(bs)
         cipher = AES.new(self.key, AES.MODE_CBC, iv)
-        return base64.b64encode(iv + cipher.encrypt(raw.encode())).decode("utf-8")
-            
+        return base64.b64encode(iv + cipher.encrypt(data)).decode("utf-8")
@@ -1,6 +1,5 @@
 import math
 import time
-import io
 import threading
 import random
 import string
@@ -12,19 +11,16 @@ from .gadget import Gadget
 from .sentry import Sentry
 from .compat import Compat
 from .snapshotresizeparams import SnapshotResizeParams
+from .snapshottransform import SnapshotTransform
 from .repeattimer import RepeatTimer
+from .taskscheduler import TaskScheduler
 from .webcamhelper import WebcamHelper
 from .finalsnap import FinalSnap
 from .notificationsender import NotificationSender
-
-try:
-    # On some systems this package will install but the import will fail due to a missing system .so.
-    # Since most setups don't use this package, we will import it with a try catch and if it fails we
-    # won't use it.
-    from PIL import Image
-    from PIL import ImageFile
-except Exception as _:
-    pass
+from .notificationeventqueue import NotificationEventQueue
+from .notificationoutbox import NotificationOutbox
+from .notificationtracing import NotificationTrace
+from .Proto.MessagePriority import MessagePriority
 
 class ProgressCompletionReportItem:
     def __init__(self, value, reported):
@@ -49,14 +45,52 @@ class NotificationsHandler:
     # globally unique. This value must stay in sync with the service.
     PrintIdLength = 60
 
+    # How many events we send at once.
+    SendEventWorkerCount = 2
+
+    # The send priority of the events. Anything not in here is Normal.
+    # Events that end or interrupt a print go first, so they are never stuck behind progress updates.
+    EventPriorities = {
+        NotificationSender.EVENT_DONE: MessagePriority.Critical,
+        NotificationSender.EVENT_ERROR: MessagePriority.Critical,
+        NotificationSender.EVENT_CANCELLED: MessagePriority.Critical,
+        NotificationSender.EVENT_PAUSED: MessagePriority.Critical,
+        NotificationSender.EVENT_FILAMENT_REQUIRED: MessagePriority.Critical,
+        NotificationSender.EVENT_USER_INTERACTION_NEEDED: MessagePriority.Critical,
+        NotificationSender.EVENT_STARTED: MessagePriority.High,
+        NotificationSender.EVENT_RESUME: MessagePriority.High,
+        NotificationSender.EVENT_FIRST_LAYER_DONE: MessagePriority.High,
+        NotificationSender.EVENT_THIRD_LAYER_DONE: MessagePriority.High,
+        NotificationSender.EVENT_BEEP: MessagePriority.High,
+        NotificationSender.EVENT_PROGRESS: MessagePriority.Low,
+        NotificationSender.EVENT_TIME_PROGRESS: MessagePriority.Low,
+    }
+
+    # Only the latest of these matter, so if one is still waiting to be sent when a new one comes in, it's replaced.
+    CollapsibleEvents = {
+        NotificationSender.EVENT_PROGRESS,
+        NotificationSender.EVENT_TIME_PROGRESS,
+    }
+
+    # The max number of send attempts for an event.
+    SendEventMaxAttempts = 3
+
     def __init__(self, printerStateInterface):
         # On init, set the key to empty.
         self.OctoKey = None
         self.PrinterId = None
         self.PrinterStateInterface = printerStateInterface
         self.NotificationSender = NotificationSender()
+        self.EventQueue = NotificationEventQueue(self._sendQueuedEvent, NotificationsHandler.CollapsibleEvents, NotificationsHandler.SendEventWorkerCount, self._onQueuedEventDiscarded)
+        # Set when the host calls EnableOutbox.
+        self.Outbox:NotificationOutbox = None
         self.ProgressTimer = None
-        self.FirstLayerTimer = None
+        # The first and third layer tracking, see OnCurrentLayerChanged
+        self.LayerLock = threading.Lock()
+        self.LayerTrackingActive = False
+        self.LayerDeadlineTasks = []
+        self.LastLayerInfo_CanBeNone = None
+        self.LastZOffsetMM_CanBeNone = None
         self.FinalSnapObj:FinalSnap = None
         # self.Gadget = Gadget(logger, self, self.PrinterStateInterface)
 
@@ -71,7 +105,7 @@ class NotificationsHandler:
         self.HasSendFirstLayerDoneMessage = False
         self.HasSendThirdLayerDoneMessage = False
         self.zOffsetLowestSeenMM = 1337.0
-        self.zOffsetNotAtLowestCount = 0
+        self.zOffsetAboveSince = 0.0
         self.zOffsetHasSeenPositiveExtrude = False
         self.zOffsetTrackingStartTimeSec = 0.0
         self.FirstLayerDoneSince = 0.0
@@ -100,11 +134,13 @@ class NotificationsHandler:
         self.HasSendThirdLayerDoneMessage = False
         # The following values are used to figure out when the first layer is done.
         self.zOffsetLowestSeenMM = 1337.0
-        self.zOffsetNotAtLowestCount = 0
+        self.zOffsetAboveSince = 0.0
         self.zOffsetTrackingStartTimeSec = 0.0
         self.FirstLayerDoneSince = 0.0
         self.ThirdLayerDoneSince = 0.0
         self.zOffsetHasSeenPositiveExtrude = False
+        self.LastLayerInfo_CanBeNone = None
+        self.LastZOffsetMM_CanBeNone = None
         self.RestorePrintProgressPercentage = False
 
         # Ensure there's no final snap running.
@@ -472,93 +508,176 @@ class NotificationsHandler:
 
 
     #
-    # Note this values are important!
-    # The cost of getting the current z offset is decently high, and thus we can't check it too often.
-    # However, the our "first layer complete" logic works by watching the zoffset to detect when it has moved above
-    # the "lowest ever seen.". It will only fire the notification after we have seen something above "the lowest ever seen"
-    # so many times. If we don't poll frequently enough, the notification will be delayed and we might miss some of the layer heights changes.
+    # The first and third layer notifications are driven by the platform, it calls OnCurrentLayerChanged or OnCurrentZOffsetChanged
+    # when the value changes, so we don't need to poll. The debounce windows below are scheduled as deadlines on the TaskScheduler,
+    # so the notification fires right when the window is over, even if no other update comes in.
     #
-    # For now, we settled on checking every 2 seconds and a FirstLayerCountAboveLowestBeforeNotify value of 5, meaning we need to constantly see
-    # a layer height above the lowest for 10 seconds before we will fire the notification.
-    FirstLayerTimerIntervalSec = 2.0
-    FirstLayerCountAboveLowestBeforeNotify = 5
+    # If the platform knows the layer (Moonraker), the layer must be past the first or third layer for LayerDoneDelaySec.
+    # Otherwise we watch the z offset. After the first extrude we wait FirstLayerPurgeLineDelaySec so we don't lock onto a purge line,
+    # then the z offset must stay above the lowest we have seen (or 3x that for the third layer) for FirstLayerAboveLowestBeforeNotifySec.
+    LayerDoneDelaySec = 10.0
+    FirstLayerPurgeLineDelaySec = 20.0
+    FirstLayerAboveLowestBeforeNotifySec = 10.0
 
 
-    # Called by our firstLayerTimer at a fixed interval defined by FirstLayerTimerIntervalSec.
-    # Returns True if the timer should continue, otherwise False
-    def _OnFirstLayerWatchTimer(self):
+    # Returns True while the first or third layer notification is still pending.
+    # The platforms use this to skip the work of reporting layer and z offset changes when no one needs them.
+    def IsLayerTrackingActive(self) -> bool:
+        return self.LayerTrackingActive
+
+
+    # Called by the platform when the system reported layer might have changed.
+    # Both values can be 0 if the layer counts aren't known yet.
+    def OnCurrentLayerChanged(self, currentLayer, totalLayers):
+        if self.LayerTrackingActive is False or currentLayer is None or totalLayers is None:
+            return
+        with self.LayerLock:
+            if self.LastLayerInfo_CanBeNone == (currentLayer, totalLayers):
+                return
+            self.LastLayerInfo_CanBeNone = (currentLayer, totalLayers)
+            self._EvaluateLayerStateUnderLock()
+
+
+    # Called by the platform when the z offset changes, if the platform doesn't know the layer.
+    # If the printer is warming up, this should be -1.
+    def OnCurrentZOffsetChanged(self, zOffsetMM):
+        if self.LayerTrackingActive is False or zOffsetMM is None:
+            return
+        with self.LayerLock:
+            if self.LastZOffsetMM_CanBeNone == zOffsetMM:
+                return
+            self.LastZOffsetMM_CanBeNone = zOffsetMM
+            self._EvaluateLayerStateUnderLock()
+
+
+    # Starts watching for the first and third layer, if they haven't been sent yet for this print.
+    def StartLayerTracking(self):
+        with self.LayerLock:
+            self._CancelLayerDeadlinesUnderLock()
+            if self.HasSendFirstLayerDoneMessage and self.HasSendThirdLayerDoneMessage:
+                self.LayerTrackingActive = False
+                return
+            self.LayerTrackingActive = True
+
+        # The platform only tells us about changes, so get the current values once to start from.
+        # If the platform doesn't know the layer, we use the z offset.
+        currentLayer, totalLayers = self.PrinterStateInterface.GetCurrentLayerInfo()
+        if currentLayer is not None and totalLayers is not None:
+            self.OnCurrentLayerChanged(currentLayer, totalLayers)
+        else:
+            self.OnCurrentZOffsetChanged(self.PrinterStateInterface.GetCurrentZOffset())
+
+
+    def StopLayerTracking(self):
+        with self.LayerLock:
+            self.LayerTrackingActive = False
+            self._CancelLayerDeadlinesUnderLock()
+
+
+    # Fired by the TaskScheduler when a debounce window is over.
+    def _OnLayerDeadline(self):
+        with self.LayerLock:
+            self.LayerDeadlineTasks = [task for task in self.LayerDeadlineTasks if task.IsRunning()]
+            if self.LayerTrackingActive:
+                self._EvaluateLayerStateUnderLock()
+
+
+    def _ScheduleLayerDeadlineUnderLock(self, delaySec:float):
+        # Drop the deadlines that already fired, on OctoPrint every z-hop restarts the window, so this would grow over the first layer.
+        self.LayerDeadlineTasks = [task for task in self.LayerDeadlineTasks if task.IsRunning()]
+        # Fire just after the window is over, so the time check passes.
+        self.LayerDeadlineTasks.append(TaskScheduler.Get().RunAfter("LayerDeadline", delaySec + 0.05, self._OnLayerDeadline))
+
+
+    def _CancelLayerDeadlinesUnderLock(self):
+        for task in self.LayerDeadlineTasks:
+            task.Cancel()
+        self.LayerDeadlineTasks = []
 
-        # If we have already sent the first layer done message there's nothing to do.
-        # Remember! This timer will be started mid print for a Moonraker state restore or on resume, so we need to make
-        # Sure we handle that. Right now we use HasSendFirstLayerDoneMessage to ensure we don't run the logic anymore until the print restarts.
-        if self.HasSendFirstLayerDoneMessage and self.HasSendThirdLayerDoneMessage:
-            return False
 
+    # Sends a layer event, if we are still printing. Returns False if we aren't, in which case layer tracking is stopped.
+    def _SendLayerEventUnderLock(self, event, args = None) -> bool:
         # Ensure we are in state where we should fire this (printing)
         if self.PrinterStateInterface.ShouldPrintingTimersBeRunning() is False:
             self.HasSendFirstLayerDoneMessage = True
             self.HasSendThirdLayerDoneMessage = True
             return False
+        self._sendEvent(event, args)
+        return True
 
-        # We have two ways of computing the layer heights.
-        # 1) On some platforms (Moonraker) we can query the actual layer from the system, so we don't have to guess.
-        # 2) If the platform doesn't support getting the actual layer height, we can try to figure it out with z offsets.
-        currentLayer, totalLayers = self.PrinterStateInterface.GetCurrentLayerInfo()
-        if currentLayer is not None and totalLayers is not None:
-            # We have layer info from the system, use this to handle the events.
-
-            # If we are over the first layer and haven't sent the notification, do it now.
-            if currentLayer > 1 and self.HasSendFirstLayerDoneMessage is False:
-                if self.FirstLayerDoneSince < 0.1:
-                    Sentry.Debug("NOTIFICATION", "First Layer Logic - Starting delay timer.")
-                    self.FirstLayerDoneSince = time.time()
-                elif time.time() - self.FirstLayerDoneSince < 10.0:
-                    Sentry.Debug("NOTIFICATION", "First Layer Logic - Waiting delay time to expire.")
-                else:
-                    Sentry.Debug("NOTIFICATION", "First Layer Logic - Done.")
-                    self.HasSendFirstLayerDoneMessage = True
-                    self._sendEvent(NotificationSender.EVENT_FIRST_LAYER_DONE)
-                    
-            if currentLayer <= 1 and self.FirstLayerDoneSince > 0.0:
-                Sentry.Debug("NOTIFICATION", "First Layer Logic - Reset.")
-                self.FirstLayerDoneSince = 0.0
-                
-            # If we are past the 3rd, layer, do the same.
-            if currentLayer > 3 and self.HasSendThirdLayerDoneMessage is False:
-                if self.ThirdLayerDoneSince < 0.1:
-                    Sentry.Debug("NOTIFICATION", "Third Layer Logic - Starting delay timer.")
-                    self.ThirdLayerDoneSince = time.time()  
-                elif time.time() - self.ThirdLayerDoneSince < 10.0:
-                    Sentry.Debug("NOTIFICATION", "Third Layer Logic - Waiting delay time to expire.")
-                else:
-                    Sentry.Debug("NOTIFICATION", "Third Layer Logic - Done.")
-                    self.HasSendThirdLayerDoneMessage = True
-                    self._sendEvent(NotificationSender.EVENT_THIRD_LAYER_DONE)
-
-            if currentLayer <= 3 and self.ThirdLayerDoneSince > 0.0:
-                Sentry.Debug("NOTIFICATION", "Third Layer Logic - Reset.")
-                self.ThirdLayerDoneSince = 0.0
-
-            # If we return true, the time will continue, otherwise it will stop.
-            isDone = self.HasSendFirstLayerDoneMessage is True and self.HasSendThirdLayerDoneMessage is True
-            return isDone is False
 
-        #
-        # We don't have a system provided layer info, use the second option with the z-offset.
+    # Runs the layer state machine with the latest values. Must be called under the layer lock.
+    def _EvaluateLayerStateUnderLock(self):
+        keepGoing = False
+        if self.LastLayerInfo_CanBeNone is not None:
+            keepGoing = self._EvaluateSystemLayerUnderLock()
+        elif self.LastZOffsetMM_CanBeNone is not None:
+            keepGoing = self._EvaluateZOffsetUnderLock()
+        else:
+            keepGoing = True
+
+        # If we have already sent the both messages there's nothing to do until the print restarts.
+        if keepGoing is False or (self.HasSendFirstLayerDoneMessage and self.HasSendThirdLayerDoneMessage):
+            Sentry.Info("NOTIFICATION", "First layer tracking is done.")
+            self.LayerTrackingActive = False
+            self._CancelLayerDeadlinesUnderLock()
+
+
+    # The layer state machine for platforms that report the layer. Returns True if we should keep going.
+    def _EvaluateSystemLayerUnderLock(self) -> bool:
+        currentLayer, _ = self.LastLayerInfo_CanBeNone
+        now = time.time()
+
+        # If we are over the first layer and haven't sent the notification, do it once the delay is over.
+        if currentLayer > 1 and self.HasSendFirstLayerDoneMessage is False:
+            if self.FirstLayerDoneSince < 0.1:
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - Starting delay timer.")
+                self.FirstLayerDoneSince = now
+                self._ScheduleLayerDeadlineUnderLock(NotificationsHandler.LayerDoneDelaySec)
+            elif now - self.FirstLayerDoneSince < NotificationsHandler.LayerDoneDelaySec:
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - Waiting delay time to expire.")
+            else:
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - Done.")
+                self.HasSendFirstLayerDoneMessage = True
+                if self._SendLayerEventUnderLock(NotificationSender.EVENT_FIRST_LAYER_DONE) is False:
+                    return False
+
+        if currentLayer <= 1 and self.FirstLayerDoneSince > 0.0:
+            Sentry.Debug("NOTIFICATION", "First Layer Logic - Reset.")
+            self.FirstLayerDoneSince = 0.0
+
+        # If we are past the 3rd, layer, do the same.
+        if currentLayer > 3 and self.HasSendThirdLayerDoneMessage is False:
+            if self.ThirdLayerDoneSince < 0.1:
+                Sentry.Debug("NOTIFICATION", "Third Layer Logic - Starting delay timer.")
+                self.ThirdLayerDoneSince = now
+                self._ScheduleLayerDeadlineUnderLock(NotificationsHandler.LayerDoneDelaySec)
+            elif now - self.ThirdLayerDoneSince < NotificationsHandler.LayerDoneDelaySec:
+                Sentry.Debug("NOTIFICATION", "Third Layer Logic - Waiting delay time to expire.")
+            else:
+                Sentry.Debug("NOTIFICATION", "Third Layer Logic - Done.")
+                self.HasSendThirdLayerDoneMessage = True
+                if self._SendLayerEventUnderLock(NotificationSender.EVENT_THIRD_LAYER_DONE) is False:
+                    return False
+
+        if currentLayer <= 3 and self.ThirdLayerDoneSince > 0.0:
+            Sentry.Debug("NOTIFICATION", "Third Layer Logic - Reset.")
+            self.ThirdLayerDoneSince = 0.0
+        return True
 
-        # Get the current zoffset value.
-        currentZOffsetMM = self.PrinterStateInterface.GetCurrentZOffset()
+
+    # The layer state machine for platforms that only know the z offset. Returns True if we should keep going.
+    def _EvaluateZOffsetUnderLock(self) -> bool:
+        currentZOffsetMM = self.LastZOffsetMM_CanBeNone
+        now = time.time()
 
         # Make sure we know it.
-        # If not, return True so we keep checking.
         if currentZOffsetMM == -1:
             Sentry.Debug("NOTIFICATION", "First Layer Logic - Waiting for positive z axis measurement.")
             return True
 
         # If the value is 0.0, the printer is still warming up or getting ready. We can't print at 0.0, because that's the nozzle touching the plate.
         # Ignore this value, so we don't lock to it as the "lowest we have seen."
-        # I'm not sure if OctoPrint does this, but moonraker will report the value of 0.0
-        # In this case, return True so we keep checking.
         if currentZOffsetMM < 0.0001:
             Sentry.Debug("NOTIFICATION", "First Layer Logic - Waiting for >0 z axis measurement.")
             return True
@@ -571,17 +690,13 @@ class NotificationsHandler:
             return True
 
         # Finally, before tracking the zAxisOffset, we need to wait for a possible purge line.
-        # Hopefully with the blocking logic above, like the warm up check and waiting to see an extrude, we will ignore any z-axis values
-        # from most pre-print macros.
-        # The final thing we need to exclude is a purge line, since the purge line's layer height might be less than the first layer height used
-        # for the actual print. That means our system will lock onto the purge line's layer height, instead of the print's first layer height.
-        #
-        # We choose 10 seconds as the time to wait. The trade off is that we want to wait longer than most purge line extrudes, but we don't want to miss the first layer
-        # being printed. Since we only start our time after the first extrude, this gives us ~10 seconds after the first extrude for the purge line to be done.
+        # The purge line's layer height might be less than the first layer height used for the actual print, so we would lock onto it.
+        # The trade off is that we want to wait longer than most purge line extrudes, but we don't want to miss the first layer being printed.
         if self.zOffsetTrackingStartTimeSec < 0.1:
             Sentry.Debug("NOTIFICATION", "First Layer Logic - Starting delay timer.")
-            self.zOffsetTrackingStartTimeSec = time.time()
-        if time.time() - self.zOffsetTrackingStartTimeSec < 20.0:
+            self.zOffsetTrackingStartTimeSec = now
+            self._ScheduleLayerDeadlineUnderLock(NotificationsHandler.FirstLayerPurgeLineDelaySec)
+        if now - self.zOffsetTrackingStartTimeSec < NotificationsHandler.FirstLayerPurgeLineDelaySec:
             Sentry.Debug("NOTIFICATION", "First Layer Logic - Waiting delay time to expire.")
             return True
 
@@ -589,46 +704,44 @@ class NotificationsHandler:
         # or how the gcode is written to do zhops.
         #
         # Our current solution is to keep track of the lowest zvalue we have seen for this print.
-        # Every time we don't see the zvalue be the lowest, we increment a counter. After n number of reports above the lowest value, we
-        # consider the first layer done because we haven't seen the printer return to the first layer height.
+        # Once the zvalue has been above the lowest for long enough, we consider the first layer done because we haven't seen
+        # the printer return to the first layer height.
         #
         # Typically, the flow looks something like... 0.4 -> 0.2 -> 0.4 -> 0.2 -> 0.4 -> 0.5 -> 0.7 -> 0.5 -> 0.7...
         # Where the layer hight is 0.2 (because it's the lowest first value) and the zhops are 0.4 or more.
-        #
-        # This system is pumped every FirstLayerTimerIntervalSec and the z offset is checked.
 
         # First, do the logic for the first layer
         if self.HasSendFirstLayerDoneMessage is False:
             # Since this is a float, avoid ==
             if currentZOffsetMM > self.zOffsetLowestSeenMM - 0.01 and currentZOffsetMM < self.zOffsetLowestSeenMM + 0.01:
                 # The zOffset is the same as the previously seen.
-                self.zOffsetNotAtLowestCount = 0
-                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f; notAtLowestCount: %d - Same as the 'lowest ever seen', resetting the counter." % (currentZOffsetMM, self.zOffsetLowestSeenMM, self.zOffsetNotAtLowestCount))
+                self.zOffsetAboveSince = 0.0
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f - Same as the 'lowest ever seen', resetting the timer." % (currentZOffsetMM, self.zOffsetLowestSeenMM))
             elif currentZOffsetMM < self.zOffsetLowestSeenMM:
                 # We found a new low, record it.
                 self.zOffsetLowestSeenMM = currentZOffsetMM
-                self.zOffsetNotAtLowestCount = 0
-                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f; notAtLowestCount: %d - New lowest zoffset ever seen." % (currentZOffsetMM, self.zOffsetLowestSeenMM, self.zOffsetNotAtLowestCount))
-            else:
-                # The zOffset is higher than the lowest we have seen.
-                self.zOffsetNotAtLowestCount += 1
-                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f; notAtLowestCount: %d - Offset is higher than lowest seen, adding to the count." % (currentZOffsetMM, self.zOffsetLowestSeenMM, self.zOffsetNotAtLowestCount))
-
-            # Check if we have been above the min layer height for FirstLayerCountAboveLowestBeforeNotify of times in a row.
-            # If not, keep waiting, if so, fire the notification.
-            if self.zOffsetNotAtLowestCount < NotificationsHandler.FirstLayerCountAboveLowestBeforeNotify:
-                # Not done yet, return True to keep checking.
+                self.zOffsetAboveSince = 0.0
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f - New lowest zoffset ever seen." % (currentZOffsetMM, self.zOffsetLowestSeenMM))
+            elif self.zOffsetAboveSince < 0.1:
+                # The zOffset just went higher than the lowest we have seen.
+                self.zOffsetAboveSince = now
+                self._ScheduleLayerDeadlineUnderLock(NotificationsHandler.FirstLayerAboveLowestBeforeNotifySec)
+                Sentry.Debug("NOTIFICATION", "First Layer Logic - currentOffset: %.4f; lowestSeen: %.4f - Offset is higher than lowest seen, starting the timer." % (currentZOffsetMM, self.zOffsetLowestSeenMM))
+
+            # Check if we have been above the min layer height for long enough.
+            if self.zOffsetAboveSince < 0.1 or now - self.zOffsetAboveSince < NotificationsHandler.FirstLayerAboveLowestBeforeNotifySec:
                 return True
 
-            # Set the flag and reset the count, since it will now be used for the third lowest layer notification.
+            # Set the flag and reset the timer, since it will now be used for the third lowest layer notification.
             self.HasSendFirstLayerDoneMessage = True
-            self.zOffsetNotAtLowestCount = 0
+            self.zOffsetAboveSince = 0.0
 
             # Send the message.
-            self._sendEvent(NotificationSender.EVENT_FIRST_LAYER_DONE, {"ZOffsetMM" : str(currentZOffsetMM) })
+            if self._SendLayerEventUnderLock(NotificationSender.EVENT_FIRST_LAYER_DONE, {"ZOffsetMM" : str(currentZOffsetMM) }) is False:
+                return False
 
         # Next, after we know the first layer is done, do the logic for the third layer notification.
-        elif self.HasSendThirdLayerDoneMessage is False:
+        if self.HasSendThirdLayerDoneMessage is False:
             # Sanity check we have a valid value for self.zOffsetLowestSeenMM, from the first layer notification.
             if self.zOffsetLowestSeenMM > 50.0:
                 Sentry.Warn("NOTIFICATION", "First layer notification has sent but third layer hans't but the zOffsetLowestSeenMM value is really high, seems like it's unset. Value: "+str(self.zOffsetLowestSeenMM))
@@ -643,32 +756,27 @@ class NotificationsHandler:
             # Since we don't allow a value of 0, this is reasonable.
             thirdLayerHeight = self.zOffsetLowestSeenMM * 3
             if currentZOffsetMM > thirdLayerHeight + 0.001:
-                # The current offset is larger than the third layer height, count it.
-                self.zOffsetNotAtLowestCount += 1
-                Sentry.Debug("NOTIFICATION", "Third Layer Logic - currentOffset: %.4f; thirdLayerHeight: %.4f; notAtLowestCount: %d - Offset is higher than the third layer height, adding to the count." % (currentZOffsetMM, thirdLayerHeight, self.zOffsetNotAtLowestCount))
-
+                # The current offset is larger than the third layer height, start the timer if it's not running.
+                if self.zOffsetAboveSince < 0.1:
+                    self.zOffsetAboveSince = now
+                    self._ScheduleLayerDeadlineUnderLock(NotificationsHandler.FirstLayerAboveLowestBeforeNotifySec)
+                    Sentry.Debug("NOTIFICATION", "Third Layer Logic - currentOffset: %.4f; thirdLayerHeight: %.4f - Offset is higher than the third layer height, starting the timer." % (currentZOffsetMM, thirdLayerHeight))
             else:
-                # The current layer height is equal to or at the third layer height, reset the count
-                self.zOffsetNotAtLowestCount = 0
-                Sentry.Debug("NOTIFICATION", "Third Layer Logic - currentOffset: %.4f; thirdLayerHeight: %.4f; notAtLowestCount: %d - Offset less than or equal to the third layer height, resetting the count." % (currentZOffsetMM, thirdLayerHeight, self.zOffsetNotAtLowestCount))
-
-            # Check if we have been above the third layer height for FirstLayerCountAboveLowestBeforeNotify of times in a row.
-            # If not, keep waiting, if so, fire the notification.
-            if self.zOffsetNotAtLowestCount < NotificationsHandler.FirstLayerCountAboveLowestBeforeNotify:
-                # Not done yet, return True to keep checking.
+                # The current layer height is equal to or at the third layer height, reset the timer
+                self.zOffsetAboveSince = 0.0
+                Sentry.Debug("NOTIFICATION", "Third Layer Logic - currentOffset: %.4f; thirdLayerHeight: %.4f - Offset less than or equal to the third layer height, resetting the timer." % (currentZOffsetMM, thirdLayerHeight))
+
+            # Check if we have been above the third layer height for long enough.
+            if self.zOffsetAboveSince < 0.1 or now - self.zOffsetAboveSince < NotificationsHandler.FirstLayerAboveLowestBeforeNotifySec:
                 return True
 
             # Set the flag to indicate we sent the notification
             self.HasSendThirdLayerDoneMessage = True
 
             # Send the notification.
-            self._sendEvent(NotificationSender.EVENT_THIRD_LAYER_DONE, {"ZOffsetMM" : str(currentZOffsetMM) })
-
-        # If we have fired both, we are done.
-        # If we are not done, return True, so we keep going.
-        # Otherwise, return false, to stop the timer, because we are done.
-        isDone = self.HasSendFirstLayerDoneMessage is True and self.HasSendThirdLayerDoneMessage is True
-        return isDone is False
+            if self._SendLayerEventUnderLock(NotificationSender.EVENT_THIRD_LAYER_DONE, {"ZOffsetMM" : str(currentZOffsetMM) }) is False:
+                return False
+        return True
 
 
     # If possible, gets a snapshot from the snapshot URL configured in OctoPrint.
@@ -676,16 +784,16 @@ class NotificationsHandler:
     # SnapshotResizeParams will also be ignored if the current image is smaller than the requested size.
     # If this fails for any reason, None is returned.
     def GetNotificationSnapshot(self, snapshotResizeParams = None):
+        snapshot = self.GetRawSnapshot()
+        if snapshot is None:
+            return None
+        return self.ProcessNotificationSnapshot(snapshot, snapshotResizeParams)
 
-        # If no snapshot resize param was specified, use the default for notifications.
-        if snapshotResizeParams is None:
-            # For notifications, if possible, we try to resize any image to be less than 720p.
-            # This scale will preserve the aspect ratio and won't happen if the image is already less than 720p.
-            # The scale might also fail if the image lib can't be loaded correctly.
-            snapshotResizeParams = SnapshotResizeParams(1080, True, False, False)
 
+    # Gets the snapshot as the camera sent it, without any of the transforms or resizing.
+    # If this fails for any reason, None is returned.
+    def GetRawSnapshot(self):
         try:
-
             # Use the snapshot helper to get the snapshot. This will handle advance logic like relative and absolute URLs
             # as well as getting a snapshot directly from a mjpeg stream if there's no snapshot URL.
             octoHttpResponse = WebcamHelper.Get().GetSnapshot()
@@ -699,6 +807,27 @@ class NotificationsHandler:
             if snapshot is None:
                 Sentry.Error("NOTIFICATION", "WebcamHelper.Get().GetSnapshot() returned a web response but no FullBodyBuffer")
                 return None
+            return snapshot
+
+        except Exception as _:
+            # Don't log here, because for those users with no webcam setup this will fail often.
+            # TODO - Ideally we would log, but filter out the expected errors when snapshots are setup by the user.
+            #Sentry.Info("NOTIFICATION", "Snapshot http call failed. " + str(e))
+            return None
+
+
+    # Applies the webcam transforms and the resize to a raw snapshot, for sending it with a notification.
+    # If this fails for any reason, None is returned.
+    def ProcessNotificationSnapshot(self, snapshot, snapshotResizeParams = None):
+
+        # If no snapshot resize param was specified, use the default for notifications.
+        if snapshotResizeParams is None:
+            # For notifications, if possible, we try to resize any image to be less than 720p.
+            # This scale will preserve the aspect ratio and won't happen if the image is already less than 720p.
+            # The scale might also fail if the image lib can't be loaded correctly.
+            snapshotResizeParams = SnapshotResizeParams(1080, True, False, False)
+
+        try:
 
             # Ensure the snapshot is a reasonable size. If it's not, try to resize it if there's not another resize planned.
             # If this fails, the size will be checked again later and the image will be thrown out.
@@ -711,121 +840,12 @@ class NotificationsHandler:
             flipH = WebcamHelper.Get().GetWebcamFlipH()
             flipV = WebcamHelper.Get().GetWebcamFlipV()
             rotation = WebcamHelper.Get().GetWebcamRotation()
+            if rotation is None:
+                rotation = 0
             if rotation != 0 or flipH or flipV or snapshotResizeParams is not None:
                 try:
-                    if Image is not None:
-
-                        # We noticed that on some under powered or otherwise bad systems the image returned
-                        # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
-                        # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
-                        # buffer, which is still an incomplete image.
-                        # Use a try catch incase the import of ImageFile failed
-                        try:
-                            ImageFile.LOAD_TRUNCATED_IMAGES = True
-                        except Exception as _:
-                            pass
-
-                        # In pillow ~9.1.0 these constants moved.
-                        # pylint: disable=no-member
-                        OE_FLIP_LEFT_RIGHT = 0
-                        OE_FLIP_TOP_BOTTOM = 0
-                        try:
-                            OE_FLIP_LEFT_RIGHT = Image.FLIP_LEFT_RIGHT
-                            OE_FLIP_TOP_BOTTOM = Image.FLIP_TOP_BOTTOM
-                        except Exception:
-                            OE_FLIP_LEFT_RIGHT = Image.Transpose.FLIP_LEFT_RIGHT
-                            OE_FLIP_TOP_BOTTOM = Image.Transpose.FLIP_TOP_BOTTOM
-                        # pylint: enable=no-member
-
-                        # Update the image
-                        # Note the order of the flips and the rotates are important!
-                        # If they are reordered, when multiple are applied the result will not be correct.
-                        didWork = False
-                        pilImage = Image.open(io.BytesIO(snapshot))
-                        if flipH:
-                            pilImage = pilImage.transpose(OE_FLIP_LEFT_RIGHT)
-                            didWork = True
-                        if flipV:
-                            pilImage = pilImage.transpose(OE_FLIP_TOP_BOTTOM)
-                            didWork = True
-                        if rotation != 0:
-                            # Our rotation is clockwise while PIL is counter clockwise.
-                            # Subtract from 360 to get the opposite rotation.
-                            rotation = 360 - rotation
-                            pilImage = pilImage.rotate(rotation)
-                            didWork = True
-
-                        #
-                        # Now apply any resize operations needed.
-                        #
-                        if snapshotResizeParams is not None:
-                            # First, if we want to scale and crop to center, we will use the resize operation to get the image
-                            # scale (preserving the aspect ratio). We will use the smallest side to scale to the desired outcome.
-                            if snapshotResizeParams.CropSquareCenterNoPadding:
-                                # We will only do the crop resize if the source image is smaller than or equal to the desired size.
-                                if pilImage.height >= snapshotResizeParams.Size and pilImage.width >= snapshotResizeParams.Size:
-                                    if pilImage.height < pilImage.width:
-                                        snapshotResizeParams.ResizeToHeight = True
-                                        snapshotResizeParams.ResizeToWidth = False
-                                    else:
-                                        snapshotResizeParams.ResizeToHeight = False
-                                        snapshotResizeParams.ResizeToWidth = True
-
-                            # Do any resizing required.
-                            resizeHeight = None
-                            resizeWidth = None
-                            if snapshotResizeParams.ResizeToHeight:
-                                if pilImage.height > snapshotResizeParams.Size:
-                                    resizeHeight = snapshotResizeParams.Size
-                                    resizeWidth = int((float(snapshotResizeParams.Size) / float(pilImage.height)) * float(pilImage.width))
-                            if snapshotResizeParams.ResizeToWidth:
-                                if pilImage.width > snapshotResizeParams.Size:
-                                    resizeHeight = int((float(snapshotResizeParams.Size) / float(pilImage.width)) * float(pilImage.height))
-                                    resizeWidth = snapshotResizeParams.Size
-                            # If we have things to resize, do it.
-                            if resizeHeight is not None and resizeWidth is not None:
-                                pilImage = pilImage.resize((resizeWidth, resizeHeight))
-                                didWork = True
-
-                            # Now if we want to crop square, use the resized image to crop the remaining side.
-                            if snapshotResizeParams.CropSquareCenterNoPadding:
-                                left = 0
-                                upper = 0
-                                right = 0
-                                lower = 0
-                                if snapshotResizeParams.ResizeToHeight:
-                                    # Crop the width - use floor to ensure if there's a remainder we float left.
-                                    centerX = math.floor(float(pilImage.width) / 2.0)
-                                    halfWidth = math.floor(float(snapshotResizeParams.Size) / 2.0)
-                                    upper = 0
-                                    lower = snapshotResizeParams.Size
-                                    left = centerX - halfWidth
-                                    right = (snapshotResizeParams.Size - halfWidth) + centerX
-                                else:
-                                    # Crop the height - use floor to ensure if there's a remainder we float left.
-                                    centerY = math.floor(float(pilImage.height) / 2.0)
-                                    halfHeight = math.floor(float(snapshotResizeParams.Size) / 2.0)
-                                    upper = centerY - halfHeight
-                                    lower = (snapshotResizeParams.Size - halfHeight) + centerY
-                                    left = 0
-                                    right = snapshotResizeParams.Size
-
-                                # Sanity check bounds
-                                if left < 0 or left > right or right > pilImage.width or upper > 0 or upper > lower or lower > pilImage.height:
-                                    Sentry.Error("NOTIFICATION", "Failed to crop image. height: "+str(pilImage.height)+", width: "+str(pilImage.width)+", size: "+str(snapshotResizeParams.Size))
-                                else:
-                                    pilImage = pilImage.crop((left, upper, right, lower))
-                                    didWork = True
-
-                        #
-                        # If we did some operation, save the image buffer back to a jpeg and overwrite the
-                        # current snapshot buffer. If we didn't do work, keep the original, to preserve quality.
-                        #
-                        if didWork:
-                            buffer = io.BytesIO()
-                            pilImage.save(buffer, format="JPEG", quality=95)
-                            snapshot = buffer.getvalue()
-                            buffer.close()
+                    if SnapshotTransform.IsAvailable():
+                        snapshot = SnapshotTransform.Apply(snapshot, snapshotResizeParams, flipH, flipV, rotation)
                     else:
                         Sentry.Warn("NOTIFICATION", "Can't manipulate image because the Image rotation lib failed to import.")
                 except Exception as ex:
@@ -834,7 +854,7 @@ class NotificationsHandler:
 
             # Ensure in the end, the snapshot is a reasonable size.
             if len(snapshot) > NotificationsHandler.MaxSnapshotFileSizeBytes:
-                Sentry.Error("NOTIFICATION", "Snapshot size if too large to send. Size: "+len(snapshot))
+                Sentry.Error("NOTIFICATION", "Snapshot size if too large to send. Size: "+str(len(snapshot)))
                 return None
 
             # Return the image
@@ -941,79 +961,116 @@ class NotificationsHandler:
     # Sends the event
     # Returns True on success, otherwise False
     def _sendEvent(self, event, args = None, progressOverwriteFloat = None, useFinalSnapSnapshot = False):
-        # Push the work off to a thread so we don't hang OctoPrint's plugin callbacks.
-        thread = threading.Thread(target=self._sendEventThreadWorker, args=(event, args, progressOverwriteFloat, useFinalSnapSnapshot, ))
-        thread.start()
-
+        # Push the work off to the event queue so we don't hang OctoPrint's plugin callbacks.
+        priority = NotificationsHandler.EventPriorities.get(event, MessagePriority.Normal)
+        self.EventQueue.Put(event, args, progressOverwriteFloat, useFinalSnapSnapshot, self.PrintId, priority)
         return True
 
 
-    # Sends the event
-    # Returns True on success, otherwise False
-    def _sendEventThreadWorker(self, event, args = None, progressOverwriteFloat = None, useFinalSnapSnapshot = False):
+    # Called by the host with the plugin data folder, to keep the events that aren't sent yet on disk so they survive a restart.
+    # Any events that were pending when we last stopped are queued again.
+    def EnableOutbox(self, dataDir:str):
         try:
-            # Build the common even args.
-            requestArgs = self.BuildCommonEventArgs(event, args, progressOverwriteFloat=progressOverwriteFloat, useFinalSnapSnapshot=useFinalSnapSnapshot)
+            self.Outbox = NotificationOutbox(dataDir, NotificationsHandler.CollapsibleEvents)
+            for entry in self.Outbox.Load():
+                self.EventQueue.PutRestored(entry["Event"], [entry["Args"], {}], entry["PrintId"], entry["Priority"], entry["Attempts"], entry["Id"])
+        except Exception as e:
+            Sentry.Exception("NotificationsHandler failed to enable the outbox.", e)
+
+
+    # Returns the state of the event queue and the outbox, like how many events are waiting and how old the oldest one is.
+    def GetEventQueueStats(self) -> dict:
+        stats = { "Queue": self.EventQueue.GetStats() }
+        if self.Outbox is not None:
+            stats["Outbox"] = self.Outbox.GetStats()
+        return stats
+
+
+    # Called by the event queue workers to send one attempt of a queued event.
+    # Returns None if the event is done, or the number of seconds to wait before the next attempt.
+    def _sendQueuedEvent(self, queuedEvent):
+        retryDelaySec = None
+        try:
+            retryDelaySec = self._sendQueuedEventAttempt(queuedEvent)
+        finally:
+            if retryDelaySec is None:
+                self._onQueuedEventDiscarded(queuedEvent)
+        return retryDelaySec
+
+
+    # When an event is done, sent or not, it's removed from the outbox.
+    def _onQueuedEventDiscarded(self, queuedEvent):
+        if self.Outbox is not None and queuedEvent.OutboxId_CanBeNone is not None:
+            self.Outbox.Remove(queuedEvent.OutboxId_CanBeNone)
+            queuedEvent.OutboxId_CanBeNone = None
+
+
+    def _sendQueuedEventAttempt(self, queuedEvent):
+        event = queuedEvent.Event
+        # Only the first attempt is traced, the retries are mostly the retry delay.
+        trace = None
+        if queuedEvent.Attempts <= 1:
+            trace = NotificationTrace(event, queuedEvent.EnqueuedAtMonotonic)
+            trace.Mark("queue")
+        try:
+            # Build the common even args. This is only done on the first attempt, the retries send the same thing.
+            if queuedEvent.RequestArgs_CanBeNone is None:
+                queuedEvent.RequestArgs_CanBeNone = self.BuildCommonEventArgs(event, queuedEvent.Args, progressOverwriteFloat=queuedEvent.ProgressOverwriteFloat, useFinalSnapSnapshot=queuedEvent.UseFinalSnapSnapshot, trace=trace)
+                # Write it to the outbox before the first attempt, so it's not lost if we restart while sending.
+                # If the event had an older outbox entry, this replaces it.
+                if self.Outbox is not None and queuedEvent.RequestArgs_CanBeNone is not None:
+                    self._onQueuedEventDiscarded(queuedEvent)
+                    queuedEvent.OutboxId_CanBeNone = self.Outbox.Add(event, queuedEvent.PrintId, queuedEvent.Priority, queuedEvent.RequestArgs_CanBeNone[0], queuedEvent.Attempts)
+            elif self.Outbox is not None and queuedEvent.OutboxId_CanBeNone is not None:
+                self.Outbox.RecordAttempt(queuedEvent.OutboxId_CanBeNone, queuedEvent.Attempts)
+            requestArgs = queuedEvent.RequestArgs_CanBeNone
 
             # Handle the result indicating we don't have the proper var to send yet.
             if requestArgs is None:
                 Sentry.Info("NOTIFICATION", "NotificationsHandler didn't send the "+str(event)+" event because we don't have the proper id and key yet.")
-                return False
+                return None
 
             # Break out the response
             args = requestArgs[0]
-            files = requestArgs[1]
 
             # Use fairly aggressive retry logic on notifications if they fail to send.
             # This is important because they power some of the other features of OctoApp now, so having them as accurate as possible is ideal.
-            attempts = 0
-            while attempts < 3:
-                attempts += 1
-                statusCode = 0
-                try:
-                    # Since we are sending the snapshot, we must send a multipart form.
-                    # Thus we must use the data and files fields, the json field will not work.
-                    #r = requests.post(eventApiUrl, data=args, files=files, timeout=5*60)
-                    Sentry.Info("NOTIFICATIONS", "Sending %s (%s)" % (event, args))
-                    self.NotificationSender.SendNotification(event=event, state=args)
-
+            try:
+                Sentry.Info("NOTIFICATIONS", "Sending %s (%s)" % (event, args))
+                if self.NotificationSender.SendNotification(event=event, state=args, trace=trace):
                     # If success
-                    return True
-
-                except Exception as e:
-                    # We must try catch the connection because sometimes it will throw for some connection issues, like DNS errors, server not connectable, etc.
-                    Sentry.ExceptionNoSend("Failed to send notification due to a connection error. ", e)
-
-                # On failure, log the issue.
-                Sentry.Warn("NOTIFICATION", f"NotificationsHandler failed to send event {str(event)}. Code:{str(statusCode)}. Waiting and then trying again.")
+                    if trace is not None:
+                        trace.Finish("sent")
+                    return None
 
-                # If the error is in the 400 class, don't retry since these are all indications there's something
-                # wrong with the request, which won't change. But we don't want to include anything above or below that.
-                if statusCode > 399 and statusCode < 500:
-                    return False
+            except Exception as e:
+                # We must try catch the connection because sometimes it will throw for some connection issues, like DNS errors, server not connectable, etc.
+                Sentry.ExceptionNoSend("Failed to send notification due to a connection error. ", e)
 
-                # We have quite a few reties and back off a decent amount. As said above, we want these to be reliable as possible, even if they are late.
-                # We want the first few retires to be quick, so the notifications happens ASAP. This will help in teh case where the server is updating, it should be
-                # back withing 2-4 seconds, but 20 is a good time to wait.
-                # If it's still failing, we want to allow the system some time to do a do a fail over or something, thus we give the retry timer more time.
-                if attempts < 1: # Attempt 1 and 2 will wait 20 seconds.
-                    time.sleep(20)
-                else: # Attempt 3, 4, 5 will wait longer.
-                    time.sleep(60 * attempts)
+            if queuedEvent.Attempts >= NotificationsHandler.SendEventMaxAttempts:
+                # We never sent it successfully.
+                Sentry.Error("NOTIFICATION", "NotificationsHandler failed to send event "+str(event)+" due to a network issues after many retries.")
+                return None
 
-            # We never sent it successfully.
-            Sentry.Error("NOTIFICATION", "NotificationsHandler failed to send event "+str(event)+" due to a network issues after many retries.")
+            # On failure, log the issue.
+            # We have quite a few reties and back off a decent amount. As said above, we want these to be reliable as possible, even if they are late.
+            # If it's failing, we want to allow the system some time to do a do a fail over or something, thus we give the retry timer more time.
+            # The event goes into the retry heap while we wait, so it doesn't hold a worker.
+            retryDelaySec = 20 if queuedEvent.Attempts == 1 else 60 * queuedEvent.Attempts
+            Sentry.Warn("NOTIFICATION", f"NotificationsHandler failed to send event {str(event)}. Trying again in {retryDelaySec}s.")
+            return retryDelaySec
 
         except Exception as e:
             Sentry.Exception("NotificationsHandler failed to send event code "+str(event), e)
 
-        return False
+        return None
 
 
     # Used by notifications and gadget to build a common event args.
     # Returns an array of [args, files] which are ready to be used in the request.
     # Returns None if the system isn't ready yet.
-    def BuildCommonEventArgs(self, event, args=None, progressOverwriteFloat=None, snapshotResizeParams = None, useFinalSnapSnapshot = False):
+    # If a NotificationTrace is given, the final snap and the args are marked as stages.
+    def BuildCommonEventArgs(self, event, args=None, progressOverwriteFloat=None, snapshotResizeParams = None, useFinalSnapSnapshot = False, trace = None):
         # Default args
         if args is None:
             args = {}
@@ -1060,7 +1117,11 @@ class NotificationsHandler:
         # If we are requested to use a final snapshot, try to use the snapshot from it.
         # This should only be requested for the "done" notification.
         if useFinalSnapSnapshot:
+            if trace is not None:
+                trace.Mark("build_args")
             snapshot = self._getFinalSnapSnapshotAndStop()
+            if trace is not None:
+                trace.Mark("final_snap")
 
         # If we don't have a snapshot, try to get one now.
         #if snapshot is None:
@@ -1070,6 +1131,8 @@ class NotificationsHandler:
         if snapshot is not None:
             files['attachment'] = ("snapshot.jpg", snapshot)
 
+        if trace is not None and useFinalSnapSnapshot is False:
+            trace.Mark("build_args")
         return [args, files]
 
 
@@ -1081,21 +1144,13 @@ class NotificationsHandler:
         if progressTimer is not None:
             progressTimer.Stop()
 
-        # Stop the first layer timer.
-        self.StopFirstLayerTimer()
+        # Stop the first layer tracking.
+        self.StopLayerTracking()
 
         # Stop Gadget From Watching
         # self.Gadget.StopWatching()
 
 
-    def StopFirstLayerTimer(self):
-        # Capture locally & Stop
-        firstLayerTimer = self.FirstLayerTimer
-        self.FirstLayerTimer = None
-        if firstLayerTimer is not None:
-            firstLayerTimer.Stop()
-
-
     # Starts all print timers, including the progress time, Gadget, and the first layer watcher.
     def StartPrintTimers(self, resetHoursReported, restoreActionSetHoursReportedInt_OrNone):
         # First, stop any timer that's currently running.
@@ -1115,11 +1170,8 @@ class NotificationsHandler:
         timer.start()
         self.ProgressTimer = timer
 
-        # Setup the first layer watcher - we use a different timer since this timer is really short lived and it fires much more often.
-        intervalSec = NotificationsHandler.FirstLayerTimerIntervalSec
-        firstLayerTimer = RepeatTimer(intervalSec, self.FirstLayerTimerCallback)
-        firstLayerTimer.start()
-        self.FirstLayerTimer = firstLayerTimer
+        # Start the first layer watcher, it's driven by the layer and z offset updates from the platform.
+        self.StartLayerTracking()
 
         # Start Gadget From Watching
         # self.Gadget.StartWatching()
@@ -1149,19 +1201,6 @@ class NotificationsHandler:
         self.OnPrintTimerProgress()
 
 
-    # Fired when the ping timer fires.
-    def FirstLayerTimerCallback(self):
-
-        # Don't check the printer state, we will allow the function to handle all of that
-        # If the function returns True, the timer should continue. If it returns false, the time should be stopped.
-        if self._OnFirstLayerWatchTimer() is True:
-            return
-
-        # Stop the timer.
-        Sentry.Info("NOTIFICATION", "First layer timer is done. Stopping.")
-        self.StopFirstLayerTimer()
-
-
     # Only allows possibly spammy events to be sent every x minutes.
     # Returns true if the event can be sent, otherwise false.
     def _shouldSendSpammyEvent(self, eventName, minTimeBetweenMinutesFloat):
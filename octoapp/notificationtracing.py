@@ -0,0 +1,134 @@
+import threading
+import time
+from collections import deque
+
+from .sentry import Sentry
+from .taskscheduler import TaskScheduler
+
+# Traces one attempt to send a notification event through the pipeline.
+#
+# Each stage calls Mark when it's done, and the time since the previous mark is recorded as that stage's duration.
+# The first stage is the time the event waited in the queue, measured from when it was added.
+# The timestamps are from time.monotonic, so they aren't affected by clock changes.
+class NotificationTrace:
+
+    def __init__(self, event:str, enqueuedAtMonotonic:float) -> None:
+        self.Event = event
+        self.StartedAt = enqueuedAtMonotonic
+        self.LastMarkAt = enqueuedAtMonotonic
+        # A list of (stage, durationSec)
+        self.Stages = []
+
+
+    # Records the end of a stage.
+    def Mark(self, stage:str) -> None:
+        now = time.monotonic()
+        self.Stages.append((stage, now - self.LastMarkAt))
+        self.LastMarkAt = now
+
+
+    # Records the total time and adds the trace to the rolling stats.
+    def Finish(self, result:str) -> None:
+        total = time.monotonic() - self.StartedAt
+        stagesStr = ", ".join([f"{stage}: {int(durationSec * 1000)}ms" for stage, durationSec in self.Stages])
+        Sentry.Debug("NOTIFICATION", f"Trace {self.Event} {result} in {int(total * 1000)}ms ({stagesStr})")
+        NotificationLatencyStats.Get().Add(self.Event, self.Stages, total)
+
+
+# Keeps the rolling latency percentiles of the notification pipeline, per stage and per event type.
+#
+# Only the last c_WindowSize samples are kept for each, so the percentiles follow the recent behavior and the memory is fixed.
+# Every c_SummaryIntervalSec a summary is logged and handed to the summary listeners, like the Moonraker agent event.
+class NotificationLatencyStats:
+
+    # Logic for a static singleton
+    _Instance = None
+    _InstanceLock = threading.Lock()
+
+    c_WindowSize = 128
+    c_SummaryIntervalSec = 30 * 60
+
+    c_TotalStage = "total"
+
+    @staticmethod
+    def Get():
+        if NotificationLatencyStats._Instance is None:
+            with NotificationLatencyStats._InstanceLock:
+                if NotificationLatencyStats._Instance is None:
+                    NotificationLatencyStats._Instance = NotificationLatencyStats()
+        return NotificationLatencyStats._Instance
+
+
+    def __init__(self) -> None:
+        self.Lock = threading.Lock()
+        # stage -> deque of durations
+        self.ByStage = {}
+        # event -> stage -> deque of durations
+        self.ByEvent = {}
+        self.SampleCount = 0
+        self.SampleCountAtLastSummary = 0
+        self.SummaryListeners = []
+        TaskScheduler.Get().Schedule("NotificationLatencySummary", NotificationLatencyStats.c_SummaryIntervalSec, self._Summarize)
+
+
+    def Add(self, event:str, stages:list, totalSec:float) -> None:
+        with self.Lock:
+            self.SampleCount += 1
+            eventStages = self.ByEvent.get(event, None)
+            if eventStages is None:
+                eventStages = {}
+                self.ByEvent[event] = eventStages
+            for stage, durationSec in stages + [(NotificationLatencyStats.c_TotalStage, totalSec)]:
+                self._GetWindow(self.ByStage, stage).append(durationSec)
+                self._GetWindow(eventStages, stage).append(durationSec)
+
+
+    # listener(statsDict) is called with GetStats() every time the periodic summary runs and there are new samples.
+    def AddSummaryListener(self, listener) -> None:
+        with self.Lock:
+            self.SummaryListeners.append(listener)
+
+
+    # Returns the p50, p95 and p99 in milliseconds and the sample count, for every stage and for every stage of each event.
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Samples": self.SampleCount,
+                "Stages": {stage: NotificationLatencyStats._Percentiles(window) for stage, window in self.ByStage.items()},
+                "Events": {event: {stage: NotificationLatencyStats._Percentiles(window) for stage, window in stages.items()} for event, stages in self.ByEvent.items()},
+            }
+
+
+    def _GetWindow(self, d:dict, stage:str) -> deque:
+        window = d.get(stage, None)
+        if window is None:
+            window = deque(maxlen=NotificationLatencyStats.c_WindowSize)
+            d[stage] = window
+        return window
+
+
+    @staticmethod
+    def _Percentiles(window:deque) -> dict:
+        values = sorted(window)
+        count = len(values)
+        def p(percent):
+            # Nearest rank
+            index = min(count - 1, max(0, int(percent / 100.0 * count + 0.5) - 1))
+            return round(values[index] * 1000.0, 1)
+        return {"Count": count, "P50Ms": p(50), "P95Ms": p(95), "P99Ms": p(99)}
+
+
+    def _Summarize(self) -> None:
+        with self.Lock:
+            if self.SampleCount == self.SampleCountAtLastSummary:
+                return
+            self.SampleCountAtLastSummary = self.SampleCount
+            listeners = list(self.SummaryListeners)
+        stats = self.GetStats()
+        stagesStr = ", ".join([f"{stage} p50 {s['P50Ms']}ms p95 {s['P95Ms']}ms p99 {s['P99Ms']}ms" for stage, s in stats["Stages"].items()])
+        Sentry.Info("NOTIFICATION", f"Notification latency over the last {NotificationLatencyStats.c_WindowSize} events: {stagesStr}")
+        for listener in listeners:
+            try:
+                listener(stats)
+            except Exception as e:
+                Sentry.ExceptionNoSend("Notification latency summary listener failed.", e)
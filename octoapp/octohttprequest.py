@@ -122,8 +122,9 @@ class OctoHttpRequest:
     # Instead, the system needs to handle the redirect 301 or 302 call as normal, sending it back to the caller, and allowing them to follow the redirect if needed.
     # The X-Forwarded-Host header will tell the OctoPrint server the correct place to set the location redirect header.
     # However, for calls that aren't proxy calls, things like local snapshot requests and such, we want to allow redirects to be more robust.
+    # timeoutSec limits how long we wait to connect and for each read of the response.
     @staticmethod
-    def MakeHttpCall(logger, pathOrUrl, pathOrUrlType, method, headers, data=None, allowRedirects=False):
+    def MakeHttpCall(logger, pathOrUrl, pathOrUrlType, method, headers, data=None, allowRedirects=False, timeoutSec:float = 1800):
         # First of all, we need to figure out what the URL is. There are two options
         #
         # 1) Absolute URLs
@@ -248,7 +249,7 @@ class OctoHttpRequest:
 
         # First, try the main URL.
         # For the first main url, we set the main response to None and is fallback to False.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Main request", method, url, headers, data, None, False, fallbackUrl, allowRedirects)
+        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Main request", method, url, headers, data, None, False, fallbackUrl, allowRedirects, timeoutSec)
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
@@ -258,7 +259,7 @@ class OctoHttpRequest:
         mainResult = ret.Result
 
         # Main failed, try the fallback, which should be the http proxy.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Http proxy fallback", method, fallbackUrl, headers, data, mainResult, True, fallbackLocalIpHttpProxySuffix, allowRedirects)
+        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Http proxy fallback", method, fallbackUrl, headers, data, mainResult, True, fallbackLocalIpHttpProxySuffix, allowRedirects, timeoutSec)
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
@@ -271,7 +272,7 @@ class OctoHttpRequest:
         # With the local IP, first try to use the http proxy URL, since it's the most likely to be bound to the public IP and not firewalled.
         # It's important we use the right http proxy protocol with the http proxy port.
         localIpFallbackUrl = httpProxyProtocol + localIp + fallbackLocalIpHttpProxySuffix
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP Http Proxy Fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackLocalIpOctoPrintPortSuffix, allowRedirects)
+        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP Http Proxy Fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackLocalIpOctoPrintPortSuffix, allowRedirects, timeoutSec)
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
@@ -279,7 +280,7 @@ class OctoHttpRequest:
 
         # Now try the OcotoPrint direct port with the local IP.
         localIpFallbackUrl = "http://" + localIp + fallbackLocalIpOctoPrintPortSuffix
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackWebcamUrl, allowRedirects)
+        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Local IP fallback", method, localIpFallbackUrl, headers, data, mainResult, True, fallbackWebcamUrl, allowRedirects, timeoutSec)
         # If the function reports the chain is done, the next fallback URL is invalid and we should always return
         # whatever is in the Response, even if it's None.
         if ret.IsChainDone:
@@ -288,7 +289,7 @@ class OctoHttpRequest:
         # If all others fail, try the hardcoded webcam URL.
         # Note this has to be last, because there commonly isn't a fallbackWebcamUrl, so it will stop the
         # chain of other attempts.
-        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Webcam hardcode fallback", method, fallbackWebcamUrl, headers, data, mainResult, True, None, allowRedirects)
+        ret = OctoHttpRequest.MakeHttpCallAttempt(logger, "Webcam hardcode fallback", method, fallbackWebcamUrl, headers, data, mainResult, True, None, allowRedirects, timeoutSec)
         # No matter what, always return the result now.
         return ret.Result
 
@@ -310,12 +311,12 @@ class OctoHttpRequest:
 
     # This function should always return a AttemptResult object.
     @staticmethod
-    def MakeHttpCallAttempt(logger, attemptName, method, url, headers, data, mainResult, isFallback, nextFallbackUrl, allowRedirects:bool = False):
+    def MakeHttpCallAttempt(logger, attemptName, method, url, headers, data, mainResult, isFallback, nextFallbackUrl, allowRedirects:bool = False, timeoutSec:float = 1800):
         response = None
         try:
             # Try to make the http call.
             #
-            # Note we use a long timeout because some api calls can hang for a while.
+            # Note we use a long timeout by default because some api calls can hang for a while.
             # For example when plugins are installed, some have to compile which can take some time.
             #
             # See the note about allowRedirects above MakeHttpCall.
@@ -326,7 +327,7 @@ class OctoHttpRequest:
             # This means that response.content will not be valid and we will always use the iter_content. But it also means
             # iter_content will ready into memory on demand and throw when the stream is consumed. This is important, because
             # our logic relies on the exception when the stream is consumed to end the http response stream.
-            response = requests.request(method, url, headers=headers, data=data, timeout=1800, allow_redirects=allowRedirects, stream=True, verify=False)
+            response = requests.request(method, url, headers=headers, data=data, timeout=timeoutSec, allow_redirects=allowRedirects, stream=True, verify=False)
         except Exception as e:
             logger.info(attemptName + " http URL threw an exception: "+str(e))
 
@@ -341,7 +342,7 @@ class OctoHttpRequest:
             else:
                 logger.warn(url + " http call returned no response on Windows. Trying again with no headers.")
             try:
-                response = requests.request(method, url, headers={}, data=data, timeout=1800, allow_redirects=False, stream=True, verify=False)
+                response = requests.request(method, url, headers={}, data=data, timeout=timeoutSec, allow_redirects=False, stream=True, verify=False)
             except Exception as e:
                 logger.info(attemptName + " http NO HEADERS URL threw an exception: "+str(e))
 
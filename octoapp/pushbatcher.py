@@ -0,0 +1,109 @@
+import threading
+import time
+
+from .sentry import Sentry
+
+# Groups push payloads of the same kind for the same targets that are sent within a short window into one request.
+#
+# Events often come in bursts, like a progress update right after a time progress update. The first payload for a set
+# of targets opens a window, anything else of the same kind for the same targets that shows up before the window closes
+# joins it, and then one request is sent for all of them. Everyone who joined waits for that request and gets its result.
+#
+# Only payloads of the same kind are merged, since the newest payload is also sent as the top level notification,
+# for servers that don't know about batches. A paused alert must never be hidden behind a progress update.
+#
+# State updates, like progress, only matter as the latest value, so if a batch has more than one of them only
+# the newest is kept.
+class PushBatcher:
+
+    # The longest we will wait for a batch someone else is sending.
+    c_FollowerMaxWaitSec = 60.0
+
+    # sendFunc(targets, payloads) must send the payloads in one request and return True on success or False if it should be retried.
+    def __init__(self, sendFunc) -> None:
+        self.SendFunc = sendFunc
+        self.Lock = threading.Lock()
+        # Target key -> the open _PushBatch
+        self.OpenBatches = {}
+        # Metrics
+        self.PayloadCount = 0
+        self.RequestCount = 0
+        self.SupersededCount = 0
+
+
+    # Adds the payload to the open batch of this kind for these targets, or opens a new one.
+    # payload is a dict with highPriority, androidData, apnsData and isStateUpdate.
+    # kind is any string, only payloads with the same kind are sent together.
+    # Blocks until the batch is sent, and returns the send result.
+    def Send(self, targets:list, payload:dict, windowSec:float, kind:str) -> bool:
+        key = (kind, tuple(sorted(t.FcmToken for t in targets)))
+        isLeader = False
+        with self.Lock:
+            self.PayloadCount += 1
+            batch = self.OpenBatches.get(key, None)
+            if batch is None:
+                batch = _PushBatch(targets)
+                self.OpenBatches[key] = batch
+                isLeader = True
+            batch.Payloads.append(payload)
+
+        if isLeader:
+            self._RunBatch(key, batch, windowSec)
+        elif batch.DoneEvent.wait(PushBatcher.c_FollowerMaxWaitSec) is False:
+            Sentry.Warn("SENDER", "Timed out waiting on a batched push.")
+            return False
+        return batch.Result
+
+
+    def GetStats(self) -> dict:
+        with self.Lock:
+            return {
+                "Payloads": self.PayloadCount,
+                "Requests": self.RequestCount,
+                "Superseded": self.SupersededCount,
+            }
+
+
+    def _RunBatch(self, key, batch, windowSec:float) -> None:
+        result = False
+        try:
+            # Give anything else in the burst a chance to join.
+            time.sleep(windowSec)
+            with self.Lock:
+                # Close the batch, anything after this starts a new one.
+                if self.OpenBatches.get(key, None) is batch:
+                    del self.OpenBatches[key]
+                payloads = PushBatcher._DropSupersededStateUpdates(batch.Payloads)
+                self.SupersededCount += len(batch.Payloads) - len(payloads)
+                self.RequestCount += 1
+            if len(batch.Payloads) > 1:
+                Sentry.Info("SENDER", f"Sending {len(payloads)} batched pushes, from {len(batch.Payloads)} payloads.")
+            result = self.SendFunc(batch.Targets, payloads)
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to send batched push", e)
+        finally:
+            with self.Lock:
+                if self.OpenBatches.get(key, None) is batch:
+                    del self.OpenBatches[key]
+            batch.Result = result
+            batch.DoneEvent.set()
+
+
+    # Keeps all payloads, except state updates that have a newer state update after them. The order is kept.
+    @staticmethod
+    def _DropSupersededStateUpdates(payloads:list) -> list:
+        lastStateUpdate = None
+        for p in payloads:
+            if p.get("isStateUpdate", False):
+                lastStateUpdate = p
+        return [p for p in payloads if p.get("isStateUpdate", False) is False or p is lastStateUpdate]
+
+
+# A batch of payloads for one set of targets.
+class _PushBatch:
+
+    def __init__(self, targets:list) -> None:
+        self.Targets = targets
+        self.Payloads = []
+        self.DoneEvent = threading.Event()
+        self.Result = False
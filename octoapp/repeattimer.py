@@ -1,33 +1,43 @@
-import threading
 from .sentry import Sentry
+from .taskscheduler import TaskScheduler
 
-class RepeatTimer(threading.Thread):
-    def __init__(self, intervalSec:int, func):
-        threading.Thread.__init__(self)
-        self.stopEvent = threading.Event()
+# Calls a function at a fixed interval until stopped.
+# This used to be a thread per timer, now it's a task on the shared TaskScheduler, but the interface is the same.
+class RepeatTimer:
+    # If the callback can block, like on network or camera I/O, a TaskScheduler lane must be set.
+    def __init__(self, intervalSec:int, func, name:str = None, lane:str = None):
         self.intervalSec = intervalSec
+        self.lane = lane
         self.callback = func
+        self.name = name if name is not None else getattr(func, "__qualname__", "RepeatTimer")
         self.running = True
+        self.task = None
 
 
-    # Overwrite the thread function.
-    def run(self):
-        # Loop while the event isn't set and the thread is still alive.
-        while not self.stopEvent.wait(self.intervalSec) and self.is_alive() and self.running:
-            try:
-                # Ensure we don't fire the callback if we weren't asked to.
-                if self.running is not True:
-                    return
-                self.callback()
-            except Exception as e:
-                Sentry.Exception("Exception in RepeatTimer thread.", e)
-        Sentry.Info("RepeatTimer", "Thread exit")
+    # Starts the timer, the first call is one interval from now.
+    def start(self):
+        if self.running is False or self.task is not None:
+            return
+        self.task = TaskScheduler.Get().Schedule(self.name, self.intervalSec, self._onTask, lane=self.lane)
+
+
+    def _onTask(self):
+        # Ensure we don't fire the callback if we weren't asked to.
+        if self.running is not True:
+            return
+        try:
+            self.callback()
+        except Exception as e:
+            Sentry.Exception("Exception in RepeatTimer callback.", e)
 
 
     # Used to update the repeat interval. This can be called while the timer is running
     # or even while in the callback.
     def SetInterval(self, intervalSec:int):
         self.intervalSec = intervalSec
+        task = self.task
+        if task is not None:
+            task.SetInterval(intervalSec)
 
 
     # Returns the current interval time in seconds
@@ -43,4 +53,6 @@ class RepeatTimer(threading.Thread):
     # Used to stop the timer.
     def Stop(self):
         self.running = False
-        self.stopEvent.set()
+        task = self.task
+        if task is not None:
+            task.Cancel()
@@ -2,7 +2,11 @@
 #  A class argument that allows requesters to resize down and crop the image if desired.
 class SnapshotResizeParams:
 
-    def __init__(self, size, resizeToHeight = False, resizeToWidth = False, cropSquareCenterNoPadding = False):
+    # The jpeg quality used if the image has to be re-encoded, when the requester doesn't set one.
+    # The notification images are shown on a phone, where the difference to higher qualities can't be seen, but the size can.
+    c_DefaultJpegQuality = 85
+
+    def __init__(self, size, resizeToHeight = False, resizeToWidth = False, cropSquareCenterNoPadding = False, jpegQuality = c_DefaultJpegQuality):
         # The size that will be used for the resize.
         self.Size = size
         if self.Size < 2:
@@ -17,3 +21,7 @@ class SnapshotResizeParams:
         self.ResizeToWidth = resizeToWidth
         # If set to True, the size will be used for the height and width, and the image will remain uniform, but cropped to center.
         self.CropSquareCenterNoPadding = cropSquareCenterNoPadding
+
+        # The jpeg quality to use if the image is re-encoded, from 1 to 95.
+        # If nothing about the image changes, the original image is used as is.
+        self.JpegQuality = max(1, min(95, int(jpegQuality)))
@@ -0,0 +1,199 @@
+import io
+import math
+
+from .sentry import Sentry
+from .snapshotresizeparams import SnapshotResizeParams
+
+try:
+    # On some systems this package will install but the import will fail due to a missing system .so.
+    # Since most setups don't use this package, we will import it with a try catch and if it fails we
+    # won't use it.
+    from PIL import Image
+    from PIL import ImageFile
+except Exception as _:
+    Image = None
+    ImageFile = None
+
+
+# Applies the webcam flips and rotation and the requested resize to a snapshot.
+#
+# This runs for every image we send, often on slow ARM boards, so it tries to touch as few pixels as it can:
+#   - When the image is shrunk, the jpeg decoder is asked to do most of it with draft mode. The decoder can scale by
+#     1/2, 1/4 or 1/8 while decoding, which skips most of the decode work, and the resize is done on the smaller image.
+#   - The flips and 90 degree rotations are folded into one transpose, rather than a pass over the image for each.
+#   - The jpeg quality is picked by the requester, since the image is re-encoded.
+# If nothing about the image needs to change, the original buffer is returned, to preserve quality.
+class SnapshotTransform:
+
+    @staticmethod
+    def IsAvailable() -> bool:
+        return Image is not None
+
+
+    # Returns the transformed image, or the snapshot itself if nothing had to change.
+    # Rotation is clockwise, in degrees. Throws if the image can't be processed.
+    @staticmethod
+    def Apply(snapshot, snapshotResizeParams:SnapshotResizeParams, flipH:bool, flipV:bool, rotation:int):
+        if rotation is None:
+            rotation = 0
+        transpose, swapsAxes, rotateCcw = SnapshotTransform._GetOrientation(flipH, flipV, rotation)
+        if transpose is None and rotateCcw == 0 and snapshotResizeParams is None:
+            return snapshot
+
+        # We noticed that on some under powered or otherwise bad systems the image returned
+        # by mjpeg is truncated. We aren't sure why this happens, but setting this flag allows us to sill
+        # manipulate the image even though we didn't get the whole thing. Otherwise, we would use the raw snapshot
+        # buffer, which is still an incomplete image.
+        ImageFile.LOAD_TRUNCATED_IMAGES = True
+
+        # Opening the image only reads the header, so we know the size before anything is decoded.
+        didWork = False
+        pilImage = Image.open(io.BytesIO(snapshot))
+
+        # Figure out the final size, from the size the image will have after it's flipped and rotated.
+        resizeTo = None
+        if snapshotResizeParams is not None:
+            width, height = pilImage.size
+            if swapsAxes:
+                width, height = height, width
+            resizeTo = SnapshotTransform._GetResizeTarget(width, height, snapshotResizeParams)
+
+        # If we are shrinking a jpeg, let the decoder do as much of it as it can.
+        # The decoder picks the largest scale that's still at least the size we ask for, so the resize below finishes the job.
+        if resizeTo is not None and pilImage.format == "JPEG":
+            draftSize = (resizeTo[1], resizeTo[0]) if swapsAxes else resizeTo
+            sizeBefore = pilImage.size
+            pilImage.draft(pilImage.mode, draftSize)
+            if pilImage.size != sizeBefore:
+                didWork = True
+
+        # Do the flips and rotation, on the smaller image.
+        if transpose is not None:
+            pilImage = pilImage.transpose(transpose)
+            didWork = True
+        if rotateCcw != 0:
+            pilImage = pilImage.rotate(rotateCcw)
+            didWork = True
+
+        if resizeTo is not None and pilImage.size != resizeTo:
+            pilImage = pilImage.resize(resizeTo)
+            didWork = True
+
+        # Now if we want to crop square, use the resized image to crop the remaining side.
+        if snapshotResizeParams is not None and snapshotResizeParams.CropSquareCenterNoPadding:
+            cropBox = SnapshotTransform._GetCenterCropBox(pilImage.width, pilImage.height, snapshotResizeParams)
+            if cropBox is None:
+                Sentry.Error("NOTIFICATION", "Failed to crop image. height: "+str(pilImage.height)+", width: "+str(pilImage.width)+", size: "+str(snapshotResizeParams.Size))
+            else:
+                pilImage = pilImage.crop(cropBox)
+                didWork = True
+
+        # If we did some operation, save the image buffer back to a jpeg.
+        # If we didn't do work, keep the original, to preserve quality.
+        if didWork is False:
+            return snapshot
+        quality = SnapshotResizeParams.c_DefaultJpegQuality if snapshotResizeParams is None else snapshotResizeParams.JpegQuality
+        if pilImage.mode not in ("RGB", "L", "CMYK"):
+            pilImage = pilImage.convert("RGB")
+        buffer = io.BytesIO()
+        pilImage.save(buffer, format="JPEG", quality=quality)
+        return buffer.getvalue()
+
+
+    # Folds the flips and the clockwise rotation into one transpose.
+    # Returns (transpose or None, if the transpose swaps the width and height, any remaining counter clockwise rotation)
+    #
+    # The flips are applied before the rotation. Flipping both ways is the same as rotating 180, and flipping
+    # vertically is the same as flipping horizontally and rotating 180, so everything becomes an optional
+    # horizontal flip followed by a rotation.
+    @staticmethod
+    def _GetOrientation(flipH:bool, flipV:bool, rotation:int):
+        mirror = False
+        if flipH and flipV:
+            rotation += 180
+        elif flipV:
+            rotation += 180
+            mirror = True
+        elif flipH:
+            mirror = True
+        rotation = rotation % 360
+
+        if rotation % 90 != 0:
+            # Not something a transpose can do, so rotate it the same way we always have.
+            transpose = SnapshotTransform._GetTranspose("FLIP_LEFT_RIGHT") if mirror else None
+            return transpose, False, 360 - rotation
+
+        # PIL's rotations are counter clockwise.
+        if mirror:
+            name = {0: "FLIP_LEFT_RIGHT", 90: "TRANSVERSE", 180: "FLIP_TOP_BOTTOM", 270: "TRANSPOSE"}[rotation]
+        else:
+            name = {0: None, 90: "ROTATE_270", 180: "ROTATE_180", 270: "ROTATE_90"}[rotation]
+        if name is None:
+            return None, False, 0
+        return SnapshotTransform._GetTranspose(name), rotation in (90, 270), 0
+
+
+    # In pillow ~9.1.0 these constants moved.
+    @staticmethod
+    def _GetTranspose(name:str):
+        # pylint: disable=no-member
+        transposeEnum = getattr(Image, "Transpose", None)
+        if transposeEnum is not None:
+            return getattr(transposeEnum, name)
+        return getattr(Image, name)
+
+
+    # Returns the (width, height) the image should be resized to, or None if it shouldn't be.
+    @staticmethod
+    def _GetResizeTarget(width:int, height:int, snapshotResizeParams:SnapshotResizeParams):
+        # First, if we want to scale and crop to center, we will use the resize operation to get the image
+        # scale (preserving the aspect ratio). We will use the smallest side to scale to the desired outcome.
+        if snapshotResizeParams.CropSquareCenterNoPadding:
+            # We will only do the crop resize if the source image is smaller than or equal to the desired size.
+            if height >= snapshotResizeParams.Size and width >= snapshotResizeParams.Size:
+                if height < width:
+                    snapshotResizeParams.ResizeToHeight = True
+                    snapshotResizeParams.ResizeToWidth = False
+                else:
+                    snapshotResizeParams.ResizeToHeight = False
+                    snapshotResizeParams.ResizeToWidth = True
+
+        resizeHeight = None
+        resizeWidth = None
+        if snapshotResizeParams.ResizeToHeight:
+            if height > snapshotResizeParams.Size:
+                resizeHeight = snapshotResizeParams.Size
+                resizeWidth = int((float(snapshotResizeParams.Size) / float(height)) * float(width))
+        if snapshotResizeParams.ResizeToWidth:
+            if width > snapshotResizeParams.Size:
+                resizeHeight = int((float(snapshotResizeParams.Size) / float(width)) * float(height))
+                resizeWidth = snapshotResizeParams.Size
+        if resizeHeight is None or resizeWidth is None:
+            return None
+        return (max(1, resizeWidth), max(1, resizeHeight))
+
+
+    # Returns the (left, upper, right, lower) box to crop the resized image to a center square, or None if it can't be.
+    @staticmethod
+    def _GetCenterCropBox(width:int, height:int, snapshotResizeParams:SnapshotResizeParams):
+        if snapshotResizeParams.ResizeToHeight:
+            # Crop the width - use floor to ensure if there's a remainder we float left.
+            centerX = math.floor(float(width) / 2.0)
+            halfWidth = math.floor(float(snapshotResizeParams.Size) / 2.0)
+            upper = 0
+            lower = snapshotResizeParams.Size
+            left = centerX - halfWidth
+            right = (snapshotResizeParams.Size - halfWidth) + centerX
+        else:
+            # Crop the height - use floor to ensure if there's a remainder we float left.
+            centerY = math.floor(float(height) / 2.0)
+            halfHeight = math.floor(float(snapshotResizeParams.Size) / 2.0)
+            upper = centerY - halfHeight
+            lower = (snapshotResizeParams.Size - halfHeight) + centerY
+            left = 0
+            right = snapshotResizeParams.Size
+
+        # Sanity check bounds
+        if left < 0 or left > right or right > width or upper < 0 or upper > lower or lower > height:
+            return None
+        return (left, upper, right, lower)
@@ -0,0 +1,277 @@
+import heapq
+import queue
+import random
+import threading
+import time
+
+from .sentry import Sentry
+
+# A repeating task that runs on the TaskScheduler.
+class ScheduledTask:
+
+    # The upper bounds of the latency histogram buckets, in seconds. Anything larger goes in the last bucket.
+    c_LatencyBucketsSec = [0.01, 0.1, 1.0, 10.0]
+    c_LatencyBucketNames = ["<10ms", "<100ms", "<1s", "<10s", ">=10s"]
+
+    def __init__(self, scheduler, name:str, intervalSec:float, func, jitterSec:float, repeat:bool = True, lane:str = None) -> None:
+        self.Scheduler = scheduler
+        self.Name = name
+        # If set, the task runs on the dedicated worker of this lane, rather than the shared workers.
+        self.Lane = lane
+        self.IntervalSec = intervalSec
+        self.Func = func
+        self.JitterSec = jitterSec
+        # One shot tasks run once and are then done.
+        self.Repeat = repeat
+        self.Running = True
+        # When the task is due next, in time.monotonic, and a version that's bumped every time it's rescheduled.
+        # Heap entries with an old version are ignored, that's how cancel and interval changes work without searching the heap.
+        self.DueAt = 0.0
+        self.Version = 0
+        # Set while the callback is running, so the scheduler knows not to queue it again.
+        self.InCallback = False
+        self.LastRunEndedAt = 0.0
+        # Metrics
+        self.RunCount = 0
+        self.OverrunCount = 0
+        self.MaxRunSec = 0.0
+        self.LatencyHistogram = [0] * len(ScheduledTask.c_LatencyBucketNames)
+
+
+    # Stops the task. If the callback is running it will finish, but it won't be called again.
+    def Cancel(self) -> None:
+        self.Scheduler.CancelTask(self)
+
+
+    # Updates the repeat interval. This can be called while the task is waiting or even from inside the callback.
+    # If the task is waiting, it's moved so it runs one new interval after the last run.
+    def SetInterval(self, intervalSec:float) -> None:
+        self.Scheduler.SetTaskInterval(self, intervalSec)
+
+
+    def GetInterval(self) -> float:
+        return self.IntervalSec
+
+
+    def IsRunning(self) -> bool:
+        return self.Running
+
+
+    def GetStats(self) -> dict:
+        return {
+            "Lane": self.Lane if self.Lane is not None else "Shared",
+            "IntervalSec": self.IntervalSec,
+            "Runs": self.RunCount,
+            # The number of runs that took longer than the interval.
+            "Overruns": self.OverrunCount,
+            "MaxRunMs": round(self.MaxRunSec * 1000.0, 1),
+            # How late the runs started after they were due.
+            "Latency": dict(zip(ScheduledTask.c_LatencyBucketNames, self.LatencyHistogram)),
+        }
+
+
+    def RecordRun(self, latencySec:float, runSec:float) -> None:
+        self.RunCount += 1
+        self.MaxRunSec = max(self.MaxRunSec, runSec)
+        if runSec > self.IntervalSec:
+            self.OverrunCount += 1
+        bucket = len(ScheduledTask.c_LatencyBucketsSec)
+        for i, upperBoundSec in enumerate(ScheduledTask.c_LatencyBucketsSec):
+            if latencySec < upperBoundSec:
+                bucket = i
+                break
+        self.LatencyHistogram[bucket] += 1
+
+
+# Runs all of the periodic work of the plugin on a small shared pool of threads.
+#
+# Most of our background work is a loop that sleeps and then does a little bit of work, like the progress timer,
+# the final snap timer, checking for expired apps or announcing our presence. Having a thread for each means a
+# lot of thread stacks that are mostly sleeping, which adds up on boards with 512MB of RAM.
+#
+# Tasks are kept in a heap ordered by their due time and the workers wait on the earliest one. A task is never
+# run on two workers at once, the next run is scheduled one interval after the callback returns, like the old
+# RepeatTimer threads did. All of the times are from time.monotonic, so clock changes, like NTP fixing the time of a
+# board without a RTC, don't stall or bunch up the tasks. Deadlines in wall clock time must be turned into a delay.
+#
+# Callbacks on the shared workers must not block, they should only do in memory work like the progress timer,
+# the layer deadlines and the latency summary. Anything that does network, camera or file I/O must be scheduled on a lane.
+# Each lane has one worker of its own, so a slow camera or a cloud call that's waiting on its timeout only delays
+# the other tasks of the same lane. The lanes are:
+#   - Camera: the final snap timer, which can wait seconds for a frame.
+#   - Gadget: the Gadget timer, which takes a snapshot and uploads it.
+#   - Cloud: calls to our servers, like the config update and sending the expired app notifications.
+#   - Moonraker: RPCs to Moonraker, like announcing our presence.
+#   - Files: file system work, like the UI injector.
+class TaskScheduler:
+
+    # Logic for a static singleton
+    _Instance = None
+    _InstanceLock = threading.Lock()
+
+    # The shared workers, for the tasks that don't block.
+    c_WorkerCount = 2
+
+    c_LaneCamera = "Camera"
+    c_LaneGadget = "Gadget"
+    c_LaneCloud = "Cloud"
+    c_LaneMoonraker = "Moonraker"
+    c_LaneFiles = "Files"
+
+    # The scheduler is started on first use, so there's no init call needed.
+    @staticmethod
+    def Get():
+        if TaskScheduler._Instance is None:
+            with TaskScheduler._InstanceLock:
+                if TaskScheduler._Instance is None:
+                    TaskScheduler._Instance = TaskScheduler(TaskScheduler.c_WorkerCount)
+        return TaskScheduler._Instance
+
+
+    def __init__(self, workerCount:int) -> None:
+        self.Condition = threading.Condition()
+        # A heap of (DueAt, Seq, Version, ScheduledTask)
+        self.Heap = []
+        self.SeqCounter = 0
+        self.Tasks = []
+        # lane name -> queue of due tasks for the lane's worker. The workers are started when the lane is first used.
+        self.Lanes = {}
+        for i in range(workerCount):
+            t = threading.Thread(target=self._Worker, name=f"TaskScheduler-{i}")
+            t.daemon = True
+            t.start()
+
+
+    # Schedules func to be called every intervalSec, until the returned task is cancelled.
+    # The first call is after initialDelaySec, or one interval if it's not set.
+    # If jitterSec is set, a random delay of up to that many seconds is added to every run, so things like
+    # cloud calls from many plugins don't all line up.
+    # If the callback can block, it must set a lane, see the class comment.
+    def Schedule(self, name:str, intervalSec:float, func, jitterSec:float = 0.0, initialDelaySec:float = None, lane:str = None) -> ScheduledTask:
+        task = ScheduledTask(self, name, intervalSec, func, jitterSec, lane=lane)
+        if initialDelaySec is None:
+            initialDelaySec = intervalSec
+        with self.Condition:
+            self._EnsureLaneUnderLock(lane)
+            self.Tasks.append(task)
+            self._PushUnderLock(task, time.monotonic() + initialDelaySec + self._GetJitter(task))
+        return task
+
+
+    # Calls func once, after delaySec, unless the returned task is cancelled before that.
+    # Used for deadlines, like the end of a debounce window.
+    def RunAfter(self, name:str, delaySec:float, func, lane:str = None) -> ScheduledTask:
+        task = ScheduledTask(self, name, delaySec, func, 0.0, repeat=False, lane=lane)
+        with self.Condition:
+            self._EnsureLaneUnderLock(lane)
+            self._PushUnderLock(task, time.monotonic() + max(delaySec, 0.0))
+        return task
+
+
+    # Returns the stats for all running tasks, by name.
+    def GetStats(self) -> dict:
+        with self.Condition:
+            return {task.Name: task.GetStats() for task in self.Tasks}
+
+
+    # Must be called under lock.
+    def _EnsureLaneUnderLock(self, lane:str) -> None:
+        if lane is None or lane in self.Lanes:
+            return
+        laneQueue = queue.Queue()
+        self.Lanes[lane] = laneQueue
+        t = threading.Thread(target=self._LaneWorker, args=(laneQueue,), name=f"TaskScheduler-{lane}")
+        t.daemon = True
+        t.start()
+
+
+    def _GetJitter(self, task:ScheduledTask) -> float:
+        if task.JitterSec <= 0:
+            return 0.0
+        return random.uniform(0, task.JitterSec)
+
+
+    # Must be called under lock.
+    def _PushUnderLock(self, task:ScheduledTask, dueAt:float) -> None:
+        task.Version += 1
+        task.DueAt = dueAt
+        self.SeqCounter += 1
+        heapq.heappush(self.Heap, (dueAt, self.SeqCounter, task.Version, task))
+        self.Condition.notify()
+
+
+    # Use ScheduledTask.Cancel
+    def CancelTask(self, task:ScheduledTask) -> None:
+        with self.Condition:
+            task.Running = False
+            # Bump the version so the entry in the heap is ignored.
+            task.Version += 1
+            if task in self.Tasks:
+                self.Tasks.remove(task)
+
+
+    # Use ScheduledTask.SetInterval
+    def SetTaskInterval(self, task:ScheduledTask, intervalSec:float) -> None:
+        with self.Condition:
+            task.IntervalSec = intervalSec
+            # If the callback is running, the new interval is used when it's scheduled again after it returns.
+            if task.Running is False or task.InCallback:
+                return
+            baseTime = task.LastRunEndedAt if task.LastRunEndedAt > 0 else time.monotonic()
+            self._PushUnderLock(task, max(baseTime + intervalSec, time.monotonic()) + self._GetJitter(task))
+
+
+    # Blocks until a task is due, and returns it.
+    def _Get(self) -> ScheduledTask:
+        with self.Condition:
+            while True:
+                now = time.monotonic()
+                while len(self.Heap) > 0:
+                    dueAt, _, version, task = self.Heap[0]
+                    # Drop entries for cancelled or rescheduled tasks.
+                    if version != task.Version or task.Running is False:
+                        heapq.heappop(self.Heap)
+                        continue
+                    if dueAt > now:
+                        break
+                    heapq.heappop(self.Heap)
+                    task.InCallback = True
+                    return task
+
+                timeoutSec = None
+                if len(self.Heap) > 0:
+                    timeoutSec = max(self.Heap[0][0] - now, 0.001)
+                self.Condition.wait(timeoutSec)
+
+
+    def _Worker(self):
+        while True:
+            task = self._Get()
+            # Tasks that can block are handed to their lane's worker.
+            if task.Lane is not None:
+                self.Lanes[task.Lane].put(task)
+                continue
+            self._Run(task)
+
+
+    def _LaneWorker(self, laneQueue:queue.Queue):
+        while True:
+            self._Run(laneQueue.get())
+
+
+    def _Run(self, task:ScheduledTask):
+        start = time.monotonic()
+        try:
+            task.Func()
+        except Exception as e:
+            Sentry.Exception("Exception in scheduled task "+task.Name, e)
+        end = time.monotonic()
+        with self.Condition:
+            task.InCallback = False
+            task.LastRunEndedAt = end
+            if task.Repeat is False:
+                task.Running = False
+                return
+            task.RecordRun(start - task.DueAt, end - start)
+            if task.Running:
+                self._PushUnderLock(task, end + task.IntervalSec + self._GetJitter(task))
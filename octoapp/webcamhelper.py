@@ -1,9 +1,15 @@
 import logging
 import os
 import json
+import threading
+import time
+
+import requests
 
 from .sentry import Sentry
 from .octohttprequest import OctoHttpRequest
+from .mjpegstreamreader import MjpegStreamReader
+from .mjpegparser import MjpegParser
 from .requestsutils import RequestsUtils
 
 #
@@ -46,6 +52,45 @@ class WebcamSettingItem:
         return True
 
 
+# A fully read snapshot, kept so callers close together in time don't each ask the camera for one.
+class CachedSnapshot:
+
+    def __init__(self, statusCode:int, headers:dict, body:bytes, url:str, didFallback:bool) -> None:
+        self.FetchedAt = time.monotonic()
+        self.StatusCode = statusCode
+        self.Headers = headers
+        self.Body = body
+        self.Url = url
+        self.DidFallback = didFallback
+
+
+    # Returns None if the result isn't a successful, fully read snapshot.
+    @staticmethod
+    def FromResult(octoHttpResult):
+        if octoHttpResult is None or octoHttpResult.Result is None or octoHttpResult.Result.status_code != 200 or octoHttpResult.FullBodyBuffer is None:
+            return None
+        # The buffer might be a bytearray if the jpeg header was fixed, make sure no one can change the shared copy.
+        return CachedSnapshot(200, dict(octoHttpResult.Result.headers), bytes(octoHttpResult.FullBodyBuffer), octoHttpResult.Url, octoHttpResult.DidFallback)
+
+
+    # Returns a new OctoHttpRequest.Result for the snapshot, so every caller can change its own headers.
+    # Like the results made from a stream frame, the response has no body, the snapshot is the FullBodyBuffer.
+    def ToResult(self) -> OctoHttpRequest.Result:
+        response = requests.models.Response()
+        response.status_code = self.StatusCode
+        response.headers.update(self.Headers)
+        response.url = self.Url
+        return OctoHttpRequest.Result(response, self.Url, self.DidFallback, self.Body)
+
+
+# A snapshot fetch that's running. Other callers for the same camera wait on it instead of starting their own.
+class SnapshotFlight:
+
+    def __init__(self) -> None:
+        self.Done = threading.Event()
+        self.Snapshot_CanBeNone = None
+
+
 # The point of this class is to abstract the logic that needs to be done to reliably get a webcam snapshot and stream from many types of
 # printer setups. The main entry point is GetSnapshot() which will try a number of ways to get a snapshot from whatever camera system is
 # setup. This includes USB based cameras, external IP based cameras, and OctoPrint instances that don't have a snapshot URL defined.
@@ -57,6 +102,18 @@ class WebcamHelper:
     # Logic for a static singleton
     _Instance = None
 
+    # How long a snapshot is reused for. This is short, it's meant to catch the callers that overlap,
+    # like the final snap timer and a notification, not to serve old frames.
+    c_DefaultSnapshotCacheTtlSec = 0.5
+    c_MaxSnapshotCacheTtlSec = 10.0
+
+    # When the snapshot comes from the stream reader, the newest frame is used if it's not older than this.
+    # Otherwise we wait up to c_StreamReaderWaitSec for the next one, which covers connecting to the stream.
+    c_StreamReaderMaxFrameAgeSec = 2.0
+    c_StreamReaderWaitSec = 5.0
+    # If the reader couldn't read any frames from a stream, it's not tried again for this stream for a while.
+    c_StreamReaderRetryAfterSec = 60.0
+
 
     @staticmethod
     def Init(webcamPlatformHelperInterface, pluginDataFolderPath):
@@ -73,6 +130,44 @@ class WebcamHelper:
         self.SettingsFilePath = os.path.join(pluginDataFolderPath, "webcam-settings.json")
         self.DefaultCameraName = None
         self._LoadDefaultCameraName()
+        # The snapshot cache and the running fetches, per camera. See _GetSharedSnapshot
+        self.SnapshotCacheLock = threading.Lock()
+        self.SnapshotCacheTtlSec = WebcamHelper.c_DefaultSnapshotCacheTtlSec
+        self.SnapshotCache = {}
+        self.SnapshotFlights = {}
+        self.SnapshotCacheHits = 0
+        self.SnapshotCacheMisses = 0
+        self.SnapshotCacheSharedFetches = 0
+        # The long lived mjpeg stream readers, by stream url. See _GetSnapshotFromStreamReader
+        self.StreamReaderEnabled = True
+        self.StreamReadersLock = threading.Lock()
+        self.StreamReaders = {}
+
+
+    # Enables or disables keeping the mjpeg stream open to get snapshots, when there's no snapshot url.
+    def SetStreamReaderEnabled(self, enabled:bool) -> None:
+        Sentry.Info("Webcam Helper", f"Mjpeg stream reader enabled: {enabled}")
+        self.StreamReaderEnabled = enabled
+
+
+    # Sets how long a snapshot can be reused for. 0 turns the cache off, but callers at the same time still share one fetch.
+    def SetSnapshotCacheTtlSec(self, ttlSec:float) -> None:
+        ttlSec = max(0.0, min(float(ttlSec), WebcamHelper.c_MaxSnapshotCacheTtlSec))
+        Sentry.Info("Webcam Helper", f"Snapshot cache ttl set to {ttlSec}s")
+        with self.SnapshotCacheLock:
+            self.SnapshotCacheTtlSec = ttlSec
+            self.SnapshotCache = {}
+
+
+    def GetSnapshotCacheStats(self) -> dict:
+        with self.SnapshotCacheLock:
+            return {
+                "TtlSec": self.SnapshotCacheTtlSec,
+                "Hits": self.SnapshotCacheHits,
+                "Misses": self.SnapshotCacheMisses,
+                # Callers that didn't hit the cache, but waited on a fetch that was already running.
+                "SharedFetches": self.SnapshotCacheSharedFetches,
+            }
 
 
     # Returns the snapshot URL from the settings.
@@ -172,7 +267,7 @@ class WebcamHelper:
             # We use the allow redirects flag to make the API more robust, since some webcam images might need that.
             #
             # Whatever this returns, the rest of the request system will handle it, since it's expecting the OctoHttpRequest object
-            return OctoHttpRequest.MakeHttpCall(webcamStreamUrl, OctoHttpRequest.GetPathType(webcamStreamUrl), "GET", {}, allowRedirects=True)
+            return OctoHttpRequest.MakeHttpCall(Sentry.Logger, webcamStreamUrl, OctoHttpRequest.GetPathType(webcamStreamUrl), "GET", {}, allowRedirects=True)
 
         # If we can't get the webcam stream URL, return None to fail out the request.
         return None
@@ -186,7 +281,50 @@ class WebcamHelper:
     def GetSnapshot(self, cameraName:str = None) -> OctoHttpRequest.Result:
         # Wrap the entire result in the _EnsureJpegHeaderInfo function, so ensure the returned snapshot can be used by all image processing libs.
         # Wrap the entire result in the add transform function, so on success the header gets added.
-        return self._AddOeWebcamTransformHeader(self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraName)), cameraName)
+        return self._AddOeWebcamTransformHeader(self._GetSharedSnapshot(cameraName), cameraName)
+
+
+    # Weak cameras are easily overloaded if the final snap, Gadget and notifications all ask for a snapshot at once.
+    # If there's a snapshot for the camera that's newer than the ttl it's used, and if a fetch is already running
+    # the caller waits for it, so there's only ever one request to each camera at a time.
+    # Every caller gets its own result object.
+    def _GetSharedSnapshot(self, cameraName:str) -> OctoHttpRequest.Result:
+        settings = self._GetWebcamSettingObj(cameraName)
+        key = settings.Name.lower() if settings is not None and settings.Name is not None else ""
+        isLeader = False
+        with self.SnapshotCacheLock:
+            snapshot = self.SnapshotCache.get(key, None)
+            if snapshot is not None and time.monotonic() - snapshot.FetchedAt <= self.SnapshotCacheTtlSec:
+                self.SnapshotCacheHits += 1
+                return snapshot.ToResult()
+            flight = self.SnapshotFlights.get(key, None)
+            if flight is None:
+                flight = SnapshotFlight()
+                self.SnapshotFlights[key] = flight
+                self.SnapshotCacheMisses += 1
+                isLeader = True
+            else:
+                self.SnapshotCacheSharedFetches += 1
+
+        if isLeader is False:
+            flight.Done.wait()
+            if flight.Snapshot_CanBeNone is None:
+                return None
+            return flight.Snapshot_CanBeNone.ToResult()
+
+        snapshot = None
+        try:
+            result = self._EnsureJpegHeaderInfo(self._GetSnapshotInternal(cameraName))
+            snapshot = CachedSnapshot.FromResult(result)
+            return result
+        finally:
+            # Always let the waiting callers go, even if the fetch threw.
+            with self.SnapshotCacheLock:
+                if snapshot is not None and self.SnapshotCacheTtlSec > 0:
+                    self.SnapshotCache[key] = snapshot
+                self.SnapshotFlights.pop(key, None)
+            flight.Snapshot_CanBeNone = snapshot
+            flight.Done.set()
 
 
     def _GetSnapshotInternal(self, cameraName:str) -> OctoHttpRequest.Result:
@@ -198,7 +336,7 @@ class WebcamHelper:
             # Where to actually make the webcam request in terms of IP and port.
             # We use the allow redirects flag to make the API more robust, since some webcam images might need that.
             Sentry.Debug("Webcam Helper", "Trying to get a snapshot using url: %s" % snapshotUrl)
-            octoHttpResult = OctoHttpRequest.MakeHttpCall(snapshotUrl, OctoHttpRequest.GetPathType(snapshotUrl), "GET", {}, allowRedirects=True)
+            octoHttpResult = OctoHttpRequest.MakeHttpCall(Sentry.Logger, snapshotUrl, OctoHttpRequest.GetPathType(snapshotUrl), "GET", {}, allowRedirects=True)
             # If the result was successful, we are done.
             if octoHttpResult is not None and octoHttpResult.Result is not None and octoHttpResult.Result.status_code == 200:
                 return octoHttpResult
@@ -208,16 +346,38 @@ class WebcamHelper:
         if streamUrl is None:
             Sentry.Debug("Webcam Helper", "Snapshot helper failed to get a snapshot from the snapshot URL, but we also don't have a stream URL.")
             return None
+        if self.StreamReaderEnabled:
+            octoHttpResult = self._GetSnapshotFromStreamReader(streamUrl)
+            if octoHttpResult is not None:
+                return octoHttpResult
         return self._GetSnapshotFromStream(streamUrl)
 
 
+    # Gets the latest frame from the long lived reader for the stream, starting it if needed.
+    # Returns None if the reader can't get a frame, in which case the caller should fall back to reading a single frame.
+    def _GetSnapshotFromStreamReader(self, url) -> OctoHttpRequest.Result:
+        with self.StreamReadersLock:
+            reader = self.StreamReaders.get(url, None)
+            if reader is None:
+                reader = MjpegStreamReader(url)
+                self.StreamReaders[url] = reader
+        if reader.HasFailedWithin(WebcamHelper.c_StreamReaderRetryAfterSec):
+            return None
+        frame = reader.GetLatestFrame(WebcamHelper.c_StreamReaderMaxFrameAgeSec, WebcamHelper.c_StreamReaderWaitSec)
+        if frame is None:
+            return None
+        # It's very important the content length matches the body, see _GetSnapshotFromStream
+        headers = {"content-type": frame.ContentType, "content-length": str(len(frame.Body))}
+        return CachedSnapshot(200, headers, frame.Body, url, False).ToResult()
+
+
     def _GetSnapshotFromStream(self, url) -> OctoHttpRequest.Result:
         try:
             # Try to connect the the mjpeg stream using the http helper class.
             # This is required because knowing the port to connect to might be tricky.
             # We use the allow redirects flag to make the API more robust, since some webcam images might need that.
             Sentry.Debug("Webcam Helper", "_GetSnapshotFromStream - Trying to get a snapshot using THE STREAM URL: %s" % url)
-            octoHttpResult = OctoHttpRequest.MakeHttpCall(url, OctoHttpRequest.GetPathType(url), "GET", {}, allowRedirects=True)
+            octoHttpResult = OctoHttpRequest.MakeHttpCall(Sentry.Logger, url, OctoHttpRequest.GetPathType(url), "GET", {}, allowRedirects=True)
             if octoHttpResult is None or octoHttpResult.Result is None:
                 Sentry.Debug("Webcam Helper", "_GetSnapshotFromStream - Failed to make web request.")
                 return None
@@ -249,65 +409,15 @@ class WebcamHelper:
                     Sentry.Info("Webcam Helper", "Snapshot fallback failed not correct content type: "+str(contentTypeLower))
                     return None
 
-                # Try to read some of the stream, so we can find the content type and the size of this first frame.
-                # We use the raw response, so we can control directly how much we read.
-                dataBuffer = response.raw.read(300)
-                if dataBuffer is None:
-                    Sentry.Info("Webcam Helper", "Snapshot fallback failed no data returned.")
+                # Parse the first frame. This works with and without a Content-Length in the part headers.
+                parsed = MjpegParser().ReadFrame(response.raw)
+                if parsed is None:
+                    Sentry.Info("Webcam Helper", "Snapshot fallback failed, the stream ended before a full frame was read.")
                     return None
-
-                # Decode the headers
-                # Example --boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-                #      or \r\n--boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-                #      or boundarydonotcross\r\nContent-Type: image/jpeg\r\nContent-Length: 48861\r\nX-Timestamp: 2122192.753042\r\n\r\n\x00!AVI1\x00\x01...
-                headerStr = dataBuffer.decode(errors="ignore")
-
-                # Find out how long the headers are. The \r\n\r\n sequence ends the headers.
-                endOfAllHeadersMatch = "\r\n\r\n"
-                endOfHeaderMatch = "\r\n"
-                headerStrSize = headerStr.find(endOfAllHeadersMatch)
-                if headerStrSize == -1:
-                    Sentry.Info("Webcam Helper", "Snapshot fallback failed no end of headers found.")
-                    return None
-
-                # Add 4 bytes for the \r\n\r\n end of header sequence.
-                headerStrSize += 4
-
-                # Try to find the size of this chunk.
-                frameSizeInt = 0
-                contentType = None
-                headers = headerStr.split(endOfHeaderMatch)
-                for header in headers:
-                    headerLower = header.lower()
-                    if headerLower.startswith("content-type"):
-                        # We found the content-length header!
-                        p = header.split(':')
-                        if len(p) == 2:
-                            contentType = p[1].strip()
-
-                    if headerLower.startswith("content-length"):
-                        # We found the content-length header!
-                        p = header.split(':')
-                        if len(p) == 2:
-                            frameSizeInt = int(p[1].strip())
-
-                if frameSizeInt == 0 or contentType is None:
-                    if frameSizeInt == 0:
-                        Sentry.Info("Webcam Helper", "Snapshot fallback failed to find frame size.")
-                    if contentType is None:
-                        Sentry.Info("Webcam Helper", "Snapshot fallback failed to find the content type.")
-                    return None
-                Sentry.Debug("Webcam Helper", "Image found in webcam stream. Size: %s, Type: %s" % (str(frameSizeInt), str(contentType)))
-
-                # Read the entire first image into the buffer.
-                totalDesiredBufferSize = frameSizeInt + headerStrSize
-                toRead = totalDesiredBufferSize - len(dataBuffer)
-                if toRead > 0:
-                    data = response.raw.read(toRead)
-                    if data is None:
-                        Sentry.Error("Webcam Helper", "_GetSnapshotFromStream failed to read the rest of the image buffer.")
-                        return None
-                    dataBuffer += data
+                contentType, frameView = parsed
+                # The parser's buffer isn't kept, so this is the one copy of the frame.
+                imageBuffer = bytes(frameView)
+                Sentry.Debug("Webcam Helper", "Image found in webcam stream. Size: %s, Type: %s" % (str(len(imageBuffer)), str(contentType)))
 
                 # Since this is a stream, ideally we close it as soon as possible to not waste resources.
                 # Otherwise this will be auto closed when the function leaves, since we are using the with: scope
@@ -316,21 +426,6 @@ class WebcamHelper:
                 except Exception:
                     pass
 
-                # If we got extra data trim it.
-                # This shouldn't happen, but just incase the api changes.
-                if len(dataBuffer) > totalDesiredBufferSize:
-                    dataBuffer = dataBuffer[:totalDesiredBufferSize]
-
-                # Check we got what we wanted.
-                if len(dataBuffer) != totalDesiredBufferSize:
-                    Sentry.Error("Webcam Helper", "Snapshot callback failed, the data read loop didn't produce the expected data size. desired: "+str(totalDesiredBufferSize)+", got: "+str(len(dataBuffer)))
-                    return None
-
-                # Get only the jpeg buffer
-                imageBuffer = dataBuffer[headerStrSize:]
-                if len(imageBuffer) != frameSizeInt:
-                    Sentry.Error("Webcam Helper", "Snapshot callback final image size was not the frame size. expected: "+str(frameSizeInt)+", got: "+str(len(imageBuffer)))
-
                 # If successful, we will use the already existing response object but update the values to match the fixed size body and content type.
                 response.status_code = 200
                 # Clear all of the current
@@ -429,7 +524,10 @@ class WebcamHelper:
             return octoHttpResult
 
         # The GetSnapshot API will always return the fully buffered snapshot.
-        buf = RequestsUtils.ReadAllContentFromStreamResponse(octoHttpResult.Result)
+        # Snapshots from the mjpeg stream are already buffered, and the stream is closed.
+        buf = octoHttpResult.FullBodyBuffer
+        if buf is None:
+            buf = RequestsUtils.ReadAllContentFromStreamResponse(octoHttpResult.Result)
         if buf is None:
             Sentry.Error("Webcam Helper", "_EnsureJpegHeaderInfo got a null body read from ReadAllContentFromStreamResponse")
             return None
@@ -67,6 +67,7 @@ class OctoAppPlugin(octoprint.plugin.AssetPlugin,
         # Init the static snapshot helper
         octoPrintWebcamHelper = OctoPrintWebcamHelper(self._settings)
         WebcamHelper.Init(octoPrintWebcamHelper, self.get_plugin_data_folder())
+        self._updateWebcamHelperSettings()
 
         # Setup our printer state object, that implements the interface.
         printerStateObject = PrinterStateObject(self._printer)
@@ -78,6 +79,7 @@ class OctoAppPlugin(octoprint.plugin.AssetPlugin,
         # Create the notification object now that we have the logger.
         self.NotificationHandler = NotificationsHandler(printerStateObject)
         printerStateObject.SetNotificationHandler(self.NotificationHandler)
+        self.NotificationHandler.EnableOutbox(self.get_plugin_data_folder())
 
         self.SubPlugins = [
             octoPrintAppStorage,
@@ -122,7 +124,17 @@ class OctoAppPlugin(octoprint.plugin.AssetPlugin,
 
     # Mixin method
     def get_settings_defaults(self):
-        return dict(encryptionKey=None, version=self._plugin_version)
+        return dict(encryptionKey=None, version=self._plugin_version, snapshotCacheTtlMs=int(WebcamHelper.c_DefaultSnapshotCacheTtlSec * 1000), snapshotStreamReader=True)
+
+
+    # Mixin method
+    def on_settings_save(self, data):
+        result = octoprint.plugin.SettingsPlugin.on_settings_save(self, data)
+        # The encryption key is part of our settings, make sure we don't keep using an old one.
+        if AppStorageHelper.Get() is not None:
+            AppStorageHelper.Get().InvalidateEncryptionKey()
+        self._updateWebcamHelperSettings()
+        return result
 
 
     # Mixin method
@@ -135,7 +147,8 @@ class OctoAppPlugin(octoprint.plugin.AssetPlugin,
         return dict(
             registerForNotifications=[],
             getPrinterFirmware=[],
-            getWebcamSnapshot=[]
+            getWebcamSnapshot=[],
+            getNotificationLatency=[]
         )
 
 
@@ -265,6 +278,16 @@ class OctoAppPlugin(octoprint.plugin.AssetPlugin,
         ]
     
 
+    def _updateWebcamHelperSettings(self):
+        if WebcamHelper.Get() is None:
+            return
+        try:
+            WebcamHelper.Get().SetSnapshotCacheTtlSec(int(self._settings.get(["snapshotCacheTtlMs"])) / 1000.0)
+            WebcamHelper.Get().SetStreamReaderEnabled(self._settings.get_boolean(["snapshotStreamReader"]))
+        except Exception as e:
+            Sentry.ExceptionNoSend("Failed to read the webcam settings", e)
+
+
     def _initLogger(self):
         self._logger_handler = logging.handlers.RotatingFileHandler(
             self._settings.get_plugin_logfile_path(), 
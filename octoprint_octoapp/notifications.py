@@ -1,6 +1,10 @@
+import flask
+
+from octoprint.access.permissions import Permissions
 
 from .subplugin import OctoAppSubPlugin
 from octoapp.notificationshandler import NotificationsHandler
+from octoapp.notificationtracing import NotificationLatencyStats
 from octoapp.sentry import Sentry
 
 class OctoAppNotificationsSubPlugin(OctoAppSubPlugin):
@@ -29,6 +33,15 @@ class OctoAppNotificationsSubPlugin(OctoAppSubPlugin):
         Sentry.Info("NOTIFICATION",  "Has PrintTimeGenius: %s" % self._hasPrintTimeGenius)
 
 
+    def OnApiCommand(self, command, data):
+        if command == "getNotificationLatency":
+            if not Permissions.PLUGIN_OCTOAPP_GET_DATA.can():
+                return flask.make_response("Insufficient rights", 403)
+            return flask.jsonify(NotificationLatencyStats.Get().GetStats())
+        else:
+            return None
+
+
     def OnPrintProgress(self, storage, path, progress):
         self._updateProgressAndSendIfChanged()
 
@@ -123,6 +136,22 @@ class OctoAppNotificationsSubPlugin(OctoAppSubPlugin):
             # No need to use a thread since all events are handled on a new thread.
             self.NotificationHandler.OnUserInteractionNeeded()
 
+        # Track the z offset for the first layer logic, the same way OctoPrint tracks currentZ from the sent moves.
+        # While the print is warming up the tool could be at any height, so like GetCurrentZOffset we report -1 then.
+        # Example cmd value: `G1 Z.4 F9000`
+        if self.NotificationHandler is not None and gcode and cmd and (gcode == "G1" or gcode == "G0") and self.NotificationHandler.IsLayerTrackingActive():
+            try:
+                indexOfZ = cmd.find('Z')
+                if indexOfZ != -1 and self.NotificationHandler.PrinterStateInterface.IsPrintWarmingUp():
+                    self.NotificationHandler.OnCurrentZOffsetChanged(-1)
+                elif indexOfZ != -1:
+                    endOfZValue = cmd.find(' ', indexOfZ)
+                    if endOfZValue == -1:
+                        endOfZValue = len(cmd)
+                    self.NotificationHandler.OnCurrentZOffsetChanged(float(cmd[indexOfZ+1:endOfZValue]))
+            except Exception as e:
+                Sentry.Warn("NOTIFICATION", "Failed to parse z from gcode %s, error %s" % (cmd, str(e)))
+
         # Look for positive extrude commands, so we can keep track of them for final snap and our first layer tracking logic.
         # Example cmd value: `G1 X112.979 Y93.81 E.03895`
         if self.NotificationHandler is not None and gcode and cmd and gcode == "G1":
@@ -81,27 +81,27 @@ class OctoPrintAppStorageSubPlugin(OctoAppSubPlugin):
                     apps = []
 
                 # add app for new registration
-                apps.append(
-                    AppInstance(
-                        fcmToken=fcmToken,
-                        fcmFallbackToken=data.get("fcmTokenFallback", None),
-                        instanceId=data["instanceId"],
-                        displayName=data["displayName"],
-                        displayDescription=data.get("displayDescription", None),
-                        model=data["model"],
-                        appVersion=data["appVersion"],
-                        appBuild=data["appBuild"],
-                        appLanguage=data["appLanguage"],
-                        lastSeenAt=time.time(),
-                        expireAt=(time.time() + data["expireInSecs"]) if "expireInSecs" in data else AppStorageHelper.Get().GetDefaultExpirationFromNow(),
-                        excludeNotifications=data.get("excludeNotifications", [])
-                    )
+                app = AppInstance(
+                    fcmToken=fcmToken,
+                    fcmFallbackToken=data.get("fcmTokenFallback", None),
+                    instanceId=data["instanceId"],
+                    displayName=data["displayName"],
+                    displayDescription=data.get("displayDescription", None),
+                    model=data["model"],
+                    appVersion=data["appVersion"],
+                    appBuild=data["appBuild"],
+                    appLanguage=data["appLanguage"],
+                    lastSeenAt=time.time(),
+                    expireAt=(time.time() + data["expireInSecs"]) if "expireInSecs" in data else AppStorageHelper.Get().GetDefaultExpirationFromNow(),
+                    excludeNotifications=data.get("excludeNotifications", [])
                 )
+                apps.append(app)
 
                 # save
                 Sentry.Info("NOTIFICATION", "Registered app %s" % fcmToken)
                 self._setAllApps(apps)
                 self.parent._settings.save()
+                AppStorageHelper.Get().OnAppRegistered(app)
                 return flask.jsonify(dict())
     
         else: 